@@ -1,5 +1,12 @@
+from amgSolver import *
+from apportionment import *
+from asyncWriter import *
+from checkpoint import *
+from csrAssembly import *
 from dilation_and_splits import *
 from g_input import *
+from incrementalSolver import *
+from inletDistribution import *
 from g_math import *
 from g_output import *
 from linearSystem import *
@@ -11,8 +18,15 @@ from linearSystem_pries import *
 from misc import *
 from paths import *
 from physiology import *
+from rbcPlacement import *
+from rbcStore import *
+from rheologyCache import *
+from runningSampler import *
+from simulationState import *
+from timeSeriesStore import *
 from units import *
 from vascularGraph import *
+from vertexClassifier import *
 from linearSystem_htd_TotFixedDT import *
 from linearSystem_htd_TotFixedDT_NEW import *
 from linearSystem_htd_TotFixedDT_StempRBCs import *
@@ -23,8 +37,15 @@ from hierarchicalApproach import *
 from linearSystem_htd_TotFixedDT_noBifRule import *
 from linearSystem_htd_TotFixedDT_passiveTracers import *
 
+import amgSolver
+import apportionment
+import asyncWriter
+import checkpoint
+import csrAssembly
 import dilation_and_splits
 import g_input
+import incrementalSolver
+import inletDistribution
 import g_math
 import g_output
 import linearSystem
@@ -37,8 +58,15 @@ import linearSystem_pries
 import misc
 import paths
 import physiology
+import rbcPlacement
+import rbcStore
+import rheologyCache
+import runningSampler
+import simulationState
+import timeSeriesStore
 import units
 import vascularGraph
+import vertexClassifier
 import linearSystem_htd_TotFixedDT
 import linearSystem_htd_TotFixedDT_StempRBCs
 import linearSystem_htd_TotFixedDT_StempRBCs_AvgBox
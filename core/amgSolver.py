@@ -0,0 +1,166 @@
+"""This module provides an AMG preconditioned Krylov solver for the pressure
+system that keeps its multigrid hierarchy between consecutive solves. During
+an RBC simulation only a few effective resistances change from one timestep
+to the next, such that the hierarchy computed for a previous matrix remains a
+good preconditioner. The (expensive) setup is therefore only repeated if the
+number of Krylov iterations or the relative change of the matrix entries
+since the last setup exceed a given threshold.
+"""
+from __future__ import division
+
+import numpy as np
+import time as ttime
+from pyamg import rootnode_solver
+from scipy.sparse.linalg import gmres, cg
+
+__all__ = ['AMGSolver']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class AMGSolver(object):
+    """Solves A x = b with GMRES or CG, preconditioned by a reusable
+    rootnode AMG hierarchy.
+    """
+    def __init__(self, rebuildIterations=20, rebuildDrift=0.1, accel='gmres',
+                 verbose=False):
+        """Initializes an AMGSolver instance.
+        INPUT: rebuildIterations: The AMG hierarchy is rebuilt before the next
+                                  solve, if a solve required more Krylov
+                                  iterations than this.
+               rebuildDrift: The AMG hierarchy is rebuilt, if the maximum
+                             relative change of a matrix entry with respect
+                             to the matrix used for the setup exceeds this
+                             value.
+               accel: Krylov method, either 'gmres' or 'cg'.
+               verbose: Print setup and solve statistics after each solve.
+        OUTPUT: None
+        """
+        if accel not in ['gmres', 'cg']:
+            raise KeyError('Unknown Krylov method %s' % accel)
+        self.rebuildIterations = rebuildIterations
+        self.rebuildDrift = rebuildDrift
+        self.accel = accel
+        self.verbose = verbose
+        self._ml = None
+        self._M = None
+        self._setupData = None
+        self._setupIndices = None
+        self._setupIndptr = None
+        self._rebuild = True
+        self.stats = {'nSetups': 0, 'nSolves': 0, 'setupTime': 0.0,
+                      'solveTime': 0.0, 'iterations': 0,
+                      'lastIterations': 0, 'lastSetupTime': 0.0,
+                      'lastSolveTime': 0.0, 'lastDrift': 0.0}
+
+    #--------------------------------------------------------------------------
+
+    def drift(self, A):
+        """Computes the maximum relative change of the entries of A with
+        respect to the matrix used for the current AMG setup.
+        INPUT: A: Matrix in CSR format.
+        OUTPUT: Maximum relative change (infinity, if the sparsity pattern
+                has changed or no setup exists).
+        """
+        if self._setupData is None or \
+           len(A.data) != len(self._setupData) or \
+           not np.array_equal(A.indptr, self._setupIndptr) or \
+           not np.array_equal(A.indices, self._setupIndices):
+            return np.inf
+        data0 = self._setupData
+        nonzero = data0 != 0
+        change = np.abs(A.data - data0)
+        if np.any(change[~nonzero] > 0):
+            return np.inf
+        if not np.any(nonzero):
+            return 0.0
+        return np.max(change[nonzero] / np.abs(data0[nonzero]))
+
+    #--------------------------------------------------------------------------
+
+    def setup(self, A):
+        """Computes the AMG hierarchy of A. A copy of A is stored, such that
+        in-place modifications of A do not alter the preconditioner.
+        INPUT: A: Matrix in CSR format.
+        OUTPUT: None
+        """
+        t0 = ttime.time()
+        A0 = A.copy()
+        A0.sort_indices()
+        # The setup draws random numbers. The state of the global generator
+        # is restored, such that the RBC inflow does not depend on how often
+        # the hierarchy is rebuilt:
+        randomState = np.random.get_state()
+        self._ml = rootnode_solver(A0, smooth=('energy', {'degree':2}),
+                                   strength='evolution')
+        np.random.set_state(randomState)
+        self._M = self._ml.aspreconditioner(cycle='V')
+        self._setupData = A.data.copy()
+        self._setupIndices = A.indices.copy()
+        self._setupIndptr = A.indptr.copy()
+        self._rebuild = False
+        setupTime = ttime.time() - t0
+        self.stats['nSetups'] += 1
+        self.stats['setupTime'] += setupTime
+        self.stats['lastSetupTime'] = setupTime
+
+    #--------------------------------------------------------------------------
+
+    def solve(self, A, b, x0=None, tol=1e-10, maxiter=200):
+        """Solves A x = b, reusing or rebuilding the AMG hierarchy.
+        INPUT: A: Matrix in CSR format.
+               b: Right hand side vector.
+               x0: Initial guess. (Optional, default=None, i.e. zero.)
+               tol: Tolerance of the Krylov method.
+               maxiter: Maximum number of iterations of the Krylov method.
+        OUTPUT: x: Solution vector.
+                info: Convergence flag of the Krylov method (0 on success).
+        """
+        drift = self.drift(A)
+        self.stats['lastDrift'] = drift
+        self.stats['lastSetupTime'] = 0.0
+        if self._rebuild or drift > self.rebuildDrift:
+            self.setup(A)
+
+        iterations = [0]
+        def counter(arg):
+            iterations[0] += 1
+
+        t0 = ttime.time()
+        if self.accel == 'gmres':
+            x, info = gmres(A, b, x0=x0, tol=tol, maxiter=maxiter,
+                            M=self._M, callback=counter)
+        else:
+            x, info = cg(A, b, x0=x0, tol=tol, maxiter=maxiter,
+                         M=self._M, callback=counter)
+        solveTime = ttime.time() - t0
+
+        self.stats['nSolves'] += 1
+        self.stats['solveTime'] += solveTime
+        self.stats['lastSolveTime'] = solveTime
+        self.stats['iterations'] += iterations[0]
+        self.stats['lastIterations'] = iterations[0]
+        if iterations[0] > self.rebuildIterations:
+            self._rebuild = True
+        if self.verbose:
+            print(self.report())
+        return x, info
+
+    #--------------------------------------------------------------------------
+
+    def report(self):
+        """Summarizes the setup and solve statistics.
+        INPUT: None
+        OUTPUT: String containing the number of setups and solves, the
+                accumulated setup and solve times and the iteration counts.
+        """
+        s = self.stats
+        avgIter = s['iterations'] / max(s['nSolves'], 1)
+        return ('AMG setups: %i (%.3f s, last %.3f s), solves: %i (%.3f s, '
+                'last %.3f s), iterations: last %i, average %.1f, '
+                'drift: %.2e' % (s['nSetups'], s['setupTime'],
+                                 s['lastSetupTime'], s['nSolves'],
+                                 s['solveTime'], s['lastSolveTime'],
+                                 s['lastIterations'], avgIter,
+                                 s['lastDrift']))
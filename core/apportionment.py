@@ -0,0 +1,106 @@
+"""This module splits integer numbers of red blood cells (RBCs) between the
+daughter vessels of divergent bifurcations. The share of a daughter vessel is
+the product of its flow ratio and the number of overshooting RBCs, rounded to
+the nearest integer (ties to even), the last daughter vessel receives the
+remaining RBCs. This is the closed-form solution of the linear equations
+n_i / N - ratio_i = 0 that were previously solved by scipy.optimize.root and
+rounded afterwards. The split is computed for many bifurcations at once.
+"""
+from __future__ import division
+
+import math
+import time
+import numpy as np
+from scipy.optimize import root
+
+__all__ = ['apportion_rbcs', 'apportionment_benchmark']
+
+#------------------------------------------------------------------------------
+
+
+def _round_half_even(x):
+    """Rounds to the nearest integer, ties to even (as np.round).
+    INPUT: x: Float.
+    OUTPUT: Integer.
+    """
+    n = math.floor(x)
+    remainder = x - n
+    if remainder > 0.5 or (remainder == 0.5 and n % 2 == 1):
+        n += 1
+    return int(n)
+
+#------------------------------------------------------------------------------
+
+
+def apportion_rbcs(total, ratios):
+    """Splits the overshooting RBCs of one or more bifurcations between the
+    daughter vessels.
+    INPUT: total: Number of RBCs to be split. Either an integer (single
+                  bifurcation) or an array with one entry per bifurcation.
+           ratios: Flow ratios of all daughter vessels except the last one.
+                   Either a sequence (single bifurcation) or a 2-D array with
+                   one row per bifurcation.
+    OUTPUT: Number of RBCs per daughter vessel, the last entry holds the
+            remaining RBCs. A list of integers for a single bifurcation,
+            otherwise an integer array with one row per bifurcation.
+    """
+    if isinstance(total, (int, long, np.integer)):
+        # A single bifurcation is split in pure Python, which is faster than
+        # NumPy for a handful of numbers:
+        shares = [_round_half_even(r * total) for r in ratios]
+        shares.append(int(total) - sum(shares))
+        return shares
+    total = np.asarray(total, dtype=np.int64)
+    ratios = np.asarray(ratios, dtype=float).reshape(len(total), -1)
+    shares = np.empty((ratios.shape[0], ratios.shape[1] + 1), dtype=np.int64)
+    shares[:, :-1] = np.round(ratios * total[:, np.newaxis])
+    shares[:, -1] = total - shares[:, :-1].sum(axis=1)
+    return shares
+
+#------------------------------------------------------------------------------
+
+
+def apportionment_benchmark(nEvents=10000, nMaxRBCs=20, nDaughters=2,
+                            seed=0):
+    """Compares apportion_rbcs to the root finding approach it replaces, with
+    respect to both the result and the runtime.
+    INPUT: nEvents: Number of random bifurcation events.
+           nMaxRBCs: Maximum number of overshooting RBCs per event.
+           nDaughters: Number of daughter vessels (2 or 3).
+           seed: Seed of the random number generator.
+    OUTPUT: Dictionary with the number of events whose split differs
+            ('nMismatch'), the runtimes of the root finding approach, of
+            apportion_rbcs called per event and called once for all events
+            ('tRoot', 'tPerEvent', 'tVectorized', in seconds) and the
+            resulting speedups ('speedupPerEvent', 'speedupVectorized').
+    """
+    rng = np.random.RandomState(seed)
+    total = rng.randint(1, nMaxRBCs + 1, nEvents)
+    ratios = rng.dirichlet(np.ones(nDaughters), nEvents)[:, :-1]
+
+    t0 = time.time()
+    reference = np.empty((nEvents, nDaughters), dtype=np.int64)
+    for i in xrange(nEvents):
+        n = total[i]
+        r = ratios[i]
+        def errorDistributeRBCs(x):
+            return x / float(n) - r
+        x = root(errorDistributeRBCs, np.ceil(r * n))['x']
+        reference[i, :-1] = np.round(x)
+        reference[i, -1] = n - reference[i, :-1].sum()
+    tRoot = time.time() - t0
+
+    t0 = time.time()
+    for i in xrange(nEvents):
+        apportion_rbcs(int(total[i]), ratios[i].tolist())
+    tPerEvent = time.time() - t0
+
+    t0 = time.time()
+    shares = apportion_rbcs(total, ratios)
+    tVectorized = time.time() - t0
+
+    return {'nMismatch': int(np.any(shares != reference, axis=1).sum()),
+            'tRoot': tRoot, 'tPerEvent': tPerEvent,
+            'tVectorized': tVectorized,
+            'speedupPerEvent': tRoot / max(tPerEvent, 1e-12),
+            'speedupVectorized': tRoot / max(tVectorized, 1e-12)}
@@ -0,0 +1,212 @@
+"""This module provides a background writer for the output of long running
+simulations (backups, samples). Write jobs are executed in the submitted
+order by a single worker thread, such that the simulation continues while
+the data is written to (slow) storage. The worker thread is started by the
+first job and runs until close() is called (a later job starts a new one).
+Writers that are still running at interpreter exit are closed, i.e. their
+pending jobs are completed. The jobs must only operate on
+immutable snapshots of the data, e.g. pickled strings or copies of arrays.
+The queue of pending jobs is bounded: if the storage falls behind, submit()
+blocks until a job has been completed (backpressure), limiting the memory
+held by pending snapshots. Exceptions raised by a job are stored and raised
+again in the submitting thread by the next call of check(), submit() or
+flush().
+"""
+from __future__ import division
+
+import atexit
+import os
+import threading
+import time
+import traceback
+import weakref
+import Queue
+
+__all__ = ['AsyncWriter']
+
+# Writers whose worker thread may be running:
+_writers = weakref.WeakSet()
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class AsyncWriter(object):
+    """Executes write jobs in a background thread.
+    """
+    def __init__(self, maxQueue=2):
+        """Initializes an AsyncWriter instance.
+        INPUT: maxQueue: Maximum number of pending jobs. (Optional,
+                         default=2.)
+        OUTPUT: None
+        """
+        self._queue = Queue.Queue(maxsize=maxQueue)
+        self._error = None
+        self._thread = None
+        self.stats = {'nSubmitted': 0, 'nWritten': 0, 'maxDepth': 0,
+                      'tBlocked': 0.0, 'tWriting': 0.0}
+
+    #--------------------------------------------------------------------------
+
+    def _running(self):
+        """Returns whether or not the worker thread is running.
+        INPUT: None
+        OUTPUT: Boolean.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    #--------------------------------------------------------------------------
+
+    def _start(self):
+        """Starts the worker thread, unless it is running already.
+        INPUT: None
+        OUTPUT: None
+        """
+        if self._running():
+            return
+        self._thread = threading.Thread(target=self._work,
+                                        name='AsyncWriter')
+        self._thread.daemon = True
+        self._thread.start()
+        _writers.add(self)
+
+    #--------------------------------------------------------------------------
+
+    def _work(self):
+        """Main loop of the worker thread.
+        INPUT: None
+        OUTPUT: None
+        """
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    # Jobs following a failure are skipped:
+                    function, args = job
+                    t0 = time.time()
+                    function(*args)
+                    self.stats['tWriting'] += time.time() - t0
+                    self.stats['nWritten'] += 1
+            except Exception:
+                self._error = traceback.format_exc()
+            finally:
+                self._queue.task_done()
+
+    #--------------------------------------------------------------------------
+
+    def check(self):
+        """Raises an error if a previous job has failed.
+        INPUT: None
+        OUTPUT: None
+        """
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError('Background write failed:\n%s' % error)
+
+    #--------------------------------------------------------------------------
+
+    def depth(self):
+        """Returns the number of pending jobs.
+        INPUT: None
+        OUTPUT: Number of jobs in the queue.
+        """
+        return self._queue.qsize()
+
+    #--------------------------------------------------------------------------
+
+    def submit(self, function, *args):
+        """Submits a job. Blocks if the queue is full.
+        INPUT: function: Function to be executed in the background.
+               *args: Arguments of the function. These must not be modified
+                      afterwards.
+        OUTPUT: None
+        """
+        self.check()
+        self._start()
+        t0 = time.time()
+        self._queue.put((function, args))
+        self.stats['tBlocked'] += time.time() - t0
+        self.stats['nSubmitted'] += 1
+        self.stats['maxDepth'] = max(self.stats['maxDepth'], self.depth())
+
+    #--------------------------------------------------------------------------
+
+    def write_bytes(self, filename, data):
+        """Writes a string to a file in the background. The file is written
+        under a temporary name and renamed when complete.
+        INPUT: filename: Name of the file.
+               data: String (e.g. returned by cPickle.dumps).
+        OUTPUT: None
+        """
+        self.submit(_write_bytes, filename, data)
+
+    #--------------------------------------------------------------------------
+
+    def flush(self):
+        """Waits until all pending jobs have been completed.
+        INPUT: None
+        OUTPUT: None
+        """
+        self._queue.join()
+        self.check()
+
+    #--------------------------------------------------------------------------
+
+    def close(self):
+        """Completes all pending jobs and stops the worker thread.
+        INPUT: None
+        OUTPUT: None
+        """
+        if self._running():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        _writers.discard(self)
+        self.check()
+
+    #--------------------------------------------------------------------------
+
+    def report(self):
+        """Returns a summary of the write statistics.
+        INPUT: None
+        OUTPUT: String.
+        """
+        return 'Background writes: %i, max. queue depth: %i, blocked: %.2f s, writing: %.2f s' \
+            % (self.stats['nWritten'], self.stats['maxDepth'],
+               self.stats['tBlocked'], self.stats['tWriting'])
+
+#------------------------------------------------------------------------------
+
+
+def _write_bytes(filename, data):
+    """Writes a string to a file atomically (via a temporary file, which is
+    synced to disk before it is renamed).
+    INPUT: filename: Name of the file.
+           data: String.
+    OUTPUT: None
+    """
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpname, filename)
+
+#------------------------------------------------------------------------------
+
+
+@atexit.register
+def _close_writers():
+    """Completes the pending jobs of all running writers at interpreter exit
+    (before the daemon worker threads are stopped).
+    INPUT: None
+    OUTPUT: None
+    """
+    for writer in list(_writers):
+        try:
+            writer.close()
+        except RuntimeError:
+            traceback.print_exc()
@@ -0,0 +1,164 @@
+"""This module writes and reads lightweight checkpoints of simulations on a
+vascular graph. A checkpoint holds the mutable simulation state only, as a
+set of flat binary NumPy arrays (compressed .npz format, no pickles) plus
+a JSON header with scalar values. Float arrays are byte-shuffled before
+compression (as by the shuffle filter of HDF5), i.e. the bytes of equal
+significance are stored contiguously, which compresses better. Both steps
+are lossless. The static graph is not stored, but referenced by a content
+hash of its topology and geometry, which is checked when the checkpoint is
+restored. Checkpoints are written atomically, i.e. a
+crash during writing never leaves a truncated checkpoint behind.
+Edge and vertex properties that may hold None (e.g. 'httBC') are stored as
+float arrays with nan entries, see optional_to_array and array_to_optional.
+"""
+from __future__ import division
+
+import hashlib
+import json
+import os
+import numpy as np
+
+__all__ = ['graph_hash', 'write_checkpoint', 'read_checkpoint',
+           'optional_to_array', 'array_to_optional']
+
+_HEADER = '__header__'
+_SHUFFLED = '__shuffled__'
+
+#------------------------------------------------------------------------------
+
+
+def graph_hash(G):
+    """Computes a content hash of the static part of a vascular graph, i.e.
+    of its topology and of the edge properties 'diameter' and 'length'.
+    INPUT: G: Vascular graph in iGraph format.
+    OUTPUT: Hexadecimal SHA-1 digest.
+    """
+    sha = hashlib.sha1()
+    sha.update(np.array([G.vcount(), G.ecount()], dtype=np.int64).tostring())
+    if G.ecount() > 0:
+        sha.update(np.array(G.get_edgelist(), dtype=np.int64).tostring())
+    for name in ['diameter', 'length']:
+        sha.update(np.array(G.es[name], dtype=np.float64).tostring())
+    return sha.hexdigest()
+
+#------------------------------------------------------------------------------
+
+
+def _shuffle(array):
+    """Byte-shuffles an array.
+    INPUT: array: NumPy array.
+    OUTPUT: uint8 array holding the first bytes of all entries, followed by
+            the second bytes, etc.
+    """
+    array = np.ascontiguousarray(array)
+    return np.ascontiguousarray(array.view(np.uint8).reshape(
+        -1, array.dtype.itemsize).T).ravel()
+
+#------------------------------------------------------------------------------
+
+
+def _unshuffle(data, dtype, shape):
+    """Reverses _shuffle.
+    INPUT: data: uint8 array as returned by _shuffle.
+           dtype: Data type of the original array.
+           shape: Shape of the original array.
+    OUTPUT: NumPy array.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    return np.ascontiguousarray(data.reshape(itemsize, -1).T).view(
+        dtype).reshape(shape)
+
+#------------------------------------------------------------------------------
+
+
+def write_checkpoint(filename, arrays, header):
+    """Writes a checkpoint atomically.
+    INPUT: filename: Name of the checkpoint file.
+           arrays: Dictionary of NumPy arrays (numeric data types only).
+           header: Dictionary of scalar values and strings (JSON
+                   serializable).
+    OUTPUT: None, file written to disk.
+    """
+    if arrays.has_key(_HEADER):
+        raise KeyError('%s is a reserved name' % _HEADER)
+    if header.has_key(_SHUFFLED):
+        raise KeyError('%s is a reserved name' % _SHUFFLED)
+    data = {}
+    shuffled = {}
+    for name, array in arrays.items():
+        if array.dtype.kind == 'f' and array.size > 0:
+            data[name] = _shuffle(array)
+            shuffled[name] = [array.dtype.str, list(array.shape)]
+        else:
+            data[name] = array
+    header = dict(header)
+    header[_SHUFFLED] = shuffled
+    data[_HEADER] = np.frombuffer(json.dumps(header), dtype=np.uint8)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        np.savez_compressed(f, **data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpname, filename)
+
+#------------------------------------------------------------------------------
+
+
+def read_checkpoint(filename):
+    """Reads a checkpoint written by write_checkpoint.
+    INPUT: filename: Name of the checkpoint file.
+    OUTPUT: arrays: Dictionary of NumPy arrays.
+            header: Dictionary of scalar values and strings.
+    """
+    with open(filename, 'rb') as f:
+        data = np.load(f, allow_pickle=False)
+        arrays = dict([(k, data[k]) for k in data.files if k != _HEADER])
+        header = json.loads(data[_HEADER].tostring())
+    for name, (dtype, shape) in header.pop(_SHUFFLED, {}).items():
+        arrays[name] = _unshuffle(arrays[name], str(dtype), shape)
+    return arrays, header
+
+#------------------------------------------------------------------------------
+
+
+def optional_to_array(values, width=None):
+    """Converts a list of values that may be None into a float array, None
+    is represented by nan.
+    INPUT: values: List of scalars (width=None) or of sequences of length
+                   width (e.g. 'logNormal'). Empty sequences are treated as
+                   None.
+           width: Length of the sequences. (Optional, default=None, i.e.
+                  scalars.)
+    OUTPUT: Float array of shape (len(values),) or (len(values), width).
+    """
+    if width is None:
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=float)
+    array = np.nan * np.ones((len(values), width))
+    for i, v in enumerate(values):
+        if v is not None and len(v) > 0:
+            array[i, :len(v)] = v
+    return array
+
+#------------------------------------------------------------------------------
+
+
+def array_to_optional(array, sequence=False):
+    """Converts a float array written by optional_to_array back into a list,
+    nan is represented by None.
+    INPUT: array: Float array.
+           sequence: If True, the rows of a 2-D array are converted into
+                     lists, all-nan rows into empty lists. (Optional,
+                     default=False, i.e. all-nan rows are None.)
+    OUTPUT: List of values.
+    """
+    if array.ndim == 1:
+        return [None if np.isnan(v) else v for v in array.tolist()]
+    result = []
+    for row in array.tolist():
+        row = [v for v in row if not np.isnan(v)]
+        if len(row) == 0:
+            result.append([] if sequence else None)
+        else:
+            result.append(row)
+    return result
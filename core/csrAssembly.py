@@ -0,0 +1,153 @@
+"""This module provides a vectorized assembly of the linear system A x = b that
+is solved for the pressure field. The sparsity pattern of A only depends on
+the graph topology and on which vertices carry a pressure boundary condition.
+It is therefore computed once, together with a map that assigns every edge
+conductance to its slots in the CSR data array of A (and in b). Subsequent
+assemblies fill A and b in a few NumPy scatter operations, without touching
+the graph structure or converting from lil to csr format.
+"""
+from __future__ import division
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+__all__ = ['CSRAssembler']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class CSRAssembler(object):
+    """Precomputes the edge to CSR-slot map of the pressure system and
+    assembles A and b from an array of edge conductances.
+    The resulting system is identical to the one constructed row by row in
+    the linear system classes: Rows of pBC vertices read A[i,i] = 1 and
+    b[i] = pBC, all other rows hold the sum of the adjacent conductances on
+    the diagonal and the negative conductance for every neighbor that is not
+    a pBC vertex. The contribution of pBC neighbors is moved to b.
+    Self-loops do not contribute to the system.
+    """
+    def __init__(self, G):
+        """Initializes a CSRAssembler instance.
+        INPUT: G: Vascular graph in iGraph format. The vertex properties 'pBC'
+                  and 'rBC' need to be present. The set of pBC vertices must
+                  not change during the lifetime of the assembler (the values
+                  may change).
+        OUTPUT: None
+        """
+        nV = G.vcount()
+        nE = G.ecount()
+        self._nV = nV
+        self._nE = nE
+
+        if nE > 0:
+            edgelist = np.array(G.get_edgelist(), dtype=np.int64)
+        else:
+            edgelist = np.zeros((0, 2), dtype=np.int64)
+        source = edgelist[:, 0]
+        target = edgelist[:, 1]
+        self.source = source
+        self.target = target
+
+        isPBC = np.array([p is not None for p in G.vs['pBC']], dtype=bool)
+        isRBC = np.array([r is not None for r in G.vs['rBC']], dtype=bool)
+        self.isPBC = isPBC
+        self.pBCVertices = np.nonzero(isPBC)[0]
+        self.rBCVertices = np.nonzero(isRBC & ~isPBC)[0]
+
+        eIndices = np.arange(nE, dtype=np.int64)
+        noLoop = source != target
+        s = source[noLoop]
+        t = target[noLoop]
+        eNoLoop = eIndices[noLoop]
+        freeS = ~isPBC[s]
+        freeT = ~isPBC[t]
+        freeST = freeS & freeT
+
+        # Entries of A as (row, column, edge, coefficient). The diagonal of
+        # every vertex is always part of the sparsity pattern:
+        rows = [s[freeS], t[freeT], s[freeST], t[freeST]]
+        cols = [s[freeS], t[freeT], t[freeST], s[freeST]]
+        edges = [eNoLoop[freeS], eNoLoop[freeT], eNoLoop[freeST],
+                 eNoLoop[freeST]]
+        coefs = [np.ones(freeS.sum()), np.ones(freeT.sum()),
+                 -np.ones(freeST.sum()), -np.ones(freeST.sum())]
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        diagonal = np.arange(nV, dtype=np.int64)
+
+        keys = np.concatenate([rows * nV + cols, diagonal * nV + diagonal])
+        uniqueKeys, slots = np.unique(keys, return_inverse=True)
+        uniqueRows = uniqueKeys // nV
+        indices = uniqueKeys % nV
+        indptr = np.zeros(nV + 1, dtype=np.int64)
+        np.cumsum(np.bincount(uniqueRows, minlength=nV), out=indptr[1:])
+
+        self._nnz = len(uniqueKeys)
+        self._slot = slots[:len(rows)]
+        self._edge = np.concatenate(edges)
+        self._coef = np.concatenate(coefs)
+        self._diagSlot = slots[len(rows):]
+        self._pBCDiagSlot = self._diagSlot[self.pBCVertices]
+
+        # Contributions of pBC neighbors to b as (row, edge, pBC vertex):
+        sToPBC = freeS & ~freeT
+        tToPBC = freeT & ~freeS
+        self._bRow = np.concatenate([s[sToPBC], t[tToPBC]])
+        self._bEdge = np.concatenate([eNoLoop[sToPBC], eNoLoop[tToPBC]])
+        self._bNeighbor = np.concatenate([t[sToPBC], s[tToPBC]])
+
+        # rBCs are added once per (non-loop) adjacent edge:
+        self._rBCFactor = np.bincount(np.concatenate([s, t]),
+                                      minlength=nV)[self.rBCVertices]
+
+        self.A = csr_matrix((np.zeros(self._nnz), indices, indptr),
+                            shape=(nV, nV))
+        self.b = np.zeros(nV)
+
+    #--------------------------------------------------------------------------
+
+    def boundary_values(self, G):
+        """Reads the current pBC and rBC values of the boundary vertices.
+        INPUT: G: Vascular graph in iGraph format.
+        OUTPUT: Arrays of the pBC values (one per pBC vertex) and the rBC
+                values (one per rBC vertex).
+        """
+        if len(self.pBCVertices) > 0:
+            pBC = np.array(G.vs[self.pBCVertices.tolist()]['pBC'], dtype=float)
+        else:
+            pBC = np.zeros(0)
+        if len(self.rBCVertices) > 0:
+            rBC = np.array(G.vs[self.rBCVertices.tolist()]['rBC'], dtype=float)
+        else:
+            rBC = np.zeros(0)
+        return pBC, rBC
+
+    #--------------------------------------------------------------------------
+
+    def assemble(self, conductance, pBC, rBC=None):
+        """Fills the persistent matrix A and vector b in place.
+        INPUT: conductance: Array of edge conductances (one value per edge).
+               pBC: Array of pressure boundary values, ordered like
+                    self.pBCVertices.
+               rBC: Array of rBC values, ordered like self.rBCVertices.
+                    (Optional, default=None.)
+        OUTPUT: A: Matrix A of the linear system in CSR format.
+                b: Vector b of the linear system.
+        """
+        conductance = np.asarray(conductance, dtype=float)
+        A = self.A
+        b = self.b
+        A.data[:] = np.bincount(self._slot,
+                                weights=self._coef * conductance[self._edge],
+                                minlength=self._nnz)
+        A.data[self._pBCDiagSlot] = 1.0
+
+        pressureBC = np.zeros(self._nV)
+        pressureBC[self.pBCVertices] = pBC
+        b[:] = np.bincount(self._bRow, weights=conductance[self._bEdge] *
+                           pressureBC[self._bNeighbor], minlength=self._nV)
+        b[self.pBCVertices] = pBC
+        if rBC is not None and len(self.rBCVertices) > 0:
+            b[self.rBCVertices] += rBC * self._rBCFactor
+        return A, b
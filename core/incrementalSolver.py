@@ -0,0 +1,159 @@
+"""This module provides a direct solver for the pressure system that updates
+its solution incrementally, if only a few edge conductances change between
+two consecutive solves. A change of the conductance of edge e by dc alters A
+by the rank-one term dc * u u^T, where u is the incidence vector of e
+restricted to the vertices without pressure boundary condition. The matrix
+is factorized once and changes with respect to the factorized matrix are
+taken into account by the Sherman-Morrison-Woodbury formula. Every edge that
+enters the update costs one solve with the factorization, and every solve
+costs O(nVertices * rank) for the correction. A new factorization is
+computed once these costs, accumulated since the last factorization, would
+exceed the (measured) cost of the factorization itself, or once the number
+of changed edges exceeds a given threshold.
+"""
+from __future__ import division
+
+import numpy as np
+import time as ttime
+from scipy.sparse.linalg import splu
+
+__all__ = ['IncrementalSolver']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class IncrementalSolver(object):
+    """Solves the pressure system A x = b assembled by a CSRAssembler, using
+    an LU factorization of a reference matrix and low-rank corrections for
+    the edges whose conductance has changed since the factorization.
+    """
+    def __init__(self, assembler, maxRank=500):
+        """Initializes an IncrementalSolver instance.
+        INPUT: assembler: CSRAssembler instance that constructs A and b.
+               maxRank: Maximum number of changed edges that are treated by
+                        the low-rank update. If more edges have changed
+                        since the last factorization, A is refactorized.
+                        Note that A0^-1 u is stored densely for every
+                        changed edge, i.e. memory grows as
+                        8 * maxRank * nVertices bytes (400 MB for the
+                        default and 10^5 vertices).
+        OUTPUT: None
+        """
+        self.maxRank = maxRank
+        isFree = ~assembler.isPBC
+        noLoop = assembler.source != assembler.target
+        self._source = assembler.source
+        self._target = assembler.target
+        self._sourceCoef = (isFree[assembler.source] & noLoop).astype(float)
+        self._targetCoef = (isFree[assembler.target] & noLoop).astype(float)
+        self._lu = None
+        self._refConductance = None
+        self._edges = np.zeros(0, dtype=np.int64)
+        self._Z = None
+        # Measured costs [s] of the last factorization, of a single solve
+        # with it and of the last low-rank correction, as well as the cost
+        # of the low-rank updates since the last factorization:
+        self._factorizationTime = 0.0
+        self._luSolveTime = 0.0
+        self._correctionTime = 0.0
+        self._updateTime = 0.0
+        self.stats = {'nFactorizations': 0, 'factorizationTime': 0.0,
+                      'nSolves': 0, 'solveTime': 0.0, 'lastRank': 0}
+
+    #--------------------------------------------------------------------------
+
+    def factorize(self, A, conductance):
+        """Computes the LU factorization of A, which becomes the reference
+        matrix of the low-rank updates.
+        INPUT: A: Matrix of the linear system in CSR format.
+               conductance: Array of the edge conductances A is based on.
+        OUTPUT: None
+        """
+        t0 = ttime.time()
+        self._lu = splu(A.tocsc())
+        self._refConductance = np.array(conductance, dtype=float)
+        self._edges = np.zeros(0, dtype=np.int64)
+        self._Z = np.zeros((A.shape[0], 0))
+        self._factorizationTime = ttime.time() - t0
+        self._correctionTime = 0.0
+        self._updateTime = 0.0
+        self.stats['nFactorizations'] += 1
+        self.stats['factorizationTime'] += self._factorizationTime
+
+    #--------------------------------------------------------------------------
+
+    def _incidence(self, edges, n):
+        """Constructs the (dense) incidence vectors of the given edges.
+        INPUT: edges: Array of edge indices.
+               n: Number of vertices.
+        OUTPUT: Matrix U of shape (n, len(edges)).
+        """
+        U = np.zeros((n, len(edges)))
+        columns = np.arange(len(edges))
+        np.add.at(U, (self._source[edges], columns), self._sourceCoef[edges])
+        np.add.at(U, (self._target[edges], columns), -self._targetCoef[edges])
+        return U
+
+    #--------------------------------------------------------------------------
+
+    def solve(self, A, b, conductance):
+        """Solves A x = b. If the number of edges whose conductance differs
+        from the reference exceeds maxRank, or if the low-rank update would
+        cost more than a new factorization, A is refactorized first.
+        INPUT: A: Matrix of the linear system in CSR format.
+               b: Vector b of the linear system.
+               conductance: Array of the edge conductances A is based on.
+        OUTPUT: x: Solution vector.
+        """
+        t0 = ttime.time()
+        conductance = np.asarray(conductance, dtype=float)
+        if self._lu is None or len(conductance) != len(self._refConductance):
+            self.factorize(A, conductance)
+        dc = conductance - self._refConductance
+        # The solves A0^-1 u of edges that changed before are reused:
+        newEdges = np.setdiff1d(np.nonzero(dc)[0], self._edges)
+        rank = len(self._edges) + len(newEdges)
+        # Estimated cost of this update, from the previous solve (the
+        # correction scales linearly with the rank):
+        updateTime = len(newEdges) * self._luSolveTime
+        if len(self._edges) > 0:
+            updateTime += self._correctionTime * rank / len(self._edges)
+        if rank > self.maxRank or \
+           self._updateTime + updateTime > self._factorizationTime:
+            self.factorize(A, conductance)
+            dc = conductance - self._refConductance
+            newEdges = np.zeros(0, dtype=np.int64)
+        t1 = ttime.time()
+        if len(newEdges) > 0:
+            Znew = self._lu.solve(self._incidence(newEdges, A.shape[0]))
+            self._edges = np.concatenate([self._edges, newEdges])
+            self._Z = np.hstack([self._Z, Znew.reshape(A.shape[0], -1)])
+
+        t2 = ttime.time()
+        y = self._lu.solve(np.asarray(b, dtype=float))
+        t3 = ttime.time()
+        self._luSolveTime = t3 - t2
+        edges = self._edges
+        if len(edges) > 0:
+            # Woodbury: x = y - Z (I + D U^T Z)^-1 D U^T y
+            Z = self._Z
+            s = self._source[edges]
+            t = self._target[edges]
+            sCoef = self._sourceCoef[edges]
+            tCoef = self._targetCoef[edges]
+            D = dc[edges]
+            UtZ = sCoef[:, None] * Z[s, :] - tCoef[:, None] * Z[t, :]
+            Uty = sCoef * y[s] - tCoef * y[t]
+            M = np.eye(len(edges)) + D[:, None] * UtZ
+            w = np.linalg.solve(M, D * Uty)
+            x = y - np.dot(Z, w)
+        else:
+            x = y
+        self._correctionTime = ttime.time() - t3
+        self._updateTime += t2 - t1 + self._correctionTime
+
+        self.stats['nSolves'] += 1
+        self.stats['solveTime'] += ttime.time() - t0
+        self.stats['lastRank'] = len(edges)
+        return x
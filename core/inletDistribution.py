@@ -0,0 +1,161 @@
+"""This module fits the log-normal distribution of the RBC spacing at the
+inflow edges of the RBC tracking simulations. The parameters mu and sigma
+only depend on the mean line density of the inflow edge, but every fit
+requires a Levenberg-Marquardt root finding with nested quadratures. The
+fitted parameters are therefore memoized, keyed by the (optionally rounded)
+line density. Optionally, the parameters are tabulated once over the
+physiological range of line densities and interpolated by cubic splines in
+logit(line density), where mu + logit(line density) and log(sigma) are
+smooth and nearly linear. Tables are shared by all instances with the same
+table parameters.
+"""
+from __future__ import division
+
+import numpy as np
+from scipy.integrate import quad
+from scipy.interpolate import CubicSpline
+from scipy.optimize import root
+
+__all__ = ['fit_inlet_lognormal', 'InletLogNormalFit']
+
+# Tables of fitted parameters, keyed by (ldMin, ldMax, nTable):
+_tables = {}
+
+#------------------------------------------------------------------------------
+
+
+def fit_inlet_lognormal(meanLD, full_output=False):
+    """Computes the parameters of the log-normal distribution of the RBC
+    spacing, such that the line density has the given mean and a standard
+    deviation of 10 percent of the mean.
+    INPUT: meanLD: Mean line density.
+           full_output: Whether or not to return the residual of the fit.
+                        (Optional, default=False.)
+    OUTPUT: mu, sigma: Parameters of the log-normal distribution.
+            residual: Maximum absolute residual of the moment equations (only
+                      if full_output is True).
+    """
+    mean_LD=meanLD
+    std_LD=0.1*mean_LD
+
+    #PDF log-normal for line density
+    f_LD = lambda z,mu,sigma: 1./((z-z**2)*np.sqrt(2*np.pi)*sigma)*np.exp(-1*(np.log(1./z-1)-mu)**2/(2*sigma**2))
+
+    #f_mean integral dummy
+    f_mean_LD_dummy = lambda z,mu,sigma: z*f_LD(z,mu,sigma)
+
+    #calculate mean
+    f_mean_LD = lambda mu,sigma: quad(f_mean_LD_dummy,0,1,args=(mu,sigma))[0]
+    f_mean_LD_Calc=np.vectorize(f_mean_LD)
+
+    #f_var integral dummy
+    f_var_LD_dummy = lambda z,mu,sigma: (z-mean_LD)**2*f_LD(z,mu,sigma)
+
+    #calculate mean
+    f_var_LD = lambda mu,sigma: quad(f_var_LD_dummy,0,1,args=(mu,sigma))[0]
+    f_var_LD_Calc=np.vectorize(f_var_LD)
+
+    #Set up system of equations
+    def f_moments_LD(m):
+        x,y=m
+        return (f_mean_LD_Calc(x,y)-mean_LD,f_var_LD_Calc(x,y)-std_LD**2)
+
+    optionsSolve={}
+    optionsSolve['xtol']=1e-20
+    if mean_LD < 0.35:
+        sol=root(f_moments_LD,(0.89,0.5),method='lm',options=optionsSolve)
+    elif mean_LD > 0.63:
+        sol=root(f_moments_LD,(-0.6,0.45),method='lm',options=optionsSolve)
+    else:
+        sol=root(f_moments_LD,(mean_LD,std_LD),method='lm',options=optionsSolve)
+    mu=sol['x'][0]
+    sigma=sol['x'][1]
+
+    if full_output:
+        return mu, sigma, np.max(np.abs(sol['fun']))
+    return mu,sigma
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class InletLogNormalFit(object):
+    """Memoized (and optionally tabulated) version of fit_inlet_lognormal.
+    """
+    def __init__(self, decimals=None, table=False, tableRange=(0.02, 0.95),
+                 nTable=33, tolerance=1e-10):
+        """Initializes an InletLogNormalFit instance.
+        INPUT: decimals: Number of decimals the line density is rounded to
+                         before the lookup (and the fit). (Optional,
+                         default=None, i.e. no rounding and the results are
+                         identical to those of fit_inlet_lognormal.)
+               table: Whether or not to interpolate the parameters from a
+                      table. Line densities outside of the table range are
+                      fitted (and memoized). (Optional, default=False.)
+               tableRange: Tuple (ldMin, ldMax) of the tabulated range of
+                           line densities.
+               nTable: Number of table entries, equidistant in
+                       logit(line density). With the default values, the
+                       interpolation error is about 1e-4 in mu and 1e-5
+                       (relative) in sigma.
+               tolerance: Table entries whose fit has a larger residual are
+                          discarded, i.e. bridged by the interpolation.
+        OUTPUT: None
+        """
+        self._decimals = decimals
+        self._memo = {}
+        self.stats = {'nFitted': 0, 'nMemoized': 0, 'nInterpolated': 0}
+        self._table = None
+        if table:
+            key = (float(tableRange[0]), float(tableRange[1]), int(nTable))
+            if not _tables.has_key(key):
+                _tables[key] = self._tabulate(key[0], key[1], key[2],
+                                              tolerance)
+            self._table = _tables[key]
+            self._ldMin, self._ldMax = key[0], key[1]
+
+    #--------------------------------------------------------------------------
+
+    def _tabulate(self, ldMin, ldMax, nTable, tolerance):
+        """Fits the parameters at the table entries and sets up the
+        interpolating splines.
+        INPUT: ldMin, ldMax: Tabulated range of line densities.
+               nTable: Number of table entries.
+               tolerance: Maximum residual of the fit of a table entry.
+        OUTPUT: Splines of mu + logit(LD) and log(sigma) over logit(LD).
+        """
+        u = np.linspace(np.log(ldMin / (1. - ldMin)),
+                        np.log(ldMax / (1. - ldMax)), nTable)
+        ld = 1. / (1. + np.exp(-u))
+        ld[0], ld[-1] = ldMin, ldMax
+        valid, mus, logSigmas = [], [], []
+        for i in xrange(nTable):
+            mu, sigma, residual = fit_inlet_lognormal(ld[i], full_output=True)
+            if residual <= tolerance and sigma > 0:
+                valid.append(i)
+                mus.append(mu + u[i])
+                logSigmas.append(np.log(sigma))
+        self.stats['nFitted'] += nTable
+        return CubicSpline(u[valid], mus), CubicSpline(u[valid], logSigmas)
+
+    #--------------------------------------------------------------------------
+
+    def parameters(self, meanLD):
+        """Returns the parameters of the log-normal distribution of the RBC
+        spacing for the given mean line density.
+        INPUT: meanLD: Mean line density.
+        OUTPUT: mu, sigma: Parameters of the log-normal distribution.
+        """
+        if self._table is not None and self._ldMin <= meanLD <= self._ldMax:
+            u = np.log(meanLD / (1. - meanLD))
+            self.stats['nInterpolated'] += 1
+            return float(self._table[0](u)) - u, \
+                   float(np.exp(self._table[1](u)))
+        if self._decimals is not None:
+            meanLD = round(meanLD, self._decimals)
+        if self._memo.has_key(meanLD):
+            self.stats['nMemoized'] += 1
+        else:
+            self._memo[meanLD] = fit_inlet_lognormal(meanLD)
+            self.stats['nFitted'] += 1
+        return self._memo[meanLD]
@@ -8,6 +8,7 @@ from scipy import finfo, ones, zeros
 from scipy.sparse import lil_matrix, linalg, coo_matrix
 from scipy.sparse.linalg import gmres
 from physiology import Physiology
+from rheologyCache import RheologyCache
 import units
 import g_output
 import vascularGraph
@@ -78,6 +79,9 @@ class LinearSystem(object):
             if len(httNone) > 0:
                 G.es[httNone]['htt']=[self._withRBC]*len(httNone)
 
+        if self._withRBC:
+            self._rheology = RheologyCache(self._P, self._invivo)
+
         self.update(G)
         self._eps = np.finfo(float).eps
         
@@ -102,8 +106,6 @@ class LinearSystem(object):
                 b: Vector b of the linear system, holding the boundary 
                    conditions.
         """
-        htt2htd = self._P.tube_to_discharge_hematocrit
-        nurel = self._P.relative_apparent_blood_viscosity
         if newGraph is not None:
             self._G = newGraph
             
@@ -128,9 +130,13 @@ class LinearSystem(object):
 
         #if with RBCs compute effective resistance
         if self._withRBC:
-            dischargeHt = [min(htt2htd(e, d, self._invivo), 1.0) for e,d in zip(G.es['htt'],G.es['diameter'])]
-            G.es['effResistance'] =[ res * nurel(max(4.0,d),min(dHt,0.6),self._invivo) for res,dHt,d in zip(G.es['resistance'], \
-                dischargeHt,G.es['diameter'])]
+            edges = np.arange(G.ecount())
+            diameter = np.array(G.es['diameter'], dtype=float)
+            dischargeHt = np.minimum(self._rheology.tube_to_discharge_hematocrit(
+                edges, G.es['htt'], diameter), 1.0)
+            nurel = self._rheology.relative_apparent_blood_viscosity(
+                edges, np.maximum(4.0, diameter), np.minimum(dischargeHt, 0.6))
+            G.es['effResistance'] = (np.array(G.es['resistance']) * nurel).tolist()
             G.es['conductance']=1/np.array(G.es['effResistance'])
         else: 
 	    # Compute conductance
@@ -188,10 +194,12 @@ class LinearSystem(object):
         """Solves the linear system A x = b for the vector of unknown pressures
         x, either using a direct solver or an iterative AMG solver. From the
         pressures, the flow field is computed.
-        INPUT: method: This can be either 'direct' or 'iterative'
+        INPUT: method: This can be either 'direct', 'iterative' or
+                       'iterative2'
                **kwargs 
-               precision: The accuracy to which the ls is to be solved. If not 
-                          supplied, machine accuracy will be used.
+               precision: The relative residual norm(b - A x) / norm(b) to
+                          which the ls is to be solved. If not supplied,
+                          1e4 times the machine accuracy will be used.
                maxiter: The maximum number of iterations. The default value for
                         the iterative solver is 250.
         OUTPUT: None - G is modified in place.
@@ -202,27 +210,35 @@ class LinearSystem(object):
         htt2htd = self._P.tube_to_discharge_hematocrit
         
         A = self._A.tocsr()
+        if kwargs.has_key('precision'):
+            eps = kwargs['precision']
+        else:
+            eps = self._eps * 1e4
+        # The iterative solvers are warm started from the pressures of a
+        # previous solution (stored in mmHg), if available:
+        x0 = None
+        if 'pressure' in G.vs.attribute_names() and \
+           None not in G.vs['pressure'] and \
+           len(G.vs['pressure']) == len(b):
+            x0 = np.array(G.vs['pressure'], dtype=float) * \
+                 vgm.units.scaling_factor_du('mmHg',G['defaultUnits'])
         if method == 'direct':
             linalg.use_solver(useUmfpack=True)
             x = linalg.spsolve(A, b)
         elif method == 'iterative':
-            if kwargs.has_key('precision'):
-                eps = kwargs['precision']
-            else:
-                eps = self._eps
             if kwargs.has_key('maxiter'):
                 maxiter = kwargs['maxiter']
             else:
                 maxiter = 250
             AA = pyamg.smoothed_aggregation_solver(A, max_levels=10, max_coarse=500)
-            x = abs(AA.solve(self._b, x0=None, tol=eps, accel='cg', cycle='V', maxiter=maxiter))
+            x = abs(AA.solve(self._b, x0=x0, tol=eps, accel='cg', cycle='V', maxiter=maxiter))
             # abs required, as (small) negative pressures may arise
         elif method == 'iterative2':
          # Set linear solver
              ml = rootnode_solver(A, smooth=('energy', {'degree':2}), strength='evolution' )
              M = ml.aspreconditioner(cycle='V')
              # Solve pressure system
-             x,info = gmres(A, self._b, tol=self._eps, maxiter=50, M=M)
+             x,info = gmres(A, self._b, x0=x0, tol=eps, maxiter=50, M=M)
              if info != 0:
                  print('ERROR in Solving the Matrix')
 
@@ -14,14 +14,29 @@ from __future__ import division
 
 import numpy as np
 from sys import stdout
+import os
+import cPickle
 
 from pyamg import smoothed_aggregation_solver, rootnode_solver, util
 import pyamg
 import scipy as sp
 from scipy import finfo, ones, zeros
-from scipy.sparse import lil_matrix, linalg
-from scipy.integrate import quad
-from scipy.optimize import root
+from scipy.sparse import linalg
+from csrAssembly import CSRAssembler
+from amgSolver import AMGSolver
+from incrementalSolver import IncrementalSolver
+from rbcStore import RBCStore
+from rbcPlacement import place_rbcs
+from apportionment import apportion_rbcs
+from vertexClassifier import VertexClassifier
+from rheologyCache import RheologyCache
+from inletDistribution import InletLogNormalFit
+from simulationState import SimulationState
+from runningSampler import RunningSampler
+from timeSeriesStore import TimeSeriesWriter
+from asyncWriter import AsyncWriter
+from checkpoint import graph_hash, write_checkpoint, read_checkpoint, \
+                       optional_to_array, array_to_optional
 from physiology import Physiology
 from scipy.sparse.linalg import gmres
 import units
@@ -45,6 +60,19 @@ class LinearSystemHtdTotFixedDT(object):
     It is differentiated between capillaries and larger vessels. At larger Vessels 
     the RBCs are distributed based on the phase separation law. 
     """
+    # Edge properties that are sampled (in addition to the pressure):
+    _sampledEdgeProps = ['flow', 'v', 'htt', 'htd', 'nRBC', 'effResistance']
+    # Mutable edge and vertex properties that are stored in checkpoints (in
+    # addition to the RBC positions and the SimulationState), properties
+    # that may be None and sequence valued properties with their length:
+    _checkpointEdgeProps = ['httBC', 'httBC_init', 'posFirst_last', 'v_last',
+                            'noFlow']
+    _checkpointVertexProps = ['vType', 'av', 'vv']
+    _checkpointSequenceProps = {'keep_rbcs': 1, 'logNormal': 2}
+    _checkpointIntProps = ['noFlow', 'vType', 'av', 'vv']
+    _checkpointGraphProps = ['dtFinal', 'iterFinalSample', 'BackUpCounter',
+                             'averagedCount']
+
     #@profile
     def __init__(self, G, invivo=True,dThreshold=10.0,init=True,**kwargs):
         """Initializes a LinearSystemHtd instance.
@@ -65,6 +93,69 @@ class LinearSystemHtdTotFixedDT(object):
                innerDiam: boolean if inner or outer diamter of vessels is given in the graph 
                    (innerDiam = 1 --> inner diameter given) (Default = 0)
                species: 'rat', 'mouse' or 'human', default is 'rat'
+               amgRebuildIterations: The AMG hierarchy of the 'iterative2'
+                   solver is reused between timesteps and only rebuilt if the
+                   previous solve needed more GMRES iterations than this
+                   (Default = 20)
+               amgRebuildDrift: The AMG hierarchy is also rebuilt if an entry
+                   of A changed by more than this fraction since the last
+                   setup (Default = 0.1)
+               incrementalMaxRank: Maximum number of edges with changed
+                   conductance that the 'incremental' solver handles by a
+                   low-rank update before A is refactorized. A is also
+                   refactorized earlier, once the update costs more than
+                   the factorization. Memory grows as 8 * nVertices *
+                   incrementalMaxRank bytes (Default = 500)
+               httTolerance: The effective resistance of an edge is only
+                   updated if its tube hematocrit differs by more than this
+                   from the value the resistance was last computed with
+                   (Default = 0.0, i.e. exact)
+               inletFitPrms: Dictionary of keyword arguments of the
+                   InletLogNormalFit, which memoizes the log-normal
+                   parameters of the RBC spacing at inflow edges, e.g.
+                   decimals (rounding of the line density) and table
+                   (interpolation from a precomputed table)
+                   (Default = {}, i.e. exact)
+               rbcSeed: Seed of the counter-based random stream from which
+                   the initial RBC positions are drawn. The positions are
+                   reproducible and do not depend on the global NumPy
+                   random state (Default = None, i.e. np.random)
+               sampleBufferSize: Number of raw snapshots that are kept in
+                   the sample database between two backups. The averages
+                   are accumulated as running means, independent of this
+                   value (Default = None, i.e. all snapshots are kept)
+               sampleStore: Directory of a chunked, compressed time series
+                   store (see timeSeriesStore), to which every sample is
+                   written. Alternatively, a dictionary of keyword arguments
+                   of the TimeSeriesWriter, including 'path' (e.g. dtype,
+                   chunkTime). The store is overwritten if init is True and
+                   appended to otherwise (after discarding the samples
+                   taken after G['iterFinalSample'], i.e. after the backup
+                   the simulation is restarted from). If provided,
+                   SampleDetailed writes to the store instead of pickling G
+                   in every timestep. Combine with sampleBufferSize = 0 to
+                   keep no sample history in memory (Default = None)
+               backupFormat: Format of the backups written by evolve. Either
+                   'pkl' (G is pickled) or 'checkpoint' (only the mutable
+                   simulation state is written as binary arrays, see
+                   checkpoint; the static graph is pickled once and
+                   referenced by its content hash) (Default = 'pkl')
+               checkpoint: Name of a checkpoint file written by evolve (with
+                   backupFormat 'checkpoint'), from which the simulation
+                   state is restored. Requires init = False and a graph G
+                   with the same topology, diameters and lengths (e.g. the
+                   static graph written along with the checkpoints)
+                   (Default = None)
+               asyncWrite: Whether or not backups and samples are written to
+                   disk in a background thread (see asyncWriter), while the
+                   simulation continues. Snapshots are pickled (copied) in
+                   the simulation thread, only the file I/O is deferred.
+                   Errors of the background writes are raised in the next
+                   timestep. The writer thread is stopped at the end of
+                   evolve (Default = False)
+               writeQueueSize: Maximum number of pending background writes.
+                   If the storage falls behind, the simulation waits
+                   (Default = 2)
         OUTPUT: None, however the following items are created:
                 self.A: Matrix A of the linear system, holding the conductance
                         information.
@@ -77,7 +168,6 @@ class LinearSystemHtdTotFixedDT(object):
         self._invivo=invivo
         self._b = zeros(G.vcount())
         self._x = zeros(G.vcount())
-        self._A = lil_matrix((G.vcount(),G.vcount()),dtype=float)
         self._eps = finfo(float).eps * 1e4
         #TODO those two are changed in evolve. depending if it is restarted or not. it would be more correct to do this here
         self._tPlot = 0.0
@@ -88,22 +178,49 @@ class LinearSystemHtdTotFixedDT(object):
         self._sampledict = {} 
 	self._init=init
         self._scaleToDef=vgm.units.scaling_factor_du('mmHg',G['defaultUnits'])
+        if kwargs.has_key('backupFormat'):
+            self._backupFormat = kwargs['backupFormat']
+        else:
+            self._backupFormat = 'pkl'
+        if self._backupFormat not in ['pkl', 'checkpoint']:
+            raise ValueError('Unknown backupFormat %s' % self._backupFormat)
+        self._staticGraphs = set()
+        if kwargs.has_key('asyncWrite') and kwargs['asyncWrite']:
+            if kwargs.has_key('writeQueueSize'):
+                self._asyncWriter = AsyncWriter(kwargs['writeQueueSize'])
+            else:
+                self._asyncWriter = AsyncWriter()
+        else:
+            self._asyncWriter = None
+        # Restore the simulation state of a checkpoint (the state of the
+        # random number generator is restored at the end of __init__):
+        if kwargs.has_key('checkpoint') and kwargs['checkpoint'] is not None:
+            if init:
+                raise ValueError('A checkpoint can only be restored with init=False')
+            rngState = self._restore_checkpoint(kwargs['checkpoint'])
+        else:
+            rngState = None
         self._vertexUpdate=None
         self._edgeUpdate=None
-        G.es['source']=[e.source for e in G.es]
-        G.es['target']=[e.target for e in G.es]
+        self._sortedEdges=None
+        self._sortDescents=0
+        edgelist = G.get_edgelist()
+        G.es['source']=[s for s, t in edgelist]
+        G.es['target']=[t for s, t in edgelist]
         G.es['countRBCs']=[0]*G.ecount()
         G.es['crosssection']=np.array([0.25*np.pi]*G.ecount())*np.array(G.es['diameter'])**2
-        G.es['volume']=[e['crosssection']*e['length'] for e in G.es]
-        adjacent=[]
-        for i in xrange(G.vcount()):
-            adjacent.append(G.adjacent(i))
-        G.vs['adjacent']=adjacent
+        # Contiguous copies of the (fixed) edge properties required by the
+        # hematocrit update:
+        self._diameter = np.array(G.es['diameter'], dtype=float)
+        self._crosssection = np.array(G.es['crosssection'], dtype=float)
+        self._length = np.array(G.es['length'], dtype=float)
+        self._volume = self._crosssection * self._length
+        G.es['volume']=self._volume.tolist()
+        G.vs['adjacent']=G.get_inclist()
         G['av']=G.vs(av_eq=1).indices
         G['vv']=G.vs(vv_eq=1).indices
 
         htd2htt=self._P.discharge_to_tube_hematocrit
-        htt2htd = self._P.tube_to_discharge_hematocrit
 
         if kwargs.has_key('species'):
             self._species = kwargs['species']
@@ -123,11 +240,62 @@ class LinearSystemHtdTotFixedDT(object):
         else:
             self._innerDiam = 0
 
+        if kwargs.has_key('amgRebuildIterations'):
+            amgRebuildIterations = kwargs['amgRebuildIterations']
+        else:
+            amgRebuildIterations = 20
+
+        if kwargs.has_key('amgRebuildDrift'):
+            amgRebuildDrift = kwargs['amgRebuildDrift']
+        else:
+            amgRebuildDrift = 0.1
+        self._amgSolver = AMGSolver(amgRebuildIterations, amgRebuildDrift)
+
+        # Diameter dependent terms of the rheology functions are computed
+        # once per edge:
+        self._rheology = RheologyCache(self._P, invivo)
+
+        # The log-normal parameters of the RBC spacing at inflow edges are
+        # fitted once per line density:
+        if kwargs.has_key('inletFitPrms'):
+            inletFitPrms = kwargs['inletFitPrms']
+        else:
+            inletFitPrms = {}
+        self._inletFit = InletLogNormalFit(**inletFitPrms)
+
+        if kwargs.has_key('rbcSeed'):
+            self._rbcSeed = kwargs['rbcSeed']
+        else:
+            self._rbcSeed = None
+
         # Assure that both pBC and rBC edge properties are present:
         for key in ['pBC', 'rBC']:
             if not G.vs[0].attributes().has_key(key):
                 G.vs[0][key] = None
 
+        # The sparsity pattern of the LS and the mapping of the edge
+        # conductances into A and b are computed once:
+        self._assembler = CSRAssembler(G)
+        self._A = self._assembler.A
+        self._b = self._assembler.b
+        self._conductance = zeros(G.ecount())
+        # Tube hematocrit of every edge at its last resistance update:
+        self._httResistance = np.nan * ones(G.ecount())
+        if kwargs.has_key('httTolerance'):
+            self._httTolerance = kwargs['httTolerance']
+        else:
+            self._httTolerance = 0.0
+        # The vertex-edge incidence used to classify the vertices by their
+        # in- and outflow edges:
+        self._vertexClassifier = VertexClassifier(G)
+
+        if kwargs.has_key('incrementalMaxRank'):
+            incrementalMaxRank = kwargs['incrementalMaxRank']
+        else:
+            incrementalMaxRank = 500
+        self._incrementalSolver = IncrementalSolver(self._assembler,
+                                                    incrementalMaxRank)
+
         if self._analyzeBifEvents:
             self._rbcsMovedPerEdge=[]
             self._edgesWithMovedRBCs=[]
@@ -153,40 +321,40 @@ class LinearSystemHtdTotFixedDT(object):
            else:
                self._sampledict['averagedCount']=G['averagedCount']
 
-        #Calculate total network Volume
-        G['V']=0
-        for e in G.es:
-            G['V']=G['V']+e['crosssection']*e['length']
+        #Calculate total network Volume (summed in edge order)
+        G['V']=np.add.accumulate(self._volume)[-1] if G.ecount() > 0 else 0
         print('Total network volume calculated')
 
-        # Compute the edge-specific minimal RBC distance:
+        # Compute the edge-specific minimal RBC distance and the maximum
+        # number of RBCs per edge (np.power is used instead of **, which
+        # squares arrays by multiplication and may differ in the last bit):
         vrbc = self._P.rbc_volume(self._species)
         if self._innerDiam:
-            G.es['minDist'] = [vrbc / (np.pi * e['diameter']**2 / 4) for e in G.es]
+            self._minDist = vrbc / (np.pi * np.power(self._diameter, 2.0) / 4)
         else:
             eslThickness = self._P.esl_thickness
-            G.es['minDist'] = [vrbc / (np.pi * (d-2*eslThickness(d))**2 / 4) for d in G.es['diameter']]
-        G.es['nMax'] = [np.floor(e['length']/ e['minDist']) for e in G.es] 
+            self._minDist = vrbc / (np.pi * np.power(self._diameter - 2 *
+                self._P.esl_thickness_array(self._diameter), 2.0) / 4)
+        self._nMax = np.floor(self._length / self._minDist)
+        G.es['minDist'] = self._minDist.tolist()
+        G.es['nMax'] = self._nMax.tolist()
 
-        # Assign capillaries and non capillary vertices
+        # Assign capillaries and non capillary vertices: either all adjacent
+        # edges are capillaries (isCap), none are, or some are (interface
+        # vertex)
         print('Start assign capillary and non capillary vertices')
-        adjacent=[np.array(G.incident(i)) for i in G.vs]
-        G.vs['isCap']=[False]*G.vcount()
-        self._interfaceVertices=[]
-        for i in xrange(G.vcount()):
-            category=[]
-            for j in adjacent[i]:
-                if G.es[int(j)]['diameter'] < dThreshold:
-                    category.append(1)
-                else:
-                    category.append(0)
-            if category.count(1) == len(category):
-                G.vs[i]['isCap']=True
-            elif category.count(0) == len(category):
-                G.vs[i]['isCap']=False
-            else:
-                self._interfaceVertices.append(i)
+        degree = np.array(G.degree(), dtype=np.int64)
+        slotVertex = np.repeat(np.arange(G.vcount()), degree)
+        slotEdge = np.array([ei for a in G.vs['adjacent'] for ei in a],
+                            dtype=np.int64)
+        nCapEdges = np.bincount(slotVertex[self._diameter[slotEdge] < dThreshold],
+                                minlength=G.vcount())
+        G.vs['isCap']=(nCapEdges == degree).tolist()
+        self._interfaceVertices=np.nonzero((nCapEdges > 0) &
+                                           (nCapEdges < degree))[0].tolist()
         print('End assign capillary and non capillary vertices')
+        self._isInterfaceVertex=np.zeros(G.vcount(),dtype=bool)
+        self._isInterfaceVertex[self._interfaceVertices]=True
 
         # Arterial-side inflow:
         if init:
@@ -212,17 +380,40 @@ class LinearSystemHtdTotFixedDT(object):
                 print('ERROR no inital tube hematocrit given for distribution of RBCs')
             else:
                 ht0=kwargs['ht0']
-            for e in G.es:
-                lrbc = e['minDist']
-                Nmax = max(int(np.floor(e['nMax'])), 1)
-                if e['httBC'] is not None:
-                    N = int(np.round(e['httBC'] * Nmax))
-                else:
-                    N = int(np.round(ht0 * Nmax))
-                indices = sorted(np.random.permutation(Nmax)[:N])
-                e['rRBC'] = np.array(indices) * lrbc + lrbc / 2.0
+            packed = self._initial_rbc_positions(ht0)
+        else:
+            packed = None
+        # All RBC positions are kept in one contiguous buffer, G.es['rRBC']
+        # holds views into this buffer:
+        self._rbcStore = RBCStore(G, G.es['nMax'], packed=packed)
         print('Initial nRBC computed')    
-        G.es['nRBC']=[len(e['rRBC']) for e in G.es]
+        G.es['nRBC'] = self._rbcStore.count.tolist()
+        # Pressure, flow, velocity, flow sign and hematocrit are held as
+        # arrays during the simulation and are only written to G at
+        # sampling and backup time:
+        self._state = SimulationState(G)
+        # Running means and variances of the sampled properties:
+        if kwargs.has_key('sampleBufferSize'):
+            sampleBufferSize = kwargs['sampleBufferSize']
+        else:
+            sampleBufferSize = None
+        sizes = dict([(eprop, G.ecount()) for eprop in self._sampledEdgeProps])
+        sizes['pressure'] = G.vcount()
+        self._sampler = RunningSampler(sizes, sampleBufferSize)
+        if kwargs.has_key('sampleStore') and kwargs['sampleStore'] is not None:
+            if isinstance(kwargs['sampleStore'], dict):
+                storePrms = dict(kwargs['sampleStore'])
+            else:
+                storePrms = {'path': kwargs['sampleStore']}
+            storePrms['mode'] = 'w' if init else 'a'
+            if not init and 'iterFinalSample' in G.attributes():
+                # Samples written after the backup G is restarted from are
+                # discarded:
+                storePrms['restartTime'] = G['iterFinalSample']
+            storePrms['asyncWriter'] = self._asyncWriter
+            self._sampleWriter = TimeSeriesWriter(sizes=sizes, **storePrms)
+        else:
+            self._sampleWriter = None
 
         if kwargs.has_key('plasmaViscosity'):
             self._muPlasma = kwargs['plasmaViscosity']
@@ -234,9 +425,7 @@ class LinearSystemHtdTotFixedDT(object):
         print('Resistance updated')
 
         # Compute the current tube hematocrit from the RBC positions:
-        for e in G.es:
-            e['htt']=min(len(e['rRBC'])*vrbc/e['volume'],1)
-            e['htd']=min(htt2htd(e['htt'], e['diameter'], invivo), 1.0)
+        self._update_hematocrit()
         print('Initial htt and htd computed')        
 
         # This initializes the full LS. Later, only relevant parts of
@@ -244,18 +433,17 @@ class LinearSystemHtdTotFixedDT(object):
         # removed from no-flow edges to avoid wasting computational
         # time on non-functional vascular branches / fragments:
         #Convert 'pBC' ['mmHG'] to default Units
-        for v in G.vs:
-            if v['pBC'] != None:
-                v['pBC']=v['pBC']*self._scaleToDef
+        pBCVertices = G.vs(pBC_ne=None).indices
+        pBC = np.array(G.vs[pBCVertices]['pBC'], dtype=float)
+        G.vs[pBCVertices]['pBC'] = (pBC*self._scaleToDef).tolist()
         self._update_eff_resistance_and_LS(None)
         print('Matrix created')
         self._solve('iterative2')
         print('Matrix solved')
-        self._G.vs['pressure'] = self._x[:]
+        self._state.pressure[:] = self._x
         #Convert deaultUnits to 'pBC' ['mmHG']
-        for v in G.vs:
-            if v['pBC'] != None:
-                v['pBC']=v['pBC']/self._scaleToDef
+        pBC = np.array(G.vs[pBCVertices]['pBC'], dtype=float)
+        G.vs[pBCVertices]['pBC'] = (pBC/self._scaleToDef).tolist()
         self._update_flow_and_velocity()
         print('Flow updated')
         self._verify_mass_balance()
@@ -270,14 +458,16 @@ class LinearSystemHtdTotFixedDT(object):
             print('Update logNormal')
             print(len(httBCInit_edges))
             print(G.ecount())
+            sign = self._state.sign
+            rRBC = G.es['rRBC']
             for i in httBCInit_edges:
-                if len(G.es[i]['rRBC']) > 0:
-                    if G.es['sign'][i] == 1:
-                        G.es[i]['posFirst_last']=G.es['rRBC'][i][0]
+                if len(rRBC[i]) > 0:
+                    if sign[i] == 1:
+                        G.es[i]['posFirst_last']=rRBC[i][0]
                     else:
-                        G.es[i]['posFirst_last']=G.es['length'][i]-G.es['rRBC'][i][-1]
+                        G.es[i]['posFirst_last']=self._length[i]-rRBC[i][-1]
                 else:
-                    G.es[i]['posFirst_last']=G.es['length'][i]
+                    G.es[i]['posFirst_last']=self._length[i]
                 G.es[i]['v_last']=0
                 httBCValue=G.es[i]['httBC_init']
                 if self._innerDiam:
@@ -290,71 +480,55 @@ class LinearSystemHtdTotFixedDT(object):
         print('Initiallize posFirst_last')
         if 'signOld' in G.es.attribute_names():
             del(G.es['signOld'])
+        self._state.signOld[:] = np.nan
         self._update_out_and_inflows_for_vertices()
         print('updated out and inflows')
 
         #Calculate an estimated network turnover time (based on conditions at the beginning)
         flowsum=0
 
+        flow = G.es['flow']
 	for vi in G['av']:
             for ei in G.adjacent(vi):
-                flowsum=flowsum+G.es['flow'][ei]
+                flowsum=flowsum+flow[ei]
         G['flowSumIn']=flowsum
         G['Ttau']=G['V']/flowsum
         print(flowsum)
         print(G['V'])
         print(self._eps)
         stdout.write("\rEstimated network turnover time Ttau=%f        \n" % G['Ttau'])
+        self._state.store_to_graph(G)
+        if rngState is not None:
+            np.random.set_state(rngState)
 
     #--------------------------------------------------------------------------
-    def _compute_mu_sigma_inlet_RBC_distribution(self, httBC):
-        """Updates the nominal and specific resistance of a given edge 
-        sequence.
-        INPUT: es: Sequence of edge indices as tuple. If not provided, all 
-                   edges are updated.
-        OUTPUT: None, the edge properties 'resistance' and 'specificResistance'
-                are updated (or created).
-        """
-        mean_LD=httBC
-        std_LD=0.1*mean_LD
-        
-        #PDF log-normal
-        f_x = lambda x,mu,sigma: 1./(x*np.sqrt(2*np.pi)*sigma)*np.exp(-1*(np.log(x)-mu)**2/(2*sigma**2))
-        
-        #PDF log-normal for line density
-        f_LD = lambda z,mu,sigma: 1./((z-z**2)*np.sqrt(2*np.pi)*sigma)*np.exp(-1*(np.log(1./z-1)-mu)**2/(2*sigma**2))
-        
-        #f_mean integral dummy
-        f_mean_LD_dummy = lambda z,mu,sigma: z*f_LD(z,mu,sigma)
-        
-        #calculate mean
-        f_mean_LD = lambda mu,sigma: quad(f_mean_LD_dummy,0,1,args=(mu,sigma))[0]
-        f_mean_LD_Calc=np.vectorize(f_mean_LD)
-        
-        #f_var integral dummy
-        f_var_LD_dummy = lambda z,mu,sigma: (z-mean_LD)**2*f_LD(z,mu,sigma)
-        
-        #calculate mean
-        f_var_LD = lambda mu,sigma: quad(f_var_LD_dummy,0,1,args=(mu,sigma))[0]
-        f_var_LD_Calc=np.vectorize(f_var_LD)
-        
-        #Set up system of equations
-        def f_moments_LD(m):
-            x,y=m
-            return (f_mean_LD_Calc(x,y)-mean_LD,f_var_LD_Calc(x,y)-std_LD**2)
 
-        optionsSolve={}
-        optionsSolve['xtol']=1e-20
-        if mean_LD < 0.35:
-            sol=root(f_moments_LD,(0.89,0.5),method='lm',options=optionsSolve)
-        elif mean_LD > 0.63:
-            sol=root(f_moments_LD,(-0.6,0.45),method='lm',options=optionsSolve)
-        else:
-            sol=root(f_moments_LD,(mean_LD,std_LD),method='lm',options=optionsSolve)
-        mu=sol['x'][0]
-        sigma=sol['x'][1]
+    def _initial_rbc_positions(self, ht0):
+        """Places the initial RBCs of all edges. Every edge is divided into
+        nMax slots of length minDist, of which round(htt * nMax) are occupied
+        by an RBC at random (htt is the hematocrit boundary condition httBC
+        of the edge, if present, and ht0 otherwise). The RBCs are located at
+        the centers of the slots (see rbcPlacement).
+        INPUT: ht0: Initial tube hematocrit of the edges without httBC.
+        OUTPUT: positions: Array of the RBC positions of all edges, ordered
+                           by edge.
+                count: Array of the number of RBCs per edge.
+        """
+        G = self._G
+        nSlots = np.maximum(self._nMax, 1).astype(np.int64)
+        httBC = G.es['httBC']
+        htt = np.array([ht0 if h is None else h for h in httBC], dtype=float)
+        nRBC = np.round(htt * nSlots).astype(np.int64)
+        return place_rbcs(nSlots, nRBC, self._minDist, self._rbcSeed)
 
-        return mu,sigma
+    #--------------------------------------------------------------------------
+    def _compute_mu_sigma_inlet_RBC_distribution(self, httBC):
+        """Computes the parameters of the log-normal distribution of the RBC
+        spacing at an inflow edge (see inletDistribution).
+        INPUT: httBC: Mean line density at the inflow edge.
+        OUTPUT: mu, sigma: Parameters of the log-normal distribution.
+        """
+        return self._inletFit.parameters(httBC)
 
     #--------------------------------------------------------------------------
 
@@ -385,25 +559,42 @@ class LinearSystemHtdTotFixedDT(object):
     #--------------------------------------------------------------------------
 
     def _update_hematocrit(self, esequence=None):
-        """Updates the tube hematocrit of a given edge sequence.
-        INPUT: es: Sequence of edge indices as tuple. If not provided, all 
-                   edges are updated. (WARNING: list should only contain int no np.int)
-        OUTPUT: None, the edge property 'htt' is updated (or created).
+        """Updates the tube and discharge hematocrit of a given edge
+        sequence. The number of RBCs is taken from the RBC store, volume and
+        diameter from the cached edge arrays.
+        INPUT: esequence: Sequence of edge indices. If not provided, all
+                          edges are updated.
+        OUTPUT: htt: Array of the updated tube hematocrits of the edges.
+                htd: Array of the updated discharge hematocrits of the edges.
+                changed: Array of the edges whose tube hematocrit differs by
+                         more than self._httTolerance from the value their
+                         effective resistance was computed with.
+                The edge properties 'htt' and 'htd' are updated (or created).
         """
         G = self._G
-        htt2htd = self._P.tube_to_discharge_hematocrit
-        invivo=self._invivo
+        htt2htd = self._rheology.tube_to_discharge_hematocrit
         vrbc = self._P.rbc_volume(self._species)
 
         if esequence is None:
-            es = G.es
+            edges = np.arange(G.ecount())
         else:
-            es = G.es(esequence)
+            edges = np.asarray(esequence, dtype=np.int64)
 
-        es['htt'] = [min(e['nRBC'] * vrbc / e['volume'],1) for e in es]
-        es['htd']= [min(htt2htd(e['htt'], e['diameter'], invivo), 1.0) for e in es]
+        htt = np.minimum(self._rbcStore.count[edges] * vrbc /
+                         self._volume[edges], 1)
+        htd = np.minimum(htt2htd(edges, htt, self._diameter[edges]), 1.0)
+        self._state.htt[edges] = htt
+        self._state.htd[edges] = htd
+        edgeList = edges.tolist()
+        G.es[edgeList]['htt'] = htt.tolist()
+        G.es[edgeList]['htd'] = htd.tolist()
+        # Edges without a resistance yet (nan) are always reported:
+        httResistance = self._httResistance[edges]
+        httResistance[np.isnan(httResistance)] = np.inf
+        changed = edges[np.abs(htt - httResistance) > self._httTolerance]
 
 	self._G=G
+        return htt, htd, changed
 
     #--------------------------------------------------------------------------
 
@@ -428,11 +619,13 @@ class LinearSystemHtdTotFixedDT(object):
         G = self._G
         dThreshold = self._dThreshold
 
+        pressure = self._state.pressure
+
         for v in self._interfaceVerticesI:
-            p = G.vs[v]['pressure']
+            p = pressure[v]
             G.vs[v]['isCap'] = True
             for n in self._interfaceNoncapNeighborsVI[v]:
-                if G.vs[n]['pressure'] > p:
+                if pressure[n] > p:
                     G.vs[v]['isCap'] = False
                     break
 
@@ -447,16 +640,26 @@ class LinearSystemHtdTotFixedDT(object):
                 one of [-1, 0, 1])
         """
         G = self._G
-        if 'sign' in G.es.attributes() and None not in G.es['sign']:
-            G.es['signOld']=G.es['sign']
-        G.es['sign'] = [np.sign(G.vs[source]['pressure'] -
-                                G.vs[target]['pressure']) for source,target in zip(G.es['source'],G.es['target'])]
+        state = self._state
+        if not np.any(np.isnan(state.sign)):
+            state.signOld[:] = state.sign
+        state.sign[:] = np.sign(state.pressure[state.source] -
+                                state.pressure[state.target])
+        # The RBC propagation reads the sign per edge, only the edges whose
+        # sign has changed are written to G:
+        if np.any(np.isnan(state.signOld)) or 'sign' not in G.es.attributes():
+            state.store_to_graph(G, ['sign'])
+        else:
+            state.store_to_graph(G, ['sign'],
+                                 np.nonzero(state.sign != state.signOld)[0])
 
     #-------------------------------------------------------------------------
     #@profile
     def _update_out_and_inflows_for_vertices(self):
         """Calculates the in- and outflow edges for vertices at the beginning.
-        Afterwards in every single timestep it is check if something changed
+        Afterwards in every single timestep it is checked if something changed.
+        Only the vertices adjacent to edges whose flow sign changed are
+        reclassified (see VertexClassifier).
         INPUT: None 
         OUTPUT: None, however the following parameters will be updated:
                 G.vs['inflowE']: Time until next RBC reaches bifurcation.
@@ -464,65 +667,34 @@ class LinearSystemHtdTotFixedDT(object):
         """    
         G=self._G
         eslThickness = self._P.esl_thickness
-        #Beginning    
-        inEdges=[]
-        outEdges=[]
-        divergentV=[]
-        convergentV=[]
-        connectingV=[]
-        doubleConnectingV=[]
+        classifier = self._vertexClassifier
         noFlowV=[]
         noFlowE=[]
-        vertices=[]
         dThreshold = self._dThreshold
-        count=0
         interfaceVertices=self._interfaceVertices
+        isInterface=self._isInterfaceVertex
+        capEdge=np.array(G.es['diameter']) <= dThreshold
         print('In update out and inflows')
-        if not 'sign' in G.es.attributes() or not 'signOld' in G.es.attributes():
+        state=self._state
+        if np.any(np.isnan(state.signOld)):
             print('Initial vType Update')
-            for v in G.vs:
-                vI=v.index
-                outE=[]
-                inE=[]
-                noFlowE=[]
-                pressure = G.vs[vI]['pressure']
-                adjacents=G.adjacent(vI)
-                for j,nI in enumerate(G.neighbors(vI)):
-                    #outEdge
-                    if pressure > G.vs[nI]['pressure']: 
-                        outE.append(adjacents[j])
-                    elif pressure == G.vs[nI]['pressure']: 
-                        noFlowE.append(adjacents[j])
-                    #inflowEdge
-                    else: #G.vs[vI]['pressure'] < G.vs[nI]['pressure']
-                        inE.append(adjacents[j])
-                #Deal with vertices at the interface
-                #isCap is defined based on the diameter of the InflowEdge
-                if vI in interfaceVertices: 
-                    capCountIn = 0
-                    capCount = 0
-                    for j in adjacents:
-                        if G.es[j]['diameter'] <= dThreshold:
-                            capCount += 1
-                            if j in inE:
-                                capCountIn += 1
-                    if capCountIn == len(inE) and capCount > len(adjacents)/2.:
-                        G.vs[vI]['isCap']=True
-                    else:
-                        G.vs[vI]['isCap']=False
-                #Group into divergent, convergent and connecting Vertices
-                if len(outE) > len(inE) and len(inE) >= 1:
-                    divergentV.append(vI)
-                elif len(inE) > len(outE) and len(outE) >= 1:
-                    convergentV.append(vI)
-                elif len(inE) == len(outE) and len(inE) == 1:
-                    connectingV.append(vI)
-                elif len(inE) == len(outE) and len(inE) == 2:
-                    doubleConnectingV.append(vI)
-                elif vI in G['av']:
-                    if len(inE) == 0 and len(outE) == 1:
+            flows=classifier.classify(state.sign,capEdge=capEdge)
+            inEdges,outEdges=classifier.flow_edges(flows)
+            #Deal with vertices at the interface
+            #isCap is defined based on the diameter of the InflowEdge
+            if len(interfaceVertices) > 0:
+                G.vs[interfaceVertices]['isCap']=flows['isCap'][interfaceVertices].tolist()
+            #Divergent, convergent and connecting Vertices are grouped by the
+            #classifier, boundary and noFlow vertices are treated here
+            av=set(G['av'])
+            vv=set(G['vv'])
+            for vI in np.nonzero(flows['vType'] == 0)[0].tolist():
+                nIn=flows['nIn'][vI]
+                nOut=flows['nOut'][vI]
+                if vI in av:
+                    if nIn == 0 and nOut == 1:
                         pass
-                    elif len(inE) == 1 and len(outE) == 0:
+                    elif nIn == 1 and nOut == 0:
                         print('WARNING1 boundary condition changed: from av --> vv')
                         print(vI)
                         G.vs[vI]['av'] = 0
@@ -533,7 +705,7 @@ class LinearSystemHtdTotFixedDT(object):
                         G.es[edgeVI]['posFirst_last']=None
                         G.es[edgeVI]['v_last']=None
                         print(G.es[edgeVI]['v_last'])
-                    elif len(inE) == 0 and len(outE) == 0:
+                    elif nIn == 0 and nOut == 0:
                         print('WARNING changed to noFlow edge')
                         edgeVI=G.adjacent(vI)[0]
                         noFlowV.append(vI)
@@ -541,15 +713,15 @@ class LinearSystemHtdTotFixedDT(object):
                     else:
                         print('ERROR in defining in and outlets')
                         print(vI)
-                elif vI in G['vv']:
-                    if len(inE) == 1 and len(outE) == 0:
+                elif vI in vv:
+                    if nIn == 1 and nOut == 0:
                         pass
-                    elif len(inE) == 0 and len(outE) == 1:
+                    elif nIn == 0 and nOut == 1:
                         print('WARNING1 boundary condition changed: from vv --> av')
                         print(vI)
                         G.vs[vI]['av'] = 1
                         G.vs[vI]['vv'] = 0
-			G.vs[vI]['vType'] = 1
+                        G.vs[vI]['vType'] = 1
                         edgeVI=G.adjacent(vI)[0]
                         G.es[edgeVI]['httBC']=G.es[edgeVI]['httBC_init']
                         if len(G.es[edgeVI]['rRBC']) > 0:
@@ -561,8 +733,9 @@ class LinearSystemHtdTotFixedDT(object):
                             G.es[edgeVI]['posFirst_last']=G.es['length'][edgeVI]
                         G.es[edgeVI]['v_last']=G.es['v'][edgeVI]
                         print(G.es[edgeVI]['v_last'])
-                    elif len(inE) == 0 and len(outE) == 0:
+                    elif nIn == 0 and nOut == 0:
                         print('WARNING changed to noFlow edge')
+                        edgeVI=G.adjacent(vI)[0]
                         noFlowV.append(vI)
                         noFlowE.append(edgeVI)
                     else:
@@ -573,140 +746,75 @@ class LinearSystemHtdTotFixedDT(object):
                         if G.es['flow'][i] > 5.0e-08:
                             print('FLOWERROR')
                             print(vI)
-                            print(inE)
-                            print(outE)
-                            print(noFlowE)
+                            print(inEdges[vI])
+                            print(outEdges[vI])
                             print(i)
                             print('Flow and diameter')
                             print(G.es['flow'][i])
                             print(G.es['diameter'][i])
                         noFlowE.append(i)
-                    inE=[]
-                    outE=[]
+                    inEdges[vI]=[]
+                    outEdges[vI]=[]
                     noFlowV.append(vI)
                     print('noFlow V')
                     print(vI)
-                inEdges.append(inE)
-                outEdges.append(outE)
             G.vs['inflowE']=inEdges
             G.vs['outflowE']=outEdges
             G.es['noFlow']=[0]*G.ecount()
             if noFlowE != []:
-                noFlowE=np.unique(noFlowE)
+                noFlowE=np.unique(noFlowE).tolist()
                 G.es[noFlowE]['noFlow']=[1]*len(noFlowE)
-            G['divV']=divergentV
-            G['conV']=convergentV
-            G['connectV']=connectingV
-            G['dConnectV']=doubleConnectingV
             G['noFlowV']=noFlowV
             print('assign vertex types')
             #vertex type av = 1, vv = 2,divV = 3, conV = 4, connectV = 5, dConnectV = 6, noFlowV = 7
-            G.vs['vType']=[0]*G.vcount()
             G['av']=G.vs(av_eq=1).indices
             G['vv']=G.vs(vv_eq=1).indices
-            G.vs[G['av']]['vType']=[1]*len(G['av'])
-            G.vs[G['vv']]['vType']=[2]*len(G['vv'])
-            G.vs[G['divV']]['vType']=[3]*len(G['divV'])
-            G.vs[G['conV']]['vType']=[4]*len(G['conV'])
-            G.vs[G['connectV']]['vType']=[5]*len(G['connectV'])
-            G.vs[G['dConnectV']]['vType']=[6]*len(G['dConnectV'])
-            G.vs[G['noFlowV']]['vType']=[7]*len(G['noFlowV'])
+            vType=np.zeros(G.vcount(),dtype=np.int64)
+            vType[G['av']]=1
+            vType[G['vv']]=2
+            regular=flows['vType'] > 0
+            vType[regular]=flows['vType'][regular]
+            vType[noFlowV]=7
+            G.vs['vType']=vType.tolist()
             if len(G.vs(vType_eq=0).indices) > 0:
                 print('BIGERROR vertex type not assigned')
                 print(len(G.vs(vType_eq=0).indices))
-            del(G['divV'])
-            del(G['conV'])
-            del(G['connectV'])
-            del(G['dConnectV'])
         #Every Time Step
         else:
-            if G.es['sign']!=G.es['signOld']:
-                sign=np.array(G.es['sign'])
-                signOld=np.array(G.es['signOld'])
-                sumTes=abs(sign+signOld)
-                #find edges where sign change took place
-                edgeList=np.array(np.where(sumTes < abs(2))[0])
-                edgeList=edgeList.tolist()
-                sign0=G.es(sign_eq=0,signOld_eq=0).indices
-                for e in sign0:
-                    edgeList.remove(e)
-                stdout.flush()
-                vertices=[]
-                for e in edgeList:
-                    for vI in G.es[int(e)].tuple:
-                        vertices.append(vI)
-                vertices=np.unique(vertices).tolist()
-                count = 0
-                for vI in vertices:
-                    #vI=v.index
-                    count += 1
-                    vI=int(vI)
-                    outE=[]
-                    inE=[]
-                    noFlowE=[]
-                    neighbors=G.neighbors(vI)
-                    pressure = G.vs[vI]['pressure']
-                    adjacents=G.adjacent(vI)
-                    for j in xrange(len(neighbors)):
-                        nI=neighbors[j]
-                        #outEdge
-                        if pressure > G.vs[nI]['pressure']:
-                            outE.append(adjacents[j])
-                        elif pressure == G.vs[nI]['pressure']:
-                            noFlowE.append(adjacents[j])
-                        #inflowEdge
-                        else: #G.vs[vI]['pressure'] < G.vs[nI]['pressure']
-                            inE.append(adjacents[j])
-                    #Deal with vertices at the interface
-                    #isCap is defined based on the diameter of the InflowEdge
-                    if vI in interfaceVertices: 
-                        capCountIn = 0
-                        capCount = 0
-                        for j in adjacents:
-                            if G.es[j]['diameter'] <= dThreshold:
-                                capCount += 1
-                                if j in inE:
-                                    capCountIn += 1
-                        if capCountIn == len(inE) and capCount > len(adjacents)/2.:
-                            G.vs[vI]['isCap']=True
-                        else:
-                            G.vs[vI]['isCap']=False
-                    #Group into divergent, convergent, connecting, doubleConnecting and noFlow Vertices
-                    #it is now a divergent Vertex
-                    if len(outE) > len(inE) and len(inE) >= 1:
-                        #Find history of vertex
-                        if G.vs[vI]['vType']==7:
-                            G.es[inE]['noFlow']=[0]*len(inE)
-                            G.es[outE]['noFlow']=[0]*len(outE)
-                        G.vs[vI]['vType']=3
-                        G.vs[vI]['inflowE']=inE
-                        G.vs[vI]['outflowE']=outE
-                    #it is now a convergent Vertex
-                    elif len(inE) > len(outE) and len(outE) >= 1:
-                        if G.vs[vI]['vType']==7:
-                            G.es[inE]['noFlow']=[0]*len(inE)
-                            G.es[outE]['noFlow']=[0]*len(outE)
-                        G.vs[vI]['vType']=4
-                        G.vs[vI]['inflowE']=inE
-                        G.vs[vI]['outflowE']=outE
-                    #it is now a connecting Vertex
-                    elif len(outE) == len(inE) and len(outE) == 1:
-                        if G.vs[vI]['vType']==7:
-                            G.es[inE]['noFlow']=[0]*len(inE)
-                            G.es[outE]['noFlow']=[0]*len(outE)
-                        G.vs[vI]['vType']=5
-                        G.vs[vI]['inflowE']=inE
-                        G.vs[vI]['outflowE']=outE
-                    #it is now a double connecting Vertex
-                    elif len(outE) == len(inE) and len(outE) == 2:
-                        if G.vs[vI]['vType']==7:
-                            G.es[inE]['noFlow']=[0]*len(inE)
-                            G.es[outE]['noFlow']=[0]*len(outE)
-                        G.vs[vI]['vType']=6
-                        G.vs[vI]['inflowE']=inE
-                        G.vs[vI]['outflowE']=outE
-                    elif vI in G['av']:
-                        if G.vs[vI]['vType']==7:
+            vertices=classifier.changed_vertices(state.sign,state.signOld)
+            if len(vertices) > 0:
+                flows=classifier.classify(state.sign,vertices,capEdge)
+                inEdges,outEdges=classifier.flow_edges(flows)
+                vertices=vertices.tolist()
+                vTypeOld=G.vs[vertices]['vType']
+                #Deal with vertices at the interface
+                #isCap is defined based on the diameter of the InflowEdge
+                interface=np.nonzero(isInterface[vertices])[0].tolist()
+                if len(interface) > 0:
+                    G.vs[[vertices[i] for i in interface]]['isCap']= \
+                        flows['isCap'][interface].tolist()
+                #Divergent, convergent, connecting and doubleConnecting
+                #Vertices
+                regular=np.nonzero(flows['vType'] > 0)[0].tolist()
+                for i in regular:
+                    #Find history of vertex
+                    if vTypeOld[i]==7:
+                        G.es[inEdges[i]]['noFlow']=[0]*len(inEdges[i])
+                        G.es[outEdges[i]]['noFlow']=[0]*len(outEdges[i])
+                if len(regular) > 0:
+                    regularV=[vertices[i] for i in regular]
+                    G.vs[regularV]['vType']=flows['vType'][regular].tolist()
+                    G.vs[regularV]['inflowE']=[inEdges[i] for i in regular]
+                    G.vs[regularV]['outflowE']=[outEdges[i] for i in regular]
+                #Boundary and noFlow Vertices
+                av=set(G['av'])
+                vv=set(G['vv'])
+                for i in np.nonzero(flows['vType'] == 0)[0].tolist():
+                    vI=vertices[i]
+                    inE=inEdges[i]
+                    outE=outEdges[i]
+                    if vI in av:
+                        if vTypeOld[i]==7:
                             G.es[inE]['noFlow']=[0]*len(inE)
                             G.es[outE]['noFlow']=[0]*len(outE)
                         if G.vs[vI]['rBC'] != None:
@@ -721,8 +829,8 @@ class LinearSystemHtdTotFixedDT(object):
                                     print(G.vs[vI]['rBC'])
                                     print(G.vs[vI]['kind'])
                                     print(G.vs[vI]['isSrxtm'])
-                                    print(G.es[G.adjacent(vI)]['sign'])
-                                    print(G.es[G.adjacent(vI)]['signOld'])
+                                    print(state.sign[G.adjacent(vI)])
+                                    print(state.signOld[G.adjacent(vI)])
                         else:
                             print('WARNING direction out av changed to vv')
                             print(vI)
@@ -735,8 +843,8 @@ class LinearSystemHtdTotFixedDT(object):
                             G.es[edgeVI]['v_last']=None
                             G.vs[vI]['inflowE']=inE
                             G.vs[vI]['outflowE']=outE
-                    elif vI in G['vv']:
-                        if G.vs[vI]['vType']==7:
+                    elif vI in vv:
+                        if vTypeOld[i]==7:
                             G.es[inE]['noFlow']=[0]*len(inE)
                             G.es[outE]['noFlow']=[0]*len(outE)
                         if G.vs[vI]['rBC'] != None:
@@ -751,14 +859,14 @@ class LinearSystemHtdTotFixedDT(object):
                                     print(G.vs[vI]['rBC'])
                                     print(G.vs[vI]['kind'])
                                     print(G.vs[vI]['isSrxtm'])
-                                    print(G.es[G.adjacent(vI)]['sign'])
-                                    print(G.es[G.adjacent(vI)]['signOld'])
+                                    print(state.sign[G.adjacent(vI)])
+                                    print(state.signOld[G.adjacent(vI)])
                         else:
                             print('WARNING direction out vv changed to av')
                             print(vI)
                             G.vs[vI]['av'] = 1
                             G.vs[vI]['vv'] = 0
-			    G.vs[vI]['vType'] = 1
+                            G.vs[vI]['vType'] = 1
                             edgeVI=G.adjacent(vI)[0]
                             G.es[edgeVI]['httBC']=G.es[edgeVI]['httBC_init']
                             if len(G.es[edgeVI]['rRBC']) > 0:
@@ -799,7 +907,7 @@ class LinearSystemHtdTotFixedDT(object):
                             print(vI)
                             G.vs[vI]['av'] = 1
                             G.vs[vI]['vv'] = 0
-			    G.vs[vI]['vType'] = 1
+                            G.vs[vI]['vType'] = 1
                             edgeVI=G.adjacent(vI)[0]
                             G.es[edgeVI]['httBC']=G.es[edgeVI]['httBC_init']
                             if len(G.es[edgeVI]['rRBC']) > 0:
@@ -812,18 +920,17 @@ class LinearSystemHtdTotFixedDT(object):
                             G.es[edgeVI]['v_last']=G.es[edgeVI]['v']
                         else:
                             noFlowEdges=[]
-                            for i in G.adjacent(vI):
-                                if G.es['flow'][i] > 5.0e-08:
+                            for j in G.adjacent(vI):
+                                if G.es['flow'][j] > 5.0e-08:
                                     print('FLOWERROR')
                                     print(vI)
                                     print(inE)
                                     print(outE)
-                                    print(noFlowE)
-                                    print(i)
+                                    print(j)
                                     print('Flow and diameter')
-                                    print(G.es['flow'][i])
-                                    print(G.es['diameter'][i])
-                                noFlowEdges.append(i)
+                                    print(G.es['flow'][j])
+                                    print(G.es['diameter'][j])
+                                noFlowEdges.append(j)
                             G.vs[vI]['vType']=7
                             G.es[noFlowEdges]['noFlow']=[1]*len(noFlowEdges)
                             G.vs[vI]['inflowE']=[]
@@ -850,13 +957,25 @@ class LinearSystemHtdTotFixedDT(object):
         """
 
         G = self._G
+        state = self._state
         invivo=self._invivo
-        vf = self._P.velocity_factor
+        vf = self._P.velocity_factor_array
         vrbc = self._P.rbc_volume(self._species)
-        vfList=[1.0 if htt == 0.0 else max(1.0,vf(d, invivo, tube_ht=htt)) for d,htt in zip(G.es['diameter'],G.es['htt'])]
+        htt = state.htt
+        vfList = np.where(htt == 0.0, 1.0, np.maximum(1.0, vf(self._diameter,
+                          invivo, tube_ht=htt)))
 
-        self._G=run_faster.update_flow_and_v(self._G,self._invivo,vfList,vrbc)
-        G= self._G
+        state.flow[:] = np.abs(state.pressure[state.source] -
+                               state.pressure[state.target]) / state.effResistance
+        state.vBulk[:] = state.flow / self._crosssection
+        # RBC velocity is not defined if tube_ht==0, using plasma velocity
+        # instead:
+        state.v[:] = np.where(htt > 0, state.vBulk * vfList, state.vBulk)
+        #RBC Flow in mum^3/ms and RBCs/ms
+        state.rbcFlow[:] = state.flow * state.htd
+        state.rbcFlow2[:] = state.rbcFlow / vrbc
+        # The RBC propagation reads flow and velocity per edge:
+        state.store_to_graph(G, ['flow', 'v'])
 
     #--------------------------------------------------------------------------
 
@@ -872,7 +991,11 @@ class LinearSystemHtdTotFixedDT(object):
         [conductance] and [conductance*pressure] otherwise, the latter being
         rBCs. This has the advantage that no re-indexing is required as the
         matrices contain all vertices.
-        INPUT: 
+        The sparsity pattern of A is fixed, A and b are filled in place by
+        the CSRAssembler from the array of edge conductances.
+        INPUT: vertex: List of vertices whose adjacent edges have changed. The
+                       effective resistance is only updated for those edges.
+                       If None, all edges are updated. (Default=None)
         OUTPUT: A: Matrix A of the linear system, holding the conductance
                    information.
                 b: Vector b of the linear system, holding the boundary
@@ -882,75 +1005,66 @@ class LinearSystemHtdTotFixedDT(object):
 
         G = self._G
         P = self._P
-        A = self._A
-        b = self._b
-        x = self._x
         invivo = self._invivo
 
-        htt2htd = P.tube_to_discharge_hematocrit
-        nurel = P.relative_apparent_blood_viscosity
+        htt2htd = self._rheology.tube_to_discharge_hematocrit
+        nurel = self._rheology.relative_apparent_blood_viscosity
 
         if vertex is None:
-            vertexList = xrange(G.vcount())
-            edgeList = xrange(G.ecount())
+            edgeList = range(G.ecount())
         else:
-            vertexList=[]
             edgeList=[]
             for i in vertex:
-                vList = np.concatenate([[i],
-                     G.neighbors(i)]).tolist()
-                eList = G.adjacent(i)
-                vertexList=np.concatenate([vertexList,vList]).tolist()
-                edgeList=np.concatenate([edgeList,eList]).tolist()
-            vertexList=np.unique(vertexList).tolist()
-            edgeList=np.unique(edgeList).tolist()
-            edgeList=[int(i) for i in edgeList]
-            vertexList=[int(i) for i in vertexList]
-        dischargeHt = [min(htt2htd(e, d, invivo), 1.0) for e,d in zip(G.es[edgeList]['htt'],G.es[edgeList]['diameter'])]
-        G.es[edgeList]['effResistance'] =[ res * nurel(max(d,4.0), min(dHt,0.6),invivo) for res,dHt,d in zip(G.es[edgeList]['resistance'], \
-            dischargeHt,G.es[edgeList]['diameter'])]
-
-        edgeList = G.es(edgeList)
-        vertexList = G.vs(vertexList)
-        for vertex in vertexList:
-            i = vertex.index
-            A.data[i] = []
-            A.rows[i] = []
-            b[i] = 0.0
-            if vertex['pBC'] is not None:
-                A[i,i] = 1.0
-                b[i] = vertex['pBC']
-            else:
-                aDummy=0
-                k=0
-                neighbors=[]
-                for edge in G.adjacent(i,'all'):
-                    if G.is_loop(edge):
-                        continue
-                    j=G.neighbors(i)[k]
-                    k += 1
-                    conductance = 1 / G.es[edge]['effResistance']
-                    neighbor = G.vs[j]
-                    # +=, -= account for multiedges
-                    aDummy += conductance
-                    if neighbor['pBC'] is not None:
-                        b[i] = b[i] + neighbor['pBC'] * conductance
-                    #elif neighbor['rBC'] is not None:
-                     #   b[i] = b[i] + neighbor['rBC']
-                    else:
-                        if j not in neighbors:
-                            A[i,j] = - conductance
-                        else:
-                            A[i,j] = A[i,j] - conductance
-                    neighbors.append(j)
-                    if vertex['rBC'] is not None:
-                        b[i] += vertex['rBC']
-                A[i,i]=aDummy
+                edgeList=np.concatenate([edgeList,G.adjacent(i)]).tolist()
+            edgeList=[int(i) for i in np.unique(edgeList)]
+        diameter = np.array(G.es[edgeList]['diameter'])
+        htt = self._state.htt[edgeList]
+        dischargeHt = np.minimum(htt2htd(edgeList, htt, diameter), 1.0)
+        effResistance = np.array(G.es[edgeList]['resistance']) * \
+            nurel(edgeList, np.maximum(diameter, 4.0), np.minimum(dischargeHt, 0.6))
+        self._state.effResistance[edgeList] = effResistance
+        self._httResistance[edgeList] = htt
 
-        self._A = A
-        self._b = b
+        # Only the conductances of the updated edges change, A and b are
+        # then refilled in place using the precomputed CSR slots:
+        if len(edgeList) > 0:
+            self._conductance[edgeList] = 1.0 / effResistance
+        # G holds 'pBC' in default units while the system is assembled, the
+        # values are kept for _write_checkpoint:
+        pBC, rBC = self._assembler.boundary_values(G)
+        self._pBC = pBC
+        self._A, self._b = self._assembler.assemble(self._conductance, pBC, rBC)
         self._G = G
 
+    #--------------------------------------------------------------------------
+
+    def _sort_edges_by_outlet_pressure(self, pOut):
+        """Sorts the edges by the pressure at their outlet vertex, edges with
+        equal outlet pressure are sorted by index. As the order changes only
+        slightly from one timestep to the next, the permutation of the
+        previous call is used as starting point of an adaptive (merge) sort.
+        The number of descents of the previous permutation, i.e. of adjacent
+        pairs which are out of order (not the number of inversions), is
+        stored in self._sortDescents. No sorting is done if it is zero.
+        INPUT: pOut: Array of the outlet pressure of every edge.
+        OUTPUT: Array of the edge indices sorted by outlet pressure.
+        """
+        perm = self._sortedEdges
+        if perm is None or len(perm) != len(pOut):
+            perm = np.arange(len(pOut))
+        p = pOut[perm]
+        dp = np.diff(p)
+        self._sortDescents = np.count_nonzero(dp < 0) + \
+            np.count_nonzero((dp == 0) & (np.diff(perm) < 0))
+        if self._sortDescents > 0:
+            perm = perm[np.argsort(p, kind='mergesort')]
+            # Ties are kept in the previous order by the stable sort, restore
+            # the ordering by index if necessary:
+            if np.any((np.diff(pOut[perm]) == 0) & (np.diff(perm) < 0)):
+                perm = np.lexsort((np.arange(len(pOut)), pOut))
+        self._sortedEdges = perm
+        return perm
+
     #--------------------------------------------------------------------------
     #@profile
     def _propagate_rbc(self):
@@ -974,16 +1088,63 @@ class LinearSystemHtdTotFixedDT(object):
         #pOut=[G.vs[e['target']]['pressure'] if e['sign'] == 1.0 else G.vs[e['source']]['pressure']
         #    for e in edgeList]
         #sortedE=zip(pOut,edgeList0)
-        pOut=[G.vs[e['target']]['pressure'] if e['sign'] == 1.0 else G.vs[e['source']]['pressure']
-            for e in G.es]
-        sortedE=zip(pOut,range(G.ecount()))
-        sortedE.sort()
-        sortedE=[i[1] for i in sortedE]
+        signs = self._state.sign.copy()
+        outlets = np.where(signs == 1.0, self._assembler.target, self._assembler.source)
+        pOut = self._state.pressure[outlets]
+        sortedE = self._sort_edges_by_outlet_pressure(pOut).tolist()
         convEdges2=[0]*G.ecount()
+        #FIRST step move all RBCs at once. RBCs in edges with a noFlow
+        #vertex (vType=7) at the outlet are not moved
+        rbcStore = self._rbcStore
+        rbcStore.sync(G)
+        moving = np.array(G.vs['vType'])[outlets] != 7
+        rbcStore.advect(np.where(moving, self._state.v * dt * signs, 0.0))
+        overshoots = rbcStore.overshoots(self._length, signs)
+        overshoots[~moving] = 0
+        #Only edges with overshooting RBCs or an inflow of RBCs (httBC) need
+        #to be considered in the second step
+        httBCEdges = np.array([h is not None for h in G.es['httBC']])
+        sortedE = [ei for ei in sortedE if overshoots[ei] > 0 or httBCEdges[ei]]
+        #Bifurcation events at connecting vertices (without RBC inflow) are
+        #processed by a compiled kernel, one call per run of consecutive
+        #events. Events the kernel cannot handle fall back to the code below
+        connecting = (np.array(G.vs['vType'])[outlets] == 5) & \
+            (overshoots > 0) & ~httBCEdges
+        connectingRuns = {}
+        if np.any(connecting[sortedE]):
+            outflowE = G.vs['outflowE']
+            run = []
+            for ei in sortedE + [None]:
+                if ei is not None and connecting[ei]:
+                    run.append(ei)
+                elif len(run) > 0:
+                    connectingRuns[run[0]] = run
+                    run = []
         edgeUpdate=[]   #Edges where the number of RBCs changed --> need to be updated
         vertexUpdate=[] #Vertices where the number of RBCs changed in adjacent edges --> need to be updated
+        adjStart = self._state.offset
+        adjEdges = self._state.adjacent
         #SECOND step go through all edges from smallest to highest pressure and move RBCs
         for ei in sortedE:
+            if ei in connectingRuns:
+                run = connectingRuns[ei]
+                outRun = [outflowE[outlets[ej]][0] for ej in run]
+                nDone, nTransferred = self._transfer_connecting(run, outRun,
+                    overshoots[run])
+                connecting[run[nDone:]] = False
+                for ej, ov in zip(run[:nDone], nTransferred[:nDone].tolist()):
+                    if ov == 0:
+                        continue
+                    vi = outlets[ej]
+                    vertexUpdate.append(self._state.source[ej])
+                    vertexUpdate.append(self._state.target[ej])
+                    edgeUpdate.extend(adjEdges[adjStart[vi]:adjStart[vi+1]].tolist())
+                    if self._analyzeBifEvents:
+                        rbcMoved += ov
+                        rbcsMovedPerEdge.append(ov)
+                        edgesWithMovedRBCs.append(ej)
+            if connecting[ei]:
+                continue
             noBifEvents = 0
             edgesInvolved=[] #all edges connected to the bifurcation vertex
             e = G.es[ei]
@@ -1005,26 +1166,14 @@ class LinearSystemHtdTotFixedDT(object):
             if convEdges2[ei] == 0 and G.vs[vi]['vType'] != 7:
             #Check if the RBCs in the edge have been moved already (--> convergent bifurcation)
             #Recheck if bifurcation vertex is a noFlow Vertex (vType=7)
-                #If RBCs are present move all RBCs
+                #RBCs have been moved in the first step, check for overshoots
                 if len(e['rRBC']) > 0:
-                    e['rRBC'] = e['rRBC'] + e['v'] * dt * e['sign']
-                    bifRBCsIndex=[]
+                    #Overshooting RBCs have been counted in the first step
                     nRBC=len(e['rRBC'])
                     if sign == 1.0:
-                        if e['rRBC'][-1] > e['length']:
-                            for i,j in enumerate(e['rRBC'][::-1]):
-                                if j > e['length']:
-                                    bifRBCsIndex.append(nRBC-1-i)
-                                else:
-                                    break
-                        bifRBCsIndex=bifRBCsIndex[::-1]
+                        bifRBCsIndex=range(nRBC-overshoots[ei],nRBC)
                     else:
-                        if e['rRBC'][0] < 0:
-                            for i,j in enumerate(e['rRBC']):
-                                if j < 0:
-                                    bifRBCsIndex.append(i)
-                                else:
-                                    break
+                        bifRBCsIndex=range(overshoots[ei])
                     #Deal with bifurcation events and overshoots in every edge
                     ##bifRBCsIndes - array with overshooting RBCs from smallest to largest index
                     #bifRBCsIndex=[]
@@ -1270,39 +1419,14 @@ class LinearSystemHtdTotFixedDT(object):
                                 else bifRBCsIndex[:posNoBifEvents]
                             overshootsNo=posNoBifEvents
                         if nonCap:
+                            #Split the RBCs according to the flow ratios
                             if not boolTrifurcation:
-                                if ratio1 != 0 and overshootsNo != 0:
-                                    def errorDistributeRBCs(n1):
-                                        return n1/float(overshootsNo)-ratio1
-                                    resultMinimizeError = root(errorDistributeRBCs,np.ceil(ratio1 * overshootsNo))
-                                    overshootsNo1=int(np.round(resultMinimizeError['x']))
-                                else:
-                                    overshootsNo1 = 0
-                                overshootsNo2 = overshootsNo - overshootsNo1
+                                overshootsNo1, overshootsNo2 = \
+                                    apportion_rbcs(overshootsNo, [ratio1])
                                 overshootsNo3 = 0
                             else:
-                                if overshootsNo == 0:
-                                    overshootsNo1=0
-                                    overshootsNo2=0
-                                elif ratio1 != 0 and ratio2 != 0 and overshootsNo != 0:
-                                    def errorDistributeRBCs(n12):
-                                        return [n12[0]/float(overshootsNo)-ratio1,n12[1]/float(overshootsNo)-ratio2]
-                                    resultMinimizeError = root(errorDistributeRBCs,[np.ceil(ratio1 * overshootsNo),np.ceil(ratio2 * overshootsNo)])
-                                    overshootsNo1=int(np.round(resultMinimizeError['x'][0]))
-                                    overshootsNo2=int(np.round(resultMinimizeError['x'][1]))
-                                elif ratio1 != 0 and overshootsNo != 0:
-                                    def errorDistributeRBCs(n1):
-                                        return n1/float(overshootsNo)-ratio1
-                                    resultMinimizeError = root(errorDistributeRBCs,np.ceil(ratio1 * overshootsNo))
-                                    overshootsNo1=int(np.round(resultMinimizeError['x']))
-                                    overshootsNo2=0
-                                elif ratio2 != 0 and overshootsNo != 0:
-                                    def errorDistributeRBCs(n2):
-                                        return n2/float(overshootsNo)-ratio2
-                                    resultMinimizeError = root(errorDistributeRBCs,np.ceil(ratio2 * overshootsNo))
-                                    overshootsNo2=int(np.round(resultMinimizeError['x']))
-                                    overshootsNo1=0
-                                overshootsNo3 = overshootsNo - overshootsNo1 - overshootsNo2
+                                overshootsNo1, overshootsNo2, overshootsNo3 = \
+                                    apportion_rbcs(overshootsNo, [ratio1, ratio2])
                             if overshootsNo1 > posNoBifEventsPref:
                                 if ratio2 > ratio3:
                                     overshootsNo2 += overshootsNo1 - posNoBifEventsPref
@@ -2572,26 +2696,14 @@ class LinearSystemHtdTotFixedDT(object):
                         #Move RBCs in second inEdge (if that has not been done already)
                         if convEdges2[inE2] == 0:
                             convEdges2[inE2]=1
-                            #If RBCs are present move all RBCs in inEdge2
+                            #RBCs have been moved in the first step, check for overshoots in inEdge2
                             if len(e2['rRBC']) > 0:
-                                e2['rRBC'] = e2['rRBC'] + e2['v'] * dt * e2['sign']
-                                bifRBCsIndex2=[]
+                                #Overshooting RBCs have been counted in the first step
                                 nRBC2=len(e2['rRBC'])
                                 if e2['sign'] == 1.0:
-                                    if e2['rRBC'][-1] > e2['length']:
-                                        for i,j in enumerate(e2['rRBC'][::-1]):
-                                            if j > e2['length']:
-                                                bifRBCsIndex2.append(nRBC2-1-i)
-                                            else:
-                                                break
-                                    bifRBCsIndex2=bifRBCsIndex2[::-1]
+                                    bifRBCsIndex2=range(nRBC2-overshoots[inE2],nRBC2)
                                 else:
-                                    if e2['rRBC'][0] < 0:
-                                        for i,j in enumerate(e2['rRBC']):
-                                            if j < 0:
-                                                bifRBCsIndex2.append(i)
-                                            else:
-                                                break
+                                    bifRBCsIndex2=range(overshoots[inE2])
                                 noBifEvents2=len(bifRBCsIndex2)
                             else:
                                 bifRBCsIndex2=[]
@@ -2607,26 +2719,14 @@ class LinearSystemHtdTotFixedDT(object):
                             boolTrifurcation = 1
                             if convEdges2[inE3] == 0:
                                 convEdges2[inE3]=1
-                                #If RBCs are present move all RBCs in inEdge3
+                                #RBCs have been moved in the first step, check for overshoots in inEdge3
                                 if len(e3['rRBC']) > 0:
-                                    e3['rRBC'] = e3['rRBC'] + e3['v'] * dt * e3['sign']
-                                    bifRBCsIndex3=[]
+                                    #Overshooting RBCs have been counted in the first step
                                     nRBC3=len(e3['rRBC'])
                                     if e3['sign'] == 1.0:
-                                        if e3['rRBC'][-1] > e3['length']:
-                                            for i,j in enumerate(e3['rRBC'][::-1]):
-                                                if j > e3['length']:
-                                                    bifRBCsIndex3.append(nRBC3-1-i)
-                                                else:
-                                                    break
-                                        bifRBCsIndex3=bifRBCsIndex3[::-1]
+                                        bifRBCsIndex3=range(nRBC3-overshoots[inE3],nRBC3)
                                     else:
-                                        if e3['rRBC'][0] < 0:
-                                            for i,j in enumerate(e3['rRBC']):
-                                                if j < 0:
-                                                    bifRBCsIndex3.append(i)
-                                                else:
-                                                    break
+                                        bifRBCsIndex3=range(overshoots[inE3])
                                     noBifEvents3=len(bifRBCsIndex3)
                                 else:
                                     bifRBCsIndex3=[]
@@ -2884,26 +2984,14 @@ class LinearSystemHtdTotFixedDT(object):
                         e2=G.es[inE2]
                         if convEdges2[inE2] == 0:
                             convEdges2[inE2]=1
-                            #If RBCs are present move all RBCs in inEdge2
+                            #RBCs have been moved in the first step, check for overshoots in inEdge2
                             if len(e2['rRBC']) > 0:
-                                e2['rRBC'] = e2['rRBC'] + e2['v'] * dt * e2['sign']
-                                bifRBCsIndex2=[]
+                                #Overshooting RBCs have been counted in the first step
                                 nRBC2=len(e2['rRBC'])
                                 if e2['sign'] == 1.0:
-                                    if e2['rRBC'][-1] > e2['length']:
-                                        for i,j in enumerate(e2['rRBC'][::-1]):
-                                            if j > e2['length']:
-                                                bifRBCsIndex2.append(nRBC2-1-i)
-                                            else:
-                                                break
-                                    bifRBCsIndex2=bifRBCsIndex2[::-1]
+                                    bifRBCsIndex2=range(nRBC2-overshoots[inE2],nRBC2)
                                 else:
-                                    if e2['rRBC'][0] < 0:
-                                        for i,j in enumerate(e2['rRBC']):
-                                            if j < 0:
-                                                bifRBCsIndex2.append(i)
-                                            else:
-                                                break
+                                    bifRBCsIndex2=range(overshoots[inE2])
                                 noBifEvents2=len(bifRBCsIndex2)
                             else:
                                 noBifEvents2=0
@@ -2950,14 +3038,9 @@ class LinearSystemHtdTotFixedDT(object):
                         noBifEvents = noBifEvents1 + noBifEvents2
                         overshootsNo=noBifEvents
                         if nonCap:
-                            if ratio1 != 0 and overshootsNo != 0:
-                                def errorDistributeRBCs(n1):
-                                    return n1/float(overshootsNo)-ratio1
-                                resultMinimizeError = root(errorDistributeRBCs,np.ceil(ratio1 * overshootsNo))
-                                overshootsNo1=int(np.round(resultMinimizeError['x']))
-                            else:
-                                overshootsNo1 = 0
-                            overshootsNo2 = overshootsNo - overshootsNo1
+                            #Split the RBCs according to the flow ratio
+                            overshootsNo1, overshootsNo2 = \
+                                apportion_rbcs(overshootsNo, [ratio1])
                             stuck1=0
                             stuck2=0
                             if overshootsNo1 > posNoBifEventsPref:
@@ -3964,6 +4047,7 @@ class LinearSystemHtdTotFixedDT(object):
                                 edgesWithMovedRBCs.append(e.index)
 
         #-------------------------------------------------------------------------------------------
+        rbcStore.sync(G)
         self._vertexUpdate=np.unique(vertexUpdate)
         edgeUpdate=np.unique(edgeUpdate)
         self._edgeUpdate=edgeUpdate.tolist()
@@ -3974,6 +4058,51 @@ class LinearSystemHtdTotFixedDT(object):
             self._rbcMoveAll.append(rbcMoved)
         self._G=G
     #--------------------------------------------------------------------------
+
+    def _transfer_connecting(self, inEdges, outEdges, nBif):
+        """Processes the bifurcation events of a sequence of connecting
+        vertices (vType 5) by the compiled kernel
+        run_faster.transfer_connecting, i.e. moves the overshooting RBCs of
+        the inflow edges into the outflow edges and the RBCs that do not fit
+        back into the inflow edges.
+        INPUT: inEdges: List of the inflow edges, in the order the events
+                        are to be processed.
+               outEdges: List of the corresponding outflow edges.
+               nBif: Array of the number of overshooting RBCs per inflow
+                     edge.
+        OUTPUT: nDone: Number of processed events. The remaining events need
+                       to be processed by _propagate_rbc.
+                nTransferred: Array of the number of RBCs that entered the
+                              outflow edge in every event.
+        """
+        G = self._G
+        rbcStore = self._rbcStore
+        inEdges = np.array(inEdges, dtype=np.int64)
+        outEdges = np.array(outEdges, dtype=np.int64)
+        nBif = np.array(nBif, dtype=np.int64)
+        nTransferred = np.zeros(len(inEdges), dtype=np.int64)
+        rbcStore.sync(G, np.unique(np.concatenate([inEdges, outEdges])).tolist())
+        nDone = run_faster.transfer_connecting(rbcStore.buffer,
+            rbcStore.offset, rbcStore.count, rbcStore.capacity, self._length,
+            self._minDist, self._nMax, self._state.v, self._state.sign,
+            inEdges, outEdges, nBif, nTransferred)
+        if nDone > 0:
+            done = np.unique(np.concatenate([inEdges[:nDone],
+                                             outEdges[:nDone]])).tolist()
+            rbcStore.refresh(G, done)
+            G.es[done]['nRBC'] = rbcStore.count[done].tolist()
+            received = {}
+            for oe, ov in zip(outEdges[:nDone].tolist(),
+                              nTransferred[:nDone].tolist()):
+                if ov > 0:
+                    received[oe] = received.get(oe, 0) + ov
+            if len(received) > 0:
+                edges = received.keys()
+                G.es[edges]['countRBCs'] = [c + received[oe] for c, oe in
+                    zip(G.es[edges]['countRBCs'], edges)]
+        return nDone, nTransferred
+
+    #--------------------------------------------------------------------------
     #@profile
     def evolve(self, time, method, dtfix,**kwargs):
         """Solves the linear system A x = b using a direct or AMG solver.
@@ -3981,12 +4110,13 @@ class LinearSystemHtdTotFixedDT(object):
 	 	     Reset in plotPrms or samplePrms = False, time is the duration 
 	 	     which is added
                method: Solution-method for solving the linear system. This can
-                       be either 'direct' or 'iterative'
+                       be either 'direct', 'iterative', 'iterative2' or
+                       'incremental' (see _solve)
                dtfix: given timestep
                **kwargs
-               precision: The accuracy to which the ls is to be solved. If not
-                          supplied, machine accuracy will be used. (This only
-                          applies to the iterative solver)
+               precision: The relative residual to which the ls is to be
+                          solved. If not supplied, self._eps will be used.
+                          (This only applies to the iterative solvers)
                plotPrms: Provides the parameters for plotting the RBC 
                          positions over time. List format with the following
                          content is expected: [start, stop, step, reset].
@@ -4004,6 +4134,12 @@ class LinearSystemHtdTotFixedDT(object):
                           are added to the already elapsed time.
                SampleDetailed:Boolean whether every step should be samplede(True) or
 			      if the sampling is done by the given samplePrms(False)
+               massBalanceCheck: Frequency of the mass balance verification.
+                                 Either an integer N (the mass balance is
+                                 verified every N timesteps) or 'sample' (the
+                                 mass balance is only verified in timesteps
+                                 in which the network is sampled).
+                                 (Optional, default=1.)
          OUTPUT: None (files are written to disk)
         """
         G=self._G
@@ -4019,6 +4155,12 @@ class LinearSystemHtdTotFixedDT(object):
         if 'SampleDetailed' in kwargs.keys():
             SampleDetailed=kwargs['SampleDetailed']
 
+        massBalanceCheck=1
+        if 'massBalanceCheck' in kwargs.keys():
+            massBalanceCheck=kwargs['massBalanceCheck']
+            if massBalanceCheck != 'sample' and int(massBalanceCheck) < 1:
+                raise ValueError('massBalanceCheck must be a positive integer or \'sample\'')
+
         doSampling, doPlotting = [False, False]
 
         if 'plotPrms' in kwargs.keys():
@@ -4039,6 +4181,7 @@ class LinearSystemHtdTotFixedDT(object):
             if init == True:
                 self._tSample = 0.0
                 self._sampledict = {}
+                self._sampler.reset()
                 timelistAvg = []
             else:
                 if 'iterFinalSample' not in G.attributes():
@@ -4086,19 +4229,28 @@ class LinearSystemHtdTotFixedDT(object):
             if t >= time:
                 break
             iteration += 1
+            # Surface errors of background writes:
+            if self._asyncWriter is not None:
+                self._asyncWriter.check()
             start_time=ttime.time()
             self._update_eff_resistance_and_LS(self._vertexUpdate)
             print('Matrix updated')
             self._solve(method, **kwargs)
             print('Matrix solved')
-            self._G.vs['pressure'] = self._x[:]
+            self._state.pressure[:] = self._x
             print('Pressure copied')
             self._update_flow_and_velocity()
             print('Flow updated')
             self._update_flow_sign()
             print('Flow sign updated')
-            self._verify_mass_balance()
-            print('Mass balance verified updated')
+            if massBalanceCheck == 'sample':
+                verifyMassBalance = SampleDetailed or (doSampling and
+                    tSample >= sStart and tSample <= sStop)
+            else:
+                verifyMassBalance = iteration % massBalanceCheck == 0
+            if verifyMassBalance:
+                self._verify_mass_balance()
+                print('Mass balance verified updated')
             self._update_out_and_inflows_for_vertices()
             print('In and outflows updated')
             stdout.flush()
@@ -4119,19 +4271,22 @@ class LinearSystemHtdTotFixedDT(object):
                 self._t=t
                 self._tSample=tSample
                 self._sample()
-                filenameDetailed ='G_iteration_'+str(iteration)+'.pkl'
-                #Convert deaultUnits to ['mmHG']
-                #for 'pBC' and 'pressure'
-                for v in G.vs:
-                    if v['pBC'] != None:
-                        v['pBC']=v['pBC']/self._scaleToDef
-                    v['pressure']=v['pressure']/self._scaleToDef
-                vgm.write_pkl(G,filenameDetailed)
-                #Convert 'pBC' ['mmHG'] to default Units
-                for v in G.vs:
-                    if v['pBC'] != None:
-                        v['pBC']=v['pBC']*self._scaleToDef
-                    v['pressure']=v['pressure']*self._scaleToDef
+                # The sample has been written to the time series store
+                # already, if any:
+                if self._sampleWriter is None:
+                    filenameDetailed ='G_iteration_'+str(iteration)+'.pkl'
+                    #Convert deaultUnits to ['mmHG']
+                    #for 'pBC' and 'pressure'
+                    for v in G.vs:
+                        if v['pBC'] != None:
+                            v['pBC']=v['pBC']/self._scaleToDef
+                        v['pressure']=v['pressure']/self._scaleToDef
+                    self._write_pkl(G,filenameDetailed)
+                    #Convert 'pBC' ['mmHG'] to default Units
+                    for v in G.vs:
+                        if v['pBC'] != None:
+                            v['pBC']=v['pBC']*self._scaleToDef
+                        v['pressure']=v['pressure']*self._scaleToDef
             else:
                 if doSampling and tSample >= sStart and tSample <= sStop:
                     print('DO sampling')
@@ -4155,24 +4310,31 @@ class LinearSystemHtdTotFixedDT(object):
                             G['edgesMovedRBCs']=self._edgesWithMovedRBCs
                             G['rbcMovedAll']=self._rbcMoveAll
                         filename1='sampledict_BackUp_'+str(BackUpCounter)+'.pkl'
-                        filename2='G_BackUp'+str(BackUpCounter)+'.pkl'
+                        filename2='G_BackUp'+str(BackUpCounter)+self._backup_extension()
                         self._sample_average()
                         print(filename1)
                         print(filename2)
-                        #Convert deaultUnits to 'pBC' ['mmHG']
-                        for v in G.vs:
-                            if v['pBC'] != None:
-                                v['pBC']=v['pBC']/self._scaleToDef
-                            v['pressure']=v['pressure']/self._scaleToDef
-                        g_output.write_pkl(self._sampledict,filename1)
-                        vgm.write_pkl(G,filename2)
+                        if self._backupFormat == 'checkpoint':
+                            self._write_pkl(self._sampledict,filename1)
+                            self._write_checkpoint(filename2)
+                        else:
+                            #Convert deaultUnits to 'pBC' ['mmHG']
+                            for v in G.vs:
+                                if v['pBC'] != None:
+                                    v['pBC']=v['pBC']/self._scaleToDef
+                                v['pressure']=v['pressure']/self._scaleToDef
+                            self._write_pkl(self._sampledict,filename1)
+                            self._write_pkl(G,filename2)
+                            #Convert 'pBC' ['mmHG'] to default Units
+                            for v in G.vs:
+                                if v['pBC'] != None:
+                                    v['pBC']=v['pBC']*self._scaleToDef
+                                v['pressure']=v['pressure']*self._scaleToDef
+                        if self._sampleWriter is not None:
+                            self._sampleWriter.flush()
                         self._sampledict = {}
                         self._sampledict['averagedCount']=G['averagedCount']
-                        #Convert 'pBC' ['mmHG'] to default Units
-                        for v in G.vs:
-                            if v['pBC'] != None:
-                                v['pBC']=v['pBC']*self._scaleToDef
-                            v['pressure']=v['pressure']*self._scaleToDef
+                        self._sampler.reset()
                         BackUpCounter += 1
                         BackUpTStart += BackUpT
                         print('BackUp Done')
@@ -4180,7 +4342,12 @@ class LinearSystemHtdTotFixedDT(object):
             stdout.flush()
             self._propagate_rbc()
             print('RBCs propagated')
-            self._update_hematocrit(self._edgeUpdate)
+            htt, htd, changed = self._update_hematocrit(self._edgeUpdate)
+            # The effective resistance only needs to be updated at edges
+            # whose hematocrit has changed:
+            self._vertexUpdate = np.unique(np.concatenate(
+                [self._assembler.source[changed],
+                 self._assembler.target[changed]]))
             print('Hematocrit updated')
             tPlot = tPlot + self._dt
             self._tPlot = tPlot
@@ -4203,13 +4370,14 @@ class LinearSystemHtdTotFixedDT(object):
 
         self._update_eff_resistance_and_LS(None)
         self._solve(method, **kwargs)
-        self._G.vs['pressure'] = self._x[:]
+        self._state.pressure[:] = self._x
         print('Pressure copied')
         self._update_flow_and_velocity()
         self._update_flow_sign()
         self._update_out_and_inflows_for_vertices()
         self._verify_mass_balance()
         print('Mass balance verified updated')
+        self._state.store_to_graph(G)
         self._t=t
         self._tSample=tSample
         stdout.flush()
@@ -4222,8 +4390,10 @@ class LinearSystemHtdTotFixedDT(object):
         #G['iterFinalPlot']=tPlot
         G['iterFinalSample']=tSample
         G['BackUpCounter']=BackUpCounter
+        if method == 'iterative2':
+            print(self._amgSolver.report())
         filename1='sampledict_BackUp_'+str(BackUpCounter)+'.pkl'
-        filename2='G_BackUp'+str(BackUpCounter)+'.pkl'
+        filename2='G_BackUp'+str(BackUpCounter)+self._backup_extension()
         #if doPlotting:
         #    filename= 'iter_'+str(int(round(tPlot+1)))+'.vtp'
         #    filenamelist.append(filename)
@@ -4239,10 +4409,20 @@ class LinearSystemHtdTotFixedDT(object):
                     v['pBC']=v['pBC']/self._scaleToDef
                 v['pressure']=v['pressure']/self._scaleToDef
             self._sample_average()
-            g_output.write_pkl(self._sampledict, 'sampledict.pkl')
-            g_output.write_pkl(self._sampledict,filename1)
-        vgm.write_pkl(G, 'G_final.pkl')
-        vgm.write_pkl(G,filename2)
+            self._write_pkl(self._sampledict, 'sampledict.pkl')
+            self._write_pkl(self._sampledict,filename1)
+        if self._sampleWriter is not None:
+            self._sampleWriter.flush()
+        self._write_pkl(G, 'G_final.pkl')
+        if self._backupFormat == 'checkpoint':
+            self._write_checkpoint(filename2)
+        else:
+            self._write_pkl(G,filename2)
+        # All files are complete when evolve returns, the writer thread is
+        # stopped (and started again by the next write):
+        if self._asyncWriter is not None:
+            self._asyncWriter.close()
+            print(self._asyncWriter.report())
 
     #--------------------------------------------------------------------------
 
@@ -4291,107 +4471,252 @@ class LinearSystemHtdTotFixedDT(object):
     
     def _sample(self):
         """Takes a snapshot of relevant current data and adds it to the sample
-        database.
+        database. The running averages are updated in place, the raw
+        snapshots are kept as specified by sampleBufferSize (they are copied
+        to self._sampledict by _sample_average, before it is written).
         INPUT: None
-        OUTPUT: None, data added to self._sampledict
+        OUTPUT: None, data added to self._sampler
         """
-        sampledict = self._sampledict
         G = self._G
-        invivo = self._invivo
-        
-        htt2htd = self._P.tube_to_discharge_hematocrit
-        du = self._G['defaultUnits']
-        scaleToDef=self._scaleToDef
+        state = self._state
+        state.store_to_graph(G)
+
+        values = {'flow': state.flow, 'v': state.v, 'htt': state.htt,
+                  'htd': state.htd, 'nRBC': G.es['nRBC'],
+                  'effResistance': state.effResistance}
         #Convert default units to ['mmHG']
-        pressure=np.array([1/scaleToDef]*G.vcount())*G.vs['pressure']
-        
-        for eprop in ['flow', 'v', 'htt', 'htd','nRBC','effResistance']:
-            if not eprop in sampledict.keys():
-                sampledict[eprop] = []
-            sampledict[eprop].append(G.es[eprop])
-        for vprop in ['pressure']:
-            if not vprop in sampledict.keys():
-                sampledict[vprop] = []
-            sampledict[vprop].append(pressure)
-        if not 'time' in sampledict.keys():
-            sampledict['time'] = []
-        sampledict['time'].append(self._tSample)
+        values['pressure'] = (1 / self._scaleToDef) * state.pressure
+        sampler = self._sampler
+        sampler.add(values, self._tSample)
+        if self._sampleWriter is not None:
+            self._sampleWriter.append(values, self._tSample)
 
     #--------------------------------------------------------------------------
 
     def _sample_average(self):
-        """Averages the self._sampleDict data and writes it to disc.
-        INPUT: sampleAvgFilename: Name of the sample average out-file.
+        """Combines the running averages of the samples taken since the last
+        backup with the averages of previous backups (weighted by their
+        number of samples) and writes them to G and to self._sampledict.
+        The variances and the retained raw snapshots of the samples since
+        the last backup are added to self._sampledict as well.
+        INPUT: None
         OUTPUT: None
         """
         sampledict = self._sampledict
         G = self._G
+        sampler = self._sampler
         if 'averagedCount' in sampledict.keys():
             avCount=sampledict['averagedCount']
         else:
             avCount = 0
-        avCountNew=len(sampledict['time'])
-        avCountE=np.array([avCount]*G.ecount())
-        avCountNewE=np.array([avCountNew]*G.ecount())
-        for eprop in ['flow', 'v', 'htt', 'htd','nRBC','effResistance']:
-            if eprop+'_avg' in G.es.attribute_names():
-                G.es[eprop + '_avg'] = (avCountE*G.es[eprop+'_avg']+ \
-                    avCountNewE*np.average(sampledict[eprop], axis=0))/(avCountE+avCountNewE)
-            else:
-                G.es[eprop + '_avg'] = np.average(sampledict[eprop], axis=0)
-            #if not [eprop + '_avg'] in sampledict.keys():
-            #    sampledict[eprop + '_avg']=[]
-            sampledict[eprop + '_avg']=G.es[eprop + '_avg']
-        avCountV=np.array([avCount]*G.vcount())
-        avCountNewV=np.array([avCountNew]*G.vcount())
-        for vprop in ['pressure']:
-            if vprop+'_avg' in G.vs.attribute_names():
-                G.vs[vprop + '_avg'] = (avCountV*G.vs[vprop+'_avg']+ \
-                    avCountNewV*np.average(sampledict[vprop], axis=0))/(avCountV+avCountNewV)
-            else:
-                G.vs[vprop + '_avg'] = np.average(sampledict[vprop], axis=0)
-            #if not [vprop + '_avg'] in sampledict.keys():
-            #    sampledict[vprop + '_avg']=[]
-            sampledict[vprop + '_avg']=G.vs[vprop + '_avg']
+        avCountNew = sampler.count
+        if avCountNew == 0:
+            return
+        for prop in self._sampledEdgeProps + ['pressure']:
+            sampledict[prop] = sampler.history(prop)
+        sampledict['time'] = sampler.times()
+        for seq, props in [(G.es, self._sampledEdgeProps),
+                           (G.vs, ['pressure'])]:
+            mean = dict([(prop, sampler.mean(prop)) for prop in props])
+            for prop in props:
+                if prop + '_avg' in seq.attribute_names():
+                    seq[prop + '_avg'] = (avCount * np.array(seq[prop + '_avg'])
+                        + avCountNew * mean[prop]) / (avCount + avCountNew)
+                else:
+                    seq[prop + '_avg'] = mean[prop]
+                sampledict[prop + '_avg'] = seq[prop + '_avg']
+                sampledict[prop + '_var'] = sampler.variance(prop)
         sampledict['averagedCount']=avCount + avCountNew
         G['averagedCount']=avCount + avCountNew
 
 
+    #--------------------------------------------------------------------------
+
+    def _write_pkl(self, data, filename):
+        """Pickles data (e.g. G or the sample database) to a file, in the
+        background if asyncWrite is set. In the latter case, the data is
+        pickled immediately, i.e. it may be modified once this returns.
+        INPUT: data: Object to be pickled.
+               filename: Name of the output file.
+        OUTPUT: None, file written to disk.
+        """
+        if self._asyncWriter is None:
+            g_output.write_pkl(data, filename)
+        else:
+            self._asyncWriter.write_bytes(filename,
+                                          cPickle.dumps(data, protocol=2))
+
+    #--------------------------------------------------------------------------
+
+    def _backup_extension(self):
+        """Returns the file extension of the backups of G.
+        INPUT: None
+        OUTPUT: '.pkl' or '.ckpt', depending on the backup format.
+        """
+        if self._backupFormat == 'checkpoint':
+            return '.ckpt'
+        return '.pkl'
+
+    #--------------------------------------------------------------------------
+
+    def _write_checkpoint(self, filename):
+        """Writes the mutable simulation state to a checkpoint file (see
+        checkpoint). The static graph is pickled once per content hash, as
+        'G_static_<hash>.pkl', with 'pBC' and 'pressure' in mmHg.
+        INPUT: filename: Name of the checkpoint file.
+        OUTPUT: None, files written to disk.
+        """
+        G = self._G
+        state = self._state
+        arrays = {}
+        rRBC = G.es['rRBC']
+        arrays['rbcCount'] = np.array([len(r) for r in rRBC], dtype=np.int64)
+        if arrays['rbcCount'].sum() > 0:
+            arrays['rbcPositions'] = np.concatenate(rRBC).astype(float)
+        else:
+            arrays['rbcPositions'] = np.zeros(0)
+        # Flow, velocity and hematocrit are recomputed from the pressure and
+        # the RBC positions on restart:
+        for name in ['pressure', 'sign']:
+            arrays['state_' + name] = getattr(state, name).copy()
+        for seq, props, prefix in [(G.es, self._checkpointEdgeProps, 'e_'),
+                                   (G.vs, self._checkpointVertexProps, 'v_')]:
+            attributes = seq.attribute_names()
+            for name in props:
+                if name in attributes:
+                    arrays[prefix + name] = optional_to_array(seq[name])
+        attributes = G.es.attribute_names()
+        for name, width in self._checkpointSequenceProps.items():
+            if name in attributes:
+                arrays['e_' + name] = optional_to_array(G.es[name], width)
+        # Averages of previous samples:
+        for seq, props, prefix in [(G.es, self._sampledEdgeProps, 'eavg_'),
+                                   (G.vs, ['pressure'], 'vavg_')]:
+            attributes = seq.attribute_names()
+            for name in props:
+                if name + '_avg' in attributes:
+                    arrays[prefix + name] = np.array(seq[name + '_avg'],
+                                                     dtype=float)
+        rng = np.random.get_state()
+        arrays['rngKeys'] = rng[1]
+
+        ghash = graph_hash(G)
+        staticGraph = 'G_static_' + ghash[:16] + '.pkl'
+        if staticGraph not in self._staticGraphs and \
+           not os.path.exists(staticGraph):
+            # The units of 'pBC' and 'pressure' in G depend on the caller
+            # (default units during evolve, mmHg after the final sample),
+            # the default unit values of the last assembly and of the state
+            # are converted instead:
+            pBCVertices = self._assembler.pBCVertices.tolist()
+            pBC = G.vs[pBCVertices]['pBC']
+            pressure = G.vs['pressure']
+            G.vs[pBCVertices]['pBC'] = (self._pBC/self._scaleToDef).tolist()
+            G.vs['pressure'] = (state.pressure/self._scaleToDef).tolist()
+            self._write_pkl(G, staticGraph)
+            self._staticGraphs.add(staticGraph)
+            G.vs[pBCVertices]['pBC'] = pBC
+            G.vs['pressure'] = pressure
+        header = {'graphHash': ghash, 'staticGraph': staticGraph,
+                  'rngAlgorithm': rng[0], 'rngPos': int(rng[2]),
+                  'rngHasGauss': int(rng[3]), 'rngGauss': float(rng[4])}
+        for name in self._checkpointGraphProps:
+            if name in G.attributes():
+                header[name] = np.asarray(G[name]).item()
+        # All arrays are copies, i.e. they can be written in the background:
+        if self._asyncWriter is None:
+            write_checkpoint(filename, arrays, header)
+        else:
+            self._asyncWriter.submit(write_checkpoint, filename, arrays,
+                                     header)
+
+    #--------------------------------------------------------------------------
+
+    def _restore_checkpoint(self, filename):
+        """Restores the mutable simulation state of a checkpoint written by
+        _write_checkpoint to the graph properties, which are then read by
+        __init__ (as for a restart from a pickled G).
+        INPUT: filename: Name of the checkpoint file.
+        OUTPUT: State of the random number generator at the time of the
+                checkpoint (see np.random.set_state).
+        """
+        G = self._G
+        arrays, header = read_checkpoint(filename)
+        if graph_hash(G) != header['graphHash']:
+            raise ValueError('The checkpoint %s does not belong to this graph (see %s)' \
+                % (filename, header['staticGraph']))
+        bounds = np.cumsum(arrays['rbcCount'])[:-1]
+        G.es['rRBC'] = np.split(arrays['rbcPositions'], bounds)
+        G.es['nRBC'] = arrays['rbcCount'].tolist()
+        G.es['sign'] = arrays['state_sign'].tolist()
+        # G holds the pressure in mmHg, as in a pickled backup:
+        G.vs['pressure'] = (arrays['state_pressure']/self._scaleToDef).tolist()
+        for seq, props, prefix in [(G.es, self._checkpointEdgeProps, 'e_'),
+                                   (G.vs, self._checkpointVertexProps, 'v_')]:
+            for name in props:
+                if not arrays.has_key(prefix + name):
+                    continue
+                values = array_to_optional(arrays[prefix + name])
+                if name in self._checkpointIntProps:
+                    values = [None if x is None else int(x) for x in values]
+                seq[name] = values
+        for name in self._checkpointSequenceProps:
+            if arrays.has_key('e_' + name):
+                G.es[name] = array_to_optional(arrays['e_' + name],
+                                               sequence=(name == 'keep_rbcs'))
+        # The inlet properties above are restored, i.e. they must not be
+        # reinitialized by __init__:
+        G.es['posFirstLast'] = [None] * G.ecount()
+        for seq, props, prefix in [(G.es, self._sampledEdgeProps, 'eavg_'),
+                                   (G.vs, ['pressure'], 'vavg_')]:
+            for name in props:
+                if arrays.has_key(prefix + name):
+                    seq[name + '_avg'] = arrays[prefix + name].tolist()
+        for name in self._checkpointGraphProps:
+            if header.has_key(name):
+                G[name] = header[name]
+        return (str(header['rngAlgorithm']), arrays['rngKeys'],
+                header['rngPos'], header['rngHasGauss'], header['rngGauss'])
+
     #--------------------------------------------------------------------------
     #@profile
     def _solve(self, method, **kwargs):
         """Solves the linear system A x = b using a direct or AMG solver.
-        INPUT: method: This can be either 'direct' or 'iterative'
+        INPUT: method: This can be either 'direct', 'iterative',
+                       'iterative2' or 'incremental'. The latter keeps an LU
+                       factorization of A and applies low-rank updates for
+                       the edges whose conductance has changed.
                **kwargs
-               precision: The accuracy to which the ls is to be solved. If not
-                          supplied, machine accuracy will be used. (This only
-                          applies to the iterative solver)
+               precision: The relative residual norm(b - A x) / norm(b) to
+                          which the ls is to be solved. If not supplied,
+                          self._eps will be used. (This only applies to the
+                          iterative solvers, which are warm started from the
+                          pressures of the previous timestep)
         OUTPUT: None, self._x is updated.
         """
-        A = self._A.tocsr()
+        A = self._A
+        x0 = self._x
+        if kwargs.has_key('precision'):
+            tol = kwargs['precision']
+        else:
+            tol = self._eps
         if method == 'direct':
             linalg.use_solver(useUmfpack=True)
             x = linalg.spsolve(A, self._b)
+        elif method == 'incremental':
+            x = self._incrementalSolver.solve(A, self._b, self._conductance)
         elif method == 'iterative':
-            if kwargs.has_key('precision'):
-                eps = kwargs['precision']
-            else:
-                eps = finfo(float).eps
             #AA = ruge_stuben_solver(A)
             AA = smoothed_aggregation_solver(A, max_levels=10, max_coarse=500)
             #PC = AA.aspreconditioner(cycle='V')
             #x,info = linalg.cg(A, self._b, tol=eps, maxiter=30, M=PC)
             #(x,flag) = pyamg.krylov.fgmres(A,self._b, maxiter=30, tol=eps)
             #x = abs(AA.solve(self._b, tol=self._eps/10000000000000000000, accel='cg')) # abs required, as (small) negative pressures may arise
-            x = abs(AA.solve(self._b, tol=self._eps/10000000, accel='cg')) # abs required, as (small) negative pressures may arise
+            x = abs(AA.solve(self._b, x0=x0, tol=tol, accel='cg')) # abs required, as (small) negative pressures may arise
         elif method == 'iterative2':
-         # Set linear solver
-             ml = rootnode_solver(A, smooth=('energy', {'degree':2}), strength='evolution' )
-             M = ml.aspreconditioner(cycle='V')
-             # Solve pressure system
-             #counter=gmres_counter()
-             #x,info = gmres(A, self._b, tol=self._eps/10000, maxiter=200, M=M,callback=counter)
-             x,info = gmres(A, self._b, tol=self._eps/10000, maxiter=200, M=M)
+         # The AMG hierarchy is reused as long as it remains a good
+         # preconditioner for the current matrix
+             x,info = self._amgSolver.solve(A, self._b, x0=x0, tol=tol, maxiter=200)
              if info != 0:
                  print('SOLVEERROR in Solving the Matrix')
                  print(info)
@@ -4409,18 +4734,26 @@ class LinearSystemHtdTotFixedDT(object):
         OUTPUT: None (result added as vertex property)
         """
         G = self._G
-        G.vs['flowSum'] = [sum([G.es[e]['flow'] * np.sign(G.vs[v]['pressure'] -
-                                                    G.vs[n]['pressure'])
-                               for e, n in zip(G.adjacent(v), G.neighbors(v))])
-                           for v in xrange(G.vcount())]
-        for i in xrange(G.vcount()):
-            if G.vs[i]['flowSum'] > 5e-4 and i not in G['av'] and i not in G['vv']:
-                print('')
-                print(i)
-                print(G.vs['flowSum'][i])
-                print('FLOWERROR')
-                for j in G.adjacent(i):
-                    print(G.es['flow'][j])
+        nV = G.vcount()
+        source = self._assembler.source
+        target = self._assembler.target
+        pressure = self._state.pressure
+        flow = self._state.flow
+        # Flow leaving the source vertex of each edge:
+        outflow = flow * np.sign(pressure[source] - pressure[target])
+        flowSum = np.bincount(source, weights=outflow, minlength=nV) - \
+                  np.bincount(target, weights=outflow, minlength=nV)
+        G.vs['flowSum'] = flowSum.tolist()
+        isBoundary = np.zeros(nV, dtype=bool)
+        isBoundary[G['av']] = True
+        isBoundary[G['vv']] = True
+        for i in np.nonzero((flowSum > 5e-4) & ~isBoundary)[0].tolist():
+            print('')
+            print(i)
+            print(flowSum[i])
+            print('FLOWERROR')
+            for j in G.adjacent(i):
+                print(flow[j])
 
     #--------------------------------------------------------------------------
 
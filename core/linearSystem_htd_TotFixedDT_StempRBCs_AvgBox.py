@@ -5813,26 +5813,29 @@ class LinearSystemHtdTotFixedDTStempAvgBox(object):
         """Solves the linear system A x = b using a direct or AMG solver.
         INPUT: method: This can be either 'direct' or 'iterative'
                **kwargs
-               precision: The accuracy to which the ls is to be solved. If not
-                          supplied, machine accuracy will be used. (This only
-                          applies to the iterative solver)
+               precision: The relative residual norm(b - A x) / norm(b) to
+                          which the ls is to be solved. If not supplied,
+                          self._eps will be used. (This only applies to the
+                          iterative solvers, which are warm started from the
+                          pressures of the previous timestep)
         OUTPUT: None, self._x is updated.
         """
         A = self._A.tocsr()
+        x0 = self._x
+        if kwargs.has_key('precision'):
+            tol = kwargs['precision']
+        else:
+            tol = self._eps
         if method == 'direct':
             linalg.use_solver(useUmfpack=True)
             x = linalg.spsolve(A, self._b)
         elif method == 'iterative':
-            if kwargs.has_key('precision'):
-                eps = kwargs['precision']
-            else:
-                eps = finfo(float).eps
             #AA = ruge_stuben_solver(A)
             AA = smoothed_aggregation_solver(A, max_levels=10, max_coarse=500)
             #PC = AA.aspreconditioner(cycle='V')
             #x,info = linalg.cg(A, self._b, tol=eps, maxiter=30, M=PC)
             #(x,flag) = pyamg.krylov.fgmres(A,self._b, maxiter=30, tol=eps)
-            x = abs(AA.solve(self._b, tol=self._eps/10000000000000000000, accel='cg')) # abs required, as (small) negative pressures may arise
+            x = abs(AA.solve(self._b, x0=x0, tol=tol, accel='cg')) # abs required, as (small) negative pressures may arise
         elif method == 'iterative2':
          # Set linear solver
              ml = rootnode_solver(A, smooth=('energy', {'degree':2}), strength='evolution' )
@@ -5840,7 +5843,7 @@ class LinearSystemHtdTotFixedDTStempAvgBox(object):
              # Solve pressure system
              #x,info = gmres(A, self._b, tol=self._eps, maxiter=50, M=M, x0=self._x)
              #x,info = gmres(A, self._b, tol=self._eps/10000000000000, maxiter=50, M=M)
-             x,info = gmres(A, self._b, tol=self._eps/10000, maxiter=50, M=M)
+             x,info = gmres(A, self._b, x0=x0, tol=tol, maxiter=50, M=M)
              if info != 0:
                  print('SOLVEERROR in Solving the Matrix')
              test = A * x
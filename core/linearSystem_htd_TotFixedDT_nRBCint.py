@@ -32,6 +32,7 @@ import pdb
 import run_faster
 import time as ttime
 import vgm
+from rbcPlacement import place_rbcs, split_positions
 
 __all__ = ['LinearSystemHtdTotFixedDTnRBCint']
 log = vgm.LogDispatcher.create_logger(__name__)
@@ -77,6 +78,9 @@ class LinearSystemHtdTotFixedDTnRBCint(object):
                analyzeCapDil: edge index of dilated capillary should be given. Upstream divergent bifurcations
                    will be analyzed
                species: 'rat', 'mouse' or 'human', default is 'rat'
+               rbcSeed: Seed of the counter-based random stream from which
+                   the initial RBC positions are drawn (see rbcPlacement,
+                   Default = None, i.e. np.random)
         OUTPUT: None, however the following items are created:
                 self.A: Matrix A of the linear system, holding the conductance
                         information.
@@ -252,22 +256,28 @@ class LinearSystemHtdTotFixedDTnRBCint(object):
             if kwargs.has_key('ht0'):
                 ht0=kwargs['ht0']
             if ht0 != 'current':
-                for e in G.es:
-                    lrbc = e['minDist']
-                    Nmax = max(int(np.floor(e['nMax'])), 1)
-                    if e['httBC'] is not None:
-                        N = int(np.round(e['httBC'] * Nmax))
-                    else:
-                        if kwargs.has_key('hd0'):
-                            ht0=self._P.discharge_to_tube_hematocrit(hd0,e['diameter'],invivo)
-                        N = int(np.round(ht0 * Nmax))
-                    indices = sorted(np.random.permutation(Nmax)[:N])
-                    e['rRBC'] = np.array(indices) * lrbc + lrbc / 2.0
+                if kwargs.has_key('hd0'):
+                    htt = self._P.discharge_to_tube_hematocrit_array(
+                        hd0 * np.ones(G.ecount()),
+                        np.array(G.es['diameter']), invivo)
+                else:
+                    htt = ht0 * np.ones(G.ecount())
+                htt = np.array([h if hBC is None else hBC
+                                for h, hBC in zip(htt, G.es['httBC'])])
+                nSlots = np.maximum(np.floor(G.es['nMax']), 1)
+                if kwargs.has_key('rbcSeed'):
+                    rbcSeed = kwargs['rbcSeed']
+                else:
+                    rbcSeed = None
+                positions, count = place_rbcs(nSlots, np.round(htt * nSlots),
+                                              G.es['minDist'], rbcSeed)
+                G.es['rRBC'] = split_positions(positions, count)
             #in every edge with httBC should be at least on RBC in the initial state. This is necessary to
             #properly initialize v_last
             httBC_edges = G.es(httBC_ne=None)
             for e in httBC_edges:
                 if len(e['rRBC']) == 0:
+                    lrbc = e['minDist']
                     Nmax = max(int(np.floor(e['nMax'])), 1)
                     N=1
                     indices = sorted(np.random.permutation(Nmax)[:N])
@@ -5061,26 +5071,29 @@ class LinearSystemHtdTotFixedDTnRBCint(object):
         """Solves the linear system A x = b using a direct or AMG solver.
         INPUT: method: This can be either 'direct' or 'iterative'
                **kwargs
-               precision: The accuracy to which the ls is to be solved. If not
-                          supplied, machine accuracy will be used. (This only
-                          applies to the iterative solver)
+               precision: The relative residual norm(b - A x) / norm(b) to
+                          which the ls is to be solved. If not supplied,
+                          self._eps will be used. (This only applies to the
+                          iterative solvers, which are warm started from the
+                          pressures of the previous timestep)
         OUTPUT: None, self._x is updated.
         """
         A = self._A.tocsr()
+        x0 = self._x
+        if kwargs.has_key('precision'):
+            tol = kwargs['precision']
+        else:
+            tol = self._eps
         if method == 'direct':
             linalg.use_solver(useUmfpack=True)
             x = linalg.spsolve(A, self._b)
         elif method == 'iterative':
-            if kwargs.has_key('precision'):
-                eps = kwargs['precision']
-            else:
-                eps = finfo(float).eps
             #AA = ruge_stuben_solver(A)
             AA = smoothed_aggregation_solver(A, max_levels=10, max_coarse=500)
             #PC = AA.aspreconditioner(cycle='V')
             #x,info = linalg.cg(A, self._b, tol=eps, maxiter=30, M=PC)
             #(x,flag) = pyamg.krylov.fgmres(A,self._b, maxiter=30, tol=eps)
-            x = abs(AA.solve(self._b, tol=self._eps/10000000000000000000, accel='cg')) # abs required, as (small) negative pressures may arise
+            x = abs(AA.solve(self._b, x0=x0, tol=tol, accel='cg')) # abs required, as (small) negative pressures may arise
         elif method == 'iterative2':
          # Set linear solver
              ml = rootnode_solver(A, smooth=('energy', {'degree':2}), strength='evolution' )
@@ -5088,7 +5101,7 @@ class LinearSystemHtdTotFixedDTnRBCint(object):
              # Solve pressure system
              #x,info = gmres(A, self._b, tol=self._eps, maxiter=50, M=M, x0=self._x)
              #x,info = gmres(A, self._b, tol=self._eps/10000000000000, maxiter=50, M=M)
-             x,info = gmres(A, self._b, tol=self._eps/10000, maxiter=50, M=M)
+             x,info = gmres(A, self._b, x0=x0, tol=tol, maxiter=50, M=M)
              if info != 0:
                  print('SOLVEERROR in Solving the Matrix')
              test = A * x
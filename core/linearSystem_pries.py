@@ -10,6 +10,7 @@ from scipy import array, finfo, ones, sparse, zeros
 from scipy.sparse import lil_matrix, linalg
 import copy
 from physiology import Physiology
+from rheologyCache import RheologyCache
 import g_output
 import vgm
 
@@ -81,6 +82,8 @@ class LinearSystemPries(object):
         else:
             self._species='rat'
 
+        self._rheology = RheologyCache(self._P, invivo)
+
         # Discharge hematocrit boundary conditions:
         if not 'htdBC' in G.vs.attribute_names():
             for vi in G['av']:
@@ -155,11 +158,15 @@ class LinearSystemPries(object):
         P = self._P
         invivo=self._invivo
         cond = P.conductance
-        nublood = P.dynamic_blood_viscosity
-
-        G.es['conductance'] = [cond(e['diameter'], e['length'],
-                               nublood(e['diameter'], invivo,discharge_ht=e['htd'],plasmaType=self._plasmaType))
-                               for e in G.es]
+        sf = P._sf['um -> du']
+
+        # Blood viscosity as in P.dynamic_blood_viscosity:
+        diameter = np.array(G.es['diameter'], dtype=float)
+        nublood = self._rheology.relative_apparent_blood_viscosity(
+            np.arange(G.ecount()), np.clip(diameter, 3.3*sf, 1978.0*sf),
+            G.es['htd']) * P.dynamic_plasma_viscosity(plasmaType=self._plasmaType)
+        G.es['conductance'] = [cond(d, l, nu) for d, l, nu in
+                               zip(G.es['diameter'], G.es['length'], nublood)]
         G.es['conductance'] = [max(min(c, 1e5), 1e-5)
                                for c in G.es['conductance']]
 
@@ -380,36 +387,38 @@ class LinearSystemPries(object):
     def _linear_analysis(self, method, **kwargs):
         """Performs the linear analysis, in which the pressure and flow fields
         are computed.
-        INPUT: method: This can be either 'direct' or 'iterative'
+        INPUT: method: This can be either 'direct', 'iterative' or
+                       'iterative2'
                **kwargs
-               precision: The accuracy to which the ls is to be solved. If not
-                          supplied, machine accuracy will be used. (This only
-                          applies to the iterative solver)
+               precisionLS: The relative residual norm(b - A x) / norm(b) to
+                            which the ls is to be solved. If not supplied,
+                            self._eps / 1000 will be used. (This only applies
+                            to the iterative solvers, which are warm started
+                            from the pressures of the previous iteration)
         OUTPUT: The maximum, mean, and median pressure change. Moreover,
                 pressure and flow are modified in-place.
         """
 
         G = self._G
         A = self._A.tocsr()
+        if kwargs.has_key('precisionLS'):
+            eps = kwargs['precisionLS']
+        else:
+            eps = self._eps / 1000
+        x0 = np.array(G.vs['pressure'], dtype=float)
         if method == 'direct':
             linalg.use_solver(useUmfpack=True)
             x = linalg.spsolve(A, self._b)
         elif method == 'iterative':
-            if kwargs.has_key('precision'):
-                eps = kwargs['precision']
-            else:
-                eps = self._eps
             AA = smoothed_aggregation_solver(A, max_levels=10, max_coarse=500)
-            x = abs(AA.solve(self._b, x0=None, tol=eps, accel='cg', cycle='V', maxiter=150))
+            x = abs(AA.solve(self._b, x0=x0, tol=eps, accel='cg', cycle='V', maxiter=150))
             # abs required, as (small) negative pressures may arise
         elif method == 'iterative2':
          # Set linear solver
              ml = rootnode_solver(A, smooth=('energy', {'degree':2}), strength='evolution' )
              M = ml.aspreconditioner(cycle='V')
              # Solve pressure system
-             #x,info = gmres(A, self._b, tol=self._eps, maxiter=50, M=M, x0=self._x)
-             #x,info = gmres(A, self._b, tol=self._eps/10000000000000, maxiter=50, M=M)
-             x,info = gmres(A, self._b, tol=self._eps/10000, maxiter=50, M=M)
+             x,info = gmres(A, self._b, x0=x0, tol=eps, maxiter=50, M=M)
              if info != 0:
                  print('SOLVEERROR in Solving the Matrix')
 
@@ -497,8 +506,8 @@ class LinearSystemPries(object):
             log.info('median pressure change: %.2e\n' % medianPDiff)
             convergenceHistory.append((maxPDiff, meanPDiff, medianPDiff))
             iterationCount += 1
-            G.es['htt'] = [P.discharge_to_tube_hematocrit(e['htd'], e['diameter'],invivo)
-                           for e in G.es]
+            G.es['htt'] = self._rheology.discharge_to_tube_hematocrit(
+                np.arange(G.ecount()), G.es['htd'], G.es['diameter']).tolist()
             vrbc = P.rbc_volume(self._species)
             G.es['nMax'] = [np.pi * e['diameter']**2 / 4 * e['length'] / vrbc
                             for e in G.es]
@@ -512,8 +521,8 @@ class LinearSystemPries(object):
         elif maxPDiff <= precision :
             stdout.write("\rPrecision limit is reached\n")
         self.integrity_check()
-        G.es['htt'] = [P.discharge_to_tube_hematocrit(e['htd'], e['diameter'],invivo)
-                       for e in G.es]
+        G.es['htt'] = self._rheology.discharge_to_tube_hematocrit(
+            np.arange(G.ecount()), G.es['htd'], G.es['diameter']).tolist()
         vrbc = P.rbc_volume(self._species)
         G.es['nMax'] = [np.pi * e['diameter']**2 / 4 * e['length'] / vrbc
                         for e in G.es]
@@ -0,0 +1,138 @@
+"""This module places the initial red blood cells (RBCs) of the RBC tracking
+simulations. Every edge is divided into nSlots slots of length minDist, of
+which nRBC are occupied by an RBC, chosen at random. The RBCs are located at
+the centers of the slots.
+The slots are either drawn edge by edge from the global NumPy random number
+generator (np.random.permutation, the traditional approach), or from a
+seeded counter-based random stream: every slot of every edge receives a
+pseudo-random key that only depends on the seed, the edge index and the
+slot index (SplitMix64 hash), and the nRBC slots with the smallest keys are
+occupied. The latter is vectorized over all edges, and its results do not
+depend on the order in which the edges are processed or on the state of
+the global random number generator, i.e. they are reproducible across
+processes and platforms.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ['place_rbcs', 'split_positions']
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+#------------------------------------------------------------------------------
+
+
+def _splitmix64(x):
+    """Applies the SplitMix64 hash to an array of unsigned 64 bit integers
+    (overflow wraps around, as intended).
+    INPUT: x: Array of dtype uint64.
+    OUTPUT: Array of dtype uint64.
+    """
+    z = x + _GOLDEN
+    z = (z ^ (z >> np.uint64(30))) * _MIX1
+    z = (z ^ (z >> np.uint64(27))) * _MIX2
+    return z ^ (z >> np.uint64(31))
+
+#------------------------------------------------------------------------------
+
+
+def _seeded_slots(nSlots, nRBC, seed, chunkSize):
+    """Draws the occupied slots of all edges from the seeded stream.
+    INPUT: nSlots, nRBC: Arrays of the number of slots and RBCs of the
+                         edges.
+           seed: Non-negative integer seed.
+           chunkSize: Maximum number of slots processed at once.
+    OUTPUT: edges: Edge index of every occupied slot.
+            slots: Slot index of every occupied slot, ascending per edge.
+    """
+    nE = len(nSlots)
+    edgeKeys = _splitmix64(np.uint64(seed) ^ _splitmix64(
+        np.arange(nE).astype(np.uint64)))
+    bounds = np.zeros(nE + 1, dtype=np.int64)
+    np.cumsum(nSlots, out=bounds[1:])
+    nBits = int(max(nE - 1, 0)).bit_length()
+    # Split into chunks of at most chunkSize slots (but at least one edge):
+    chunks = [0]
+    while chunks[-1] < nE:
+        end = np.searchsorted(bounds, bounds[chunks[-1]] + chunkSize,
+                              side='right') - 1
+        chunks.append(max(end, chunks[-1] + 1))
+    edges, slots = [], []
+    for a, b in zip(chunks[:-1], chunks[1:]):
+        m = nSlots[a:b]
+        total = bounds[b] - bounds[a]
+        start = np.repeat(bounds[a:b] - bounds[a], m)
+        edge = np.repeat(np.arange(a, b), m)
+        slot = np.arange(total) - start
+        keys = _splitmix64(edgeKeys[edge] + slot.astype(np.uint64))
+        # Rank of every slot within its edge, by key. The local edge index
+        # is packed into the high bits of the key, such that a single
+        # (stable, i.e. platform independent) sort suffices. The number of
+        # key bits given up only depends on the number of edges, not on the
+        # chunks:
+        if nBits > 0:
+            keys = ((edge - a).astype(np.uint64) << np.uint64(64 - nBits)) | \
+                   (keys >> np.uint64(nBits))
+        order = np.argsort(keys, kind='mergesort')
+        rank = np.arange(total) - start
+        chosen = np.sort(order[rank < np.repeat(nRBC[a:b], m)])
+        edges.append(edge[chosen])
+        slots.append(slot[chosen])
+    if len(edges) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(edges), np.concatenate(slots)
+
+#------------------------------------------------------------------------------
+
+
+def place_rbcs(nSlots, nRBC, slotLength, seed=None, chunkSize=2**22):
+    """Places RBCs at random slots of the edges.
+    INPUT: nSlots: Array of the number of slots per edge.
+           nRBC: Array of the number of RBCs per edge (at most nSlots are
+                 placed).
+           slotLength: Array of the slot lengths (i.e. minDist) per edge.
+           seed: Non-negative integer seed of the counter-based random
+                 stream. (Optional, default=None, i.e. the slots are drawn
+                 edge by edge from the global NumPy random number
+                 generator.)
+           chunkSize: Maximum number of slots that are processed at once
+                      by the seeded stream (limits the memory footprint).
+    OUTPUT: positions: Array of the RBC positions of all edges, ordered by
+                       edge and ascending within an edge.
+            count: Array of the number of RBCs per edge.
+    """
+    nSlots = np.asarray(nSlots, dtype=np.int64)
+    nRBC = np.minimum(np.asarray(nRBC, dtype=np.int64), nSlots)
+    slotLength = np.asarray(slotLength, dtype=float)
+    if seed is None:
+        permutation = np.random.permutation
+        slots = [np.sort(permutation(m)[:n]) for m, n in
+                 zip(nSlots.tolist(), nRBC.tolist())]
+        count = np.array([len(s) for s in slots], dtype=np.int64)
+        if count.sum() == 0:
+            return np.zeros(0), count
+        slots = np.concatenate(slots)
+        edges = np.repeat(np.arange(len(nSlots)), count)
+    else:
+        edges, slots = _seeded_slots(nSlots, nRBC,
+                                     int(seed) & 0xFFFFFFFFFFFFFFFF,
+                                     chunkSize)
+        count = np.bincount(edges, minlength=len(nSlots)).astype(np.int64)
+    lrbc = slotLength[edges]
+    return slots * lrbc + lrbc / 2.0, count
+
+#------------------------------------------------------------------------------
+
+
+def split_positions(positions, count):
+    """Splits the flat array of RBC positions returned by place_rbcs into
+    one array per edge.
+    INPUT: positions: Array of the RBC positions of all edges.
+           count: Array of the number of RBCs per edge.
+    OUTPUT: List of arrays, the RBC positions of every edge.
+    """
+    bounds = np.cumsum(count)[:-1]
+    return np.split(np.asarray(positions, dtype=float), bounds)
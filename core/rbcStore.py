@@ -0,0 +1,248 @@
+"""This module provides a struct-of-arrays storage for the positions of the
+red blood cells (RBCs) in a vascular graph. Instead of one NumPy array per
+edge, all positions are kept in a single contiguous float64 buffer. Every
+edge owns a block of the buffer, described by its offset, its number of
+RBCs (count) and its capacity (count plus spare slots). The edge property
+'rRBC' holds views into this buffer, such that code operating on
+G.es['rRBC'] continues to work unchanged, while operations affecting all
+RBCs (e.g. moving them with the local velocity) are single vectorized
+operations on the buffer.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ['RBCStore']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class RBCStore(object):
+    """Contiguous storage of the RBC positions of all edges of a vascular
+    graph. The edge property 'rRBC' is replaced by views into the storage.
+    Changes that are made by assigning new arrays to 'rRBC' are copied back
+    to the storage by sync(). In-place changes of the views directly modify
+    the storage.
+    """
+    def __init__(self, G, capacity=None, spare=4, packed=None):
+        """Initializes an RBCStore instance from the edge property 'rRBC'
+        (or from RBC positions in the compact format of pack()).
+        INPUT: G: Vascular graph in iGraph format.
+               capacity: Array of the minimum number of RBCs that every edge
+                         should be able to hold without a relayout of the
+                         storage (e.g. the edge property 'nMax').
+                         (Optional, default=None.)
+               spare: Number of spare slots per edge in addition to the
+                      current number of RBCs. (Optional, default=4.)
+               packed: Tuple (positions, count) of the RBC positions in the
+                       compact format of pack(). If provided, the edge
+                       property 'rRBC' is not read. (Optional,
+                       default=None.)
+        OUTPUT: None, the edge property 'rRBC' is replaced by views.
+        """
+        self._nE = G.ecount()
+        self._spare = spare
+        if capacity is None:
+            self._minCapacity = np.zeros(self._nE, dtype=np.int64)
+        else:
+            self._minCapacity = np.ceil(np.asarray(capacity, dtype=float)
+                                        ).astype(np.int64)
+        if packed is None:
+            self.load(G)
+        else:
+            self.unpack(G, packed[0], packed[1])
+
+    #--------------------------------------------------------------------------
+
+    def _layout(self, positions, counts=None):
+        """Allocates the buffer and copies the RBC positions into it.
+        INPUT: positions: List of arrays, the RBC positions of every edge.
+                          Alternatively, a single array of all RBC positions,
+                          ordered by edge (requires counts).
+               counts: Array of the number of RBCs per edge. (Optional,
+                       default=None, i.e. given by positions.)
+        OUTPUT: None
+        """
+        nE = self._nE
+        if counts is None:
+            counts = np.array([len(p) for p in positions], dtype=np.int64)
+        else:
+            counts = np.array(counts, dtype=np.int64)
+            positions = [np.asarray(positions, dtype=float)]
+        capacity = np.maximum(counts + self._spare, self._minCapacity)
+        offset = np.zeros(nE + 1, dtype=np.int64)
+        np.cumsum(capacity, out=offset[1:])
+        buf = np.zeros(offset[-1])
+        # Slots that are not occupied by an RBC point to a dummy edge nE:
+        slotEdge = np.empty(offset[-1], dtype=np.int64)
+        slotEdge.fill(nE)
+        validEdges = np.repeat(np.arange(nE, dtype=np.int64), counts)
+        start = np.zeros(nE, dtype=np.int64)
+        np.cumsum(counts[:-1], out=start[1:])
+        validSlots = np.arange(counts.sum(), dtype=np.int64) + \
+                     np.repeat(offset[:-1] - start, counts)
+        slotEdge[validSlots] = validEdges
+        if len(validSlots) > 0:
+            buf[validSlots] = np.concatenate(positions)
+        self.buffer = buf
+        self.offset = offset[:-1]
+        self.count = counts
+        self.capacity = capacity
+        self._slotEdge = slotEdge
+        self._views = [buf[o:o+c] for o, c in zip(self.offset, counts)]
+
+    #--------------------------------------------------------------------------
+
+    def load(self, G):
+        """Copies all RBC positions from the edge property 'rRBC' into a new
+        buffer and replaces 'rRBC' by views into the buffer.
+        INPUT: G: Vascular graph in iGraph format.
+        OUTPUT: None
+        """
+        positions = [np.array(r, dtype=float).ravel() for r in G.es['rRBC']]
+        self._layout(positions)
+        G.es['rRBC'] = self._views
+
+    #--------------------------------------------------------------------------
+
+    def sync(self, G, edges=None):
+        """Copies the RBC positions of the edges whose property 'rRBC' has
+        been replaced (i.e. is not the view into the buffer anymore) back to
+        the buffer. If an edge exceeds its capacity, the whole buffer is
+        rebuilt from all edges (also those not in the list).
+        INPUT: G: Vascular graph in iGraph format.
+               edges: List of the edges to be checked. (Optional,
+                      default=None, i.e. all edges.)
+        OUTPUT: List of the edges that have been synchronized.
+        """
+        views = self._views
+        fullSync = edges is None
+        if fullSync:
+            edges = xrange(self._nE)
+            current = G.es['rRBC']
+        else:
+            current = dict(zip(edges, G.es[edges]['rRBC']))
+        changed = [i for i in edges if current[i] is not views[i]]
+        if len(changed) == 0:
+            return changed
+        # Copies are made first, as the new arrays may be views into the
+        # buffer themselves:
+        newPositions = [np.array(current[i], dtype=float).ravel()
+                        for i in changed]
+        if any([len(p) > self.capacity[i]
+                for i, p in zip(changed, newPositions)]):
+            # The rebuilt buffer replaces the arrays of all edges, i.e. the
+            # edges outside of the list need to be synchronized as well:
+            if not fullSync:
+                return self.sync(G)
+            positions = list(views)
+            for i, p in zip(changed, newPositions):
+                positions[i] = p
+            self._layout(positions)
+            G.es['rRBC'] = self._views
+            return changed
+        buf = self.buffer
+        for i, p in zip(changed, newPositions):
+            o = self.offset[i]
+            n = len(p)
+            buf[o:o+n] = p
+            self.count[i] = n
+        self.refresh(G, changed)
+        return changed
+
+    #--------------------------------------------------------------------------
+
+    def refresh(self, G, edges):
+        """Updates the bookkeeping and the views of edges whose RBCs have
+        been modified directly in the buffer, i.e. whose count has been
+        changed by the caller (e.g. by a compiled kernel).
+        INPUT: G: Vascular graph in iGraph format.
+               edges: List of the modified edges.
+        OUTPUT: None, the edge property 'rRBC' of the edges is replaced by
+                the new views.
+        """
+        buf = self.buffer
+        slotEdge = self._slotEdge
+        views = self._views
+        nE = self._nE
+        for i in edges:
+            o = self.offset[i]
+            n = self.count[i]
+            slotEdge[o:o+n] = i
+            slotEdge[o+n:o+self.capacity[i]] = nE
+            views[i] = buf[o:o+n]
+        G.es[edges]['rRBC'] = [views[i] for i in edges]
+
+    #--------------------------------------------------------------------------
+
+    def advect(self, displacement):
+        """Moves all RBCs by the displacement of their edge.
+        INPUT: displacement: Array of the displacement of the RBCs in every
+                             edge (e.g. v * dt * sign).
+        OUTPUT: None, the buffer is modified in place.
+        """
+        d = np.append(np.asarray(displacement, dtype=float), 0.0)
+        self.buffer += d[self._slotEdge]
+
+    #--------------------------------------------------------------------------
+
+    def edge_of_rbc(self):
+        """Returns the slot and edge indices of all stored RBCs.
+        INPUT: None
+        OUTPUT: slots: Indices of the occupied slots of the buffer.
+                edges: Edge index of every occupied slot.
+        """
+        slots = np.nonzero(self._slotEdge < self._nE)[0]
+        return slots, self._slotEdge[slots]
+
+    #--------------------------------------------------------------------------
+
+    def overshoots(self, length, sign):
+        """Counts the RBCs that have passed the outlet of their edge, i.e.
+        RBCs with a position > length (sign == 1) or < 0 (sign == -1). As the
+        RBCs of an edge are ordered, these are the last (first) RBCs of the
+        edge.
+        INPUT: length: Array of the edge lengths.
+               sign: Array of the flow directions of the edges.
+        OUTPUT: Array of the number of overshooting RBCs per edge.
+        """
+        slots, edges = self.edge_of_rbc()
+        pos = self.buffer[slots]
+        beyond = np.where(np.asarray(sign)[edges] == 1.0,
+                          pos > np.asarray(length)[edges], pos < 0)
+        return np.bincount(edges[beyond], minlength=self._nE)
+
+    #--------------------------------------------------------------------------
+
+    def positions(self, edge):
+        """Returns the RBC positions of an edge.
+        INPUT: edge: Edge index.
+        OUTPUT: View into the buffer holding the positions.
+        """
+        return self._views[edge]
+
+    #--------------------------------------------------------------------------
+
+    def pack(self):
+        """Returns the RBC positions in a compact format, suitable for
+        checkpointing.
+        INPUT: None
+        OUTPUT: positions: Array of all RBC positions, ordered by edge.
+                count: Array of the number of RBCs per edge.
+        """
+        slots = self.edge_of_rbc()[0]
+        return self.buffer[slots].copy(), self.count.copy()
+
+    #--------------------------------------------------------------------------
+
+    def unpack(self, G, positions, count):
+        """Restores the RBC positions from the compact format returned by
+        pack().
+        INPUT: G: Vascular graph in iGraph format.
+               positions: Array of all RBC positions, ordered by edge.
+               count: Array of the number of RBCs per edge.
+        OUTPUT: None, the buffer is rebuilt and 'rRBC' is replaced by views.
+        """
+        self._layout(positions, count)
+        G.es['rRBC'] = self._views
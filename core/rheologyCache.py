@@ -0,0 +1,135 @@
+"""This module provides an edge-level cache of the diameter dependent terms of
+the rheology functions of the Physiology class. The conversion from tube to
+discharge hematocrit and the relative apparent blood viscosity spend most of
+their time on terms that only depend on the vessel diameter (physical vessel
+diameter, hematocrit conversion factor, ESL thickness, viscosity at Ht=0.45
+and exponent c). These are computed once per edge, such that the evaluation
+for new hematocrit values reduces to a few arithmetic operations per edge.
+The coefficients are keyed by the diameter they were computed for: Edges
+whose diameter has changed since (e.g. in dilation experiments) are
+recomputed automatically on their next use.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ['RheologyCache']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class RheologyCache(object):
+    """Caches the diameter dependent coefficients of
+    tube_to_discharge_hematocrit and relative_apparent_blood_viscosity per
+    edge. The results are identical to those of the Physiology methods.
+    """
+    def __init__(self, P, invivo):
+        """Initializes a RheologyCache instance.
+        INPUT: P: Physiology instance.
+               invivo: Boolean, whether or not to consider ESL influence.
+        OUTPUT: None
+        """
+        self._P = P
+        self._invivo = invivo
+        # Coefficients and the diameters they were computed for, per
+        # function:
+        self._coef = {'hematocrit': np.zeros((0, 5)),
+                      'viscosity': np.zeros((0, 6))}
+        self._diameter = {'hematocrit': np.zeros(0),
+                          'viscosity': np.zeros(0)}
+        self._compute = {'hematocrit': P.hematocrit_coefficients,
+                         'viscosity': P.viscosity_coefficients}
+        self.stats = {'nRecomputed': 0}
+
+    #--------------------------------------------------------------------------
+
+    def invalidate(self, edges=None):
+        """Marks the coefficients of the given edges as invalid, such that
+        they are recomputed on their next use.
+        INPUT: edges: Sequence of edge indices. (Optional, default=None, i.e.
+                      all edges.)
+        OUTPUT: None
+        """
+        for key in self._diameter:
+            if edges is None:
+                self._diameter[key][:] = np.nan
+            else:
+                edges = np.asarray(edges, dtype=np.int64)
+                edges = edges[edges < len(self._diameter[key])]
+                self._diameter[key][edges] = np.nan
+
+    #--------------------------------------------------------------------------
+
+    def _coefficients(self, key, edges, diameter):
+        """Returns the coefficients of the given edges, recomputing those
+        whose diameter differs from the cached one.
+        INPUT: key: Either 'hematocrit' or 'viscosity'.
+               edges: Array of edge indices.
+               diameter: Array of the current diameters of the edges.
+        OUTPUT: Array of the coefficients of the edges.
+        """
+        edges = np.asarray(edges, dtype=np.int64)
+        diameter = np.asarray(diameter, dtype=float)
+        nE = edges.max() + 1 if len(edges) > 0 else 0
+        if nE > len(self._diameter[key]):
+            # The number of edges has grown (e.g. due to central_dilation):
+            n = len(self._diameter[key])
+            self._diameter[key] = np.concatenate(
+                [self._diameter[key], np.nan * np.ones(nE - n)])
+            self._coef[key] = np.concatenate(
+                [self._coef[key], np.zeros((nE - n,
+                                            self._coef[key].shape[1]))])
+        # Note that invalid (nan) diameters never compare equal:
+        stale = self._diameter[key][edges] != diameter
+        if np.any(stale):
+            staleEdges = edges[stale]
+            self._coef[key][staleEdges] = \
+                self._compute[key](diameter[stale], self._invivo)
+            self._diameter[key][staleEdges] = diameter[stale]
+            self.stats['nRecomputed'] += len(staleEdges)
+        return self._coef[key][edges]
+
+    #--------------------------------------------------------------------------
+
+    def tube_to_discharge_hematocrit(self, edges, tube_ht, diameter):
+        """Converts tube to discharge hematocrit (see
+        Physiology.tube_to_discharge_hematocrit).
+        INPUT: edges: Array of edge indices.
+               tube_ht: Array of the tube hematocrits of the edges.
+               diameter: Array of the diameters of the edges.
+        OUTPUT: Array of the discharge hematocrits of the edges.
+        """
+        coef = self._coefficients('hematocrit', edges, diameter)
+        return self._P.tube_to_discharge_hematocrit_coef(tube_ht, coef)
+
+    #--------------------------------------------------------------------------
+
+    def discharge_to_tube_hematocrit(self, edges, discharge_ht, diameter):
+        """Converts discharge to tube hematocrit (see
+        Physiology.discharge_to_tube_hematocrit). This conversion is explicit
+        and is not cached.
+        INPUT: edges: Array of edge indices. (Not used.)
+               discharge_ht: Array of the discharge hematocrits of the edges.
+               diameter: Array of the diameters of the edges.
+        OUTPUT: Array of the tube hematocrits of the edges.
+        """
+        return self._P.discharge_to_tube_hematocrit_array(discharge_ht,
+                                                          diameter,
+                                                          self._invivo)
+
+    #--------------------------------------------------------------------------
+
+    def relative_apparent_blood_viscosity(self, edges, diameter,
+                                          discharge_hematocrit):
+        """Computes the relative apparent blood viscosity (see
+        Physiology.relative_apparent_blood_viscosity).
+        INPUT: edges: Array of edge indices.
+               diameter: Array of the diameters of the edges.
+               discharge_hematocrit: Array of the discharge hematocrits of
+                                     the edges.
+        OUTPUT: Array of the relative apparent blood viscosities.
+        """
+        coef = self._coefficients('viscosity', edges, diameter)
+        return self._P.relative_apparent_blood_viscosity_coef(
+            discharge_hematocrit, coef, self._invivo)
@@ -0,0 +1,144 @@
+"""This module provides a sampler that accumulates running means and
+variances of vertex and edge properties (Welford's algorithm). Every sample
+is an in-place update of preallocated float64 arrays, i.e. its cost is
+proportional to the number of entries and does not grow with the number of
+samples taken. Optionally, the raw snapshots are retained: either all of
+them (in lists, as the traditional sample database) or the last N of them in
+a preallocated ring buffer, which bounds the memory footprint.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ['RunningSampler']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class RunningSampler(object):
+    """Running means and variances of a fixed set of properties, plus an
+    optional history of the raw snapshots.
+    """
+    def __init__(self, sizes, bufferSize=None):
+        """Initializes a RunningSampler instance.
+        INPUT: sizes: Dictionary of the sampled properties and their number
+                      of entries (e.g. {'flow': G.ecount(), 'pressure':
+                      G.vcount()}).
+               bufferSize: Number of raw snapshots retained. (Optional,
+                           default=None, i.e. all snapshots are retained. 0
+                           retains none.)
+        OUTPUT: None
+        """
+        self._sizes = dict(sizes)
+        self._bufferSize = bufferSize
+        self._mean = dict([(k, np.zeros(n)) for k, n in self._sizes.items()])
+        self._m2 = dict([(k, np.zeros(n)) for k, n in self._sizes.items()])
+        if bufferSize is not None:
+            self._ring = dict([(k, np.zeros((bufferSize, n)))
+                               for k, n in self._sizes.items()])
+            self._ringTime = np.zeros(bufferSize)
+        self.reset()
+
+    #--------------------------------------------------------------------------
+
+    def reset(self):
+        """Discards all samples taken so far.
+        INPUT: None
+        OUTPUT: None
+        """
+        self.count = 0
+        for k in self._sizes:
+            self._mean[k][:] = 0.0
+            self._m2[k][:] = 0.0
+        if self._bufferSize is None:
+            self._history = dict([(k, []) for k in self._sizes])
+            self._time = []
+        # Number of snapshots written to the ring buffer:
+        self._nWritten = 0
+
+    #--------------------------------------------------------------------------
+
+    def add(self, values, time):
+        """Adds a snapshot to the running statistics (and to the history).
+        INPUT: values: Dictionary of the current values of all sampled
+                       properties.
+               time: Time of the snapshot.
+        OUTPUT: None
+        """
+        self.count += 1
+        n = self.count
+        for k in self._sizes:
+            x = np.asarray(values[k])
+            mean = self._mean[k]
+            delta = x - mean
+            mean += delta / n
+            self._m2[k] += delta * (x - mean)
+            if self._bufferSize is None:
+                self._history[k].append(x.copy())
+            elif self._bufferSize > 0:
+                self._ring[k][self._nWritten % self._bufferSize] = x
+        if self._bufferSize is None:
+            self._time.append(time)
+        elif self._bufferSize > 0:
+            self._ringTime[self._nWritten % self._bufferSize] = time
+            self._nWritten += 1
+
+    #--------------------------------------------------------------------------
+
+    def mean(self, name):
+        """Returns the mean of a property over all snapshots.
+        INPUT: name: Name of the property.
+        OUTPUT: Array of the means (a copy).
+        """
+        return self._mean[name].copy()
+
+    #--------------------------------------------------------------------------
+
+    def variance(self, name):
+        """Returns the (population) variance of a property over all
+        snapshots.
+        INPUT: name: Name of the property.
+        OUTPUT: Array of the variances.
+        """
+        return self._m2[name] / max(self.count, 1)
+
+    #--------------------------------------------------------------------------
+
+    def _ring_order(self):
+        """Returns the ring buffer rows of the retained snapshots in
+        chronological order.
+        INPUT: None
+        OUTPUT: Array of row indices.
+        """
+        size = self._bufferSize
+        nRetained = min(self._nWritten, size)
+        return np.arange(self._nWritten - nRetained, self._nWritten) % size
+
+    #--------------------------------------------------------------------------
+
+    def history(self, name):
+        """Returns the retained raw snapshots of a property.
+        INPUT: name: Name of the property.
+        OUTPUT: The snapshots in chronological order. A list of arrays if all
+                snapshots are retained, otherwise a 2-D array with one row
+                per snapshot.
+        """
+        if self._bufferSize is None:
+            return self._history[name]
+        if self._bufferSize == 0:
+            return np.zeros((0, self._sizes[name]))
+        return self._ring[name][self._ring_order()]
+
+    #--------------------------------------------------------------------------
+
+    def times(self):
+        """Returns the times of the retained raw snapshots.
+        INPUT: None
+        OUTPUT: List of the snapshot times in chronological order.
+        """
+        if self._bufferSize is None:
+            return self._time
+        if self._bufferSize == 0:
+            return []
+        return self._ringTime[self._ring_order()].tolist()
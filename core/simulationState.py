@@ -0,0 +1,115 @@
+"""This module provides a container for the working state of the RBC tracking
+simulations. Pressure, flow, velocity, flow sign and hematocrit are held as
+float64 NumPy arrays (one entry per vertex or edge) instead of igraph
+attributes, which are lists of Python objects and need to be converted on
+every read and write. The topology of the graph (source and target of every
+edge and the vertex-edge incidence in compressed sparse row format) is
+extracted once. The arrays are synchronized with the graph attributes of the
+same name by load_from_graph() and store_to_graph() only, i.e. at
+initialization, sampling and backup time.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ['SimulationState']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class SimulationState(object):
+    """Typed array storage of the vertex and edge properties that are
+    updated in every timestep.
+    """
+    # Edge and vertex properties held by the state:
+    edgeFields = ['flow', 'v', 'vBulk', 'rbcFlow', 'rbcFlow2', 'sign',
+                  'signOld', 'htt', 'htd', 'effResistance']
+    vertexFields = ['pressure']
+
+    def __init__(self, G):
+        """Initializes a SimulationState instance. Properties that exist in
+        G are loaded, all others are set to nan.
+        INPUT: G: Vascular graph in iGraph format. The topology of G must not
+                  change during the lifetime of the state.
+        OUTPUT: None
+        """
+        self.nV = G.vcount()
+        self.nE = G.ecount()
+        if self.nE > 0:
+            edgelist = np.array(G.get_edgelist(), dtype=np.int64)
+        else:
+            edgelist = np.zeros((0, 2), dtype=np.int64)
+        self.source = edgelist[:, 0].copy()
+        self.target = edgelist[:, 1].copy()
+        # Adjacent edges of every vertex in the order of G.adjacent():
+        incidence = G.get_inclist()
+        self.degree = np.array([len(a) for a in incidence], dtype=np.int64)
+        self.offset = np.zeros(self.nV + 1, dtype=np.int64)
+        np.cumsum(self.degree, out=self.offset[1:])
+        self.adjacent = np.array([e for a in incidence for e in a],
+                                 dtype=np.int64)
+
+        for name in self.edgeFields:
+            setattr(self, name, np.nan * np.ones(self.nE))
+        for name in self.vertexFields:
+            setattr(self, name, np.nan * np.ones(self.nV))
+        self.load_from_graph(G)
+
+    #--------------------------------------------------------------------------
+
+    def _fields(self, fields):
+        """Splits a list of property names into edge and vertex properties.
+        INPUT: fields: List of property names. (None, i.e. all properties.)
+        OUTPUT: edgeFields, vertexFields: Lists of property names.
+        """
+        if fields is None:
+            return self.edgeFields, self.vertexFields
+        for name in fields:
+            if name not in self.edgeFields and name not in self.vertexFields:
+                raise KeyError('Unknown state property %s' % name)
+        return [f for f in fields if f in self.edgeFields], \
+               [f for f in fields if f in self.vertexFields]
+
+    #--------------------------------------------------------------------------
+
+    def load_from_graph(self, G, fields=None):
+        """Copies graph attributes into the state. Attributes that do not
+        exist or contain None are skipped, i.e. the state keeps its values.
+        INPUT: G: Vascular graph in iGraph format.
+               fields: List of the properties to be loaded. (Optional,
+                       default=None, i.e. all properties.)
+        OUTPUT: None
+        """
+        edgeFields, vertexFields = self._fields(fields)
+        for seq, names in [(G.es, edgeFields), (G.vs, vertexFields)]:
+            attributes = seq.attribute_names()
+            for name in names:
+                if name not in attributes:
+                    continue
+                values = seq[name]
+                if None in values:
+                    continue
+                getattr(self, name)[:] = values
+
+    #--------------------------------------------------------------------------
+
+    def store_to_graph(self, G, fields=None, edges=None):
+        """Copies the state to the graph attributes of the same name.
+        INPUT: G: Vascular graph in iGraph format.
+               fields: List of the properties to be stored. (Optional,
+                       default=None, i.e. all properties.)
+               edges: Array of edge indices. If provided, the edge properties
+                      are only stored for these edges. (Optional,
+                      default=None, i.e. all edges.)
+        OUTPUT: None, the graph attributes are updated (or created).
+        """
+        edgeFields, vertexFields = self._fields(fields)
+        for name in edgeFields:
+            if edges is None:
+                G.es[name] = getattr(self, name).tolist()
+            else:
+                edges = np.asarray(edges, dtype=np.int64)
+                G.es[edges.tolist()][name] = getattr(self, name)[edges].tolist()
+        for name in vertexFields:
+            G.vs[name] = getattr(self, name).tolist()
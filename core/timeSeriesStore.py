@@ -0,0 +1,385 @@
+"""This module provides a chunked, compressed, columnar storage for time
+series of vertex and edge properties (e.g. the samples of the RBC tracking
+simulations). A store is a directory holding one dataset per property. Every
+dataset is a 2-D array (time x entries), which is split into chunks along
+both axes. Each chunk is saved as a separate zlib compressed file
+'<timeChunk>.<entryChunk>' in the subdirectory of its dataset, the shapes
+and data types are described by the JSON file 'meta.json' (similar to the
+Zarr directory format, but with NumPy and the standard library only).
+Snapshots are appended along the time axis and are written to disk as soon
+as a time chunk is full, i.e. the memory footprint is bounded by one time
+chunk per dataset. The time series of single entries and single timesteps
+can be read without loading the whole dataset.
+"""
+from __future__ import division
+
+import json
+import os
+import zlib
+import numpy as np
+
+__all__ = ['TimeSeriesWriter', 'TimeSeriesReader']
+
+_METAFILE = 'meta.json'
+_FORMAT = 'vgm-timeseries'
+
+#------------------------------------------------------------------------------
+
+
+def _read_meta(path):
+    """Reads the metadata of a store.
+    INPUT: path: Directory of the store.
+    OUTPUT: Dictionary of the metadata.
+    """
+    with open(os.path.join(path, _METAFILE), 'r') as f:
+        meta = json.load(f)
+    if meta.get('format') != _FORMAT:
+        raise ValueError('%s is not a time series store' % path)
+    return meta
+
+#------------------------------------------------------------------------------
+
+
+def _chunk_file(path, name, timeChunk, entryChunk):
+    """Returns the file name of a chunk.
+    INPUT: path: Directory of the store.
+           name: Name of the dataset.
+           timeChunk, entryChunk: Chunk indices along both axes.
+    OUTPUT: File name.
+    """
+    return os.path.join(path, name, '%i.%i' % (timeChunk, entryChunk))
+
+#------------------------------------------------------------------------------
+
+
+def _read_chunk(path, meta, name, timeChunk, entryChunk):
+    """Reads and decompresses a chunk.
+    INPUT: path: Directory of the store.
+           meta: Dictionary of the metadata.
+           name: Name of the dataset.
+           timeChunk, entryChunk: Chunk indices along both axes.
+    OUTPUT: 2-D array of the chunk.
+    """
+    dataset = meta['datasets'][name]
+    chunkEntries = meta['chunkEntries']
+    nEntries = min(chunkEntries, dataset['size'] - entryChunk * chunkEntries)
+    with open(_chunk_file(path, name, timeChunk, entryChunk), 'rb') as f:
+        data = np.fromstring(zlib.decompress(f.read()), dtype=dataset['dtype'])
+    return data.reshape(meta['chunkRows'][timeChunk], nEntries)
+
+#------------------------------------------------------------------------------
+
+
+def _write_files(path, chunks, metaText, compression):
+    """Compresses and writes chunks, then writes the metadata (atomically,
+    i.e. a reader never sees a partially written metadata file, nor
+    metadata referring to missing chunks).
+    INPUT: path: Directory of the store.
+           chunks: List of tuples (filename, array).
+           metaText: Metadata in JSON format.
+           compression: zlib compression level.
+    OUTPUT: None
+    """
+    for filename, data in chunks:
+        with open(filename, 'wb') as f:
+            f.write(zlib.compress(data.tostring(), compression))
+    filename = os.path.join(path, _METAFILE)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(metaText)
+    os.rename(filename + '.tmp', filename)
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class TimeSeriesWriter(object):
+    """Appends snapshots of a fixed set of properties to a time series
+    store.
+    """
+    def __init__(self, path, sizes, dtype='float32', chunkTime=64,
+                 chunkEntries=65536, compression=6, mode='w',
+                 asyncWriter=None, restartTime=None):
+        """Initializes a TimeSeriesWriter instance.
+        INPUT: path: Directory of the store. It is created if it does not
+                     exist.
+               sizes: Dictionary of the properties and their number of
+                      entries (e.g. {'flow': G.ecount(), 'pressure':
+                      G.vcount()}). The snapshot times are stored in the
+                      additional dataset 'time' (float64).
+               dtype: Data type of the stored values. (Optional,
+                      default='float32'.)
+               chunkTime: Number of snapshots per chunk.
+               chunkEntries: Number of entries (vertices or edges) per
+                             chunk.
+               compression: zlib compression level (0-9).
+               mode: 'w' creates a new store (an existing store in the
+                     same directory is overwritten), 'a' appends to an
+                     existing store (e.g. when a simulation is restarted).
+                     (Optional, default='w'.)
+               asyncWriter: AsyncWriter instance, by which full chunks are
+                            compressed and written in the background.
+                            (Optional, default=None, i.e. chunks are written
+                            immediately.)
+               restartTime: In mode 'a', the snapshots taken after this
+                            time are discarded before appending, e.g. those
+                            written after the backup from which a simulation
+                            is restarted. (Optional, default=None, i.e. all
+                            snapshots are kept.)
+        OUTPUT: None
+        """
+        self.path = path
+        self._asyncWriter = asyncWriter
+        sizes = dict(sizes)
+        sizes['time'] = 1
+        if mode == 'a' and os.path.exists(os.path.join(path, _METAFILE)):
+            meta = _read_meta(path)
+            stored = dict([(k, v['size']) for k, v in
+                           meta['datasets'].items()])
+            if stored != sizes:
+                raise ValueError('The properties of %s do not match' % path)
+        elif mode in ['w', 'a']:
+            datasets = {}
+            for name, size in sizes.items():
+                datasets[name] = {'size': int(size),
+                                  'dtype': 'float64' if name == 'time' else
+                                           np.dtype(dtype).name}
+            meta = {'format': _FORMAT, 'version': 1,
+                    'chunkTime': int(chunkTime),
+                    'chunkEntries': int(chunkEntries),
+                    'compression': int(compression),
+                    'chunkRows': [], 'datasets': datasets}
+            for name in sizes:
+                directory = os.path.join(path, name)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                for f in os.listdir(directory):
+                    os.remove(os.path.join(directory, f))
+            self._meta = meta
+            _write_files(path, [], self._meta_text(), 0)
+        else:
+            raise ValueError('Unknown mode %s' % mode)
+        self._meta = meta
+        self._buffer = dict([(name, []) for name in sizes])
+        if mode == 'a' and restartTime is not None:
+            self._truncate(restartTime)
+
+    #--------------------------------------------------------------------------
+
+    def _meta_text(self):
+        """Returns the metadata in JSON format.
+        INPUT: None
+        OUTPUT: String.
+        """
+        return json.dumps(self._meta, indent=1, sort_keys=True)
+
+    #--------------------------------------------------------------------------
+
+    def _truncate(self, time):
+        """Discards the stored snapshots taken after the given time. The
+        remaining snapshots of the time chunk holding the first discarded
+        snapshot are moved back to the buffer and are written again by the
+        next flush.
+        INPUT: time: Time of the last snapshot that is kept.
+        OUTPUT: None
+        """
+        meta = self._meta
+        nTimeChunks = len(meta['chunkRows'])
+        for timeChunk in xrange(nTimeChunks):
+            times = _read_chunk(self.path, meta, 'time', timeChunk, 0)[:, 0]
+            later = np.nonzero(times > time)[0]
+            if len(later) > 0:
+                break
+        else:
+            return
+        nKept = later[0]
+        chunkEntries = meta['chunkEntries']
+        chunkFiles = []
+        for name, dataset in meta['datasets'].items():
+            nEntryChunks = (dataset['size'] + chunkEntries - 1) // chunkEntries
+            if nKept > 0:
+                block = np.hstack([_read_chunk(self.path, meta, name,
+                                               timeChunk, ec)
+                                   for ec in xrange(nEntryChunks)])
+                self._buffer[name] = list(block[:nKept])
+            chunkFiles.extend([_chunk_file(self.path, name, tc, ec)
+                               for tc in xrange(timeChunk, nTimeChunks)
+                               for ec in xrange(nEntryChunks)])
+        del meta['chunkRows'][timeChunk:]
+        # The metadata is updated before the chunks are removed, such that it
+        # never refers to missing chunks:
+        _write_files(self.path, [], self._meta_text(), 0)
+        for filename in chunkFiles:
+            os.remove(filename)
+
+    #--------------------------------------------------------------------------
+
+    def append(self, values, time):
+        """Appends a snapshot. The snapshot is written to disk once the
+        current time chunk is full.
+        INPUT: values: Dictionary of the current values of all properties.
+               time: Time of the snapshot.
+        OUTPUT: None
+        """
+        meta = self._meta
+        for name, dataset in meta['datasets'].items():
+            if name == 'time':
+                x = np.array([time], dtype=np.float64)
+            else:
+                x = np.asarray(values[name]).astype(dataset['dtype'])
+                if x.shape != (dataset['size'],):
+                    raise ValueError('Wrong number of entries of %s' % name)
+            self._buffer[name].append(x)
+        if len(self._buffer['time']) >= meta['chunkTime']:
+            self.flush()
+
+    #--------------------------------------------------------------------------
+
+    def flush(self):
+        """Writes the buffered snapshots to disk as a new time chunk.
+        INPUT: None
+        OUTPUT: None
+        """
+        nRows = len(self._buffer['time'])
+        if nRows == 0:
+            return
+        meta = self._meta
+        timeChunk = len(meta['chunkRows'])
+        chunkEntries = meta['chunkEntries']
+        chunks = []
+        for name, dataset in meta['datasets'].items():
+            block = np.vstack(self._buffer[name])
+            for entryChunk, start in enumerate(xrange(0, dataset['size'],
+                                                      chunkEntries)):
+                data = np.ascontiguousarray(block[:, start:start+chunkEntries])
+                chunks.append((_chunk_file(self.path, name, timeChunk,
+                                           entryChunk), data))
+            self._buffer[name] = []
+        meta['chunkRows'].append(nRows)
+        # The chunks are new arrays, i.e. they can be written in the
+        # background:
+        if self._asyncWriter is None:
+            _write_files(self.path, chunks, self._meta_text(),
+                         meta['compression'])
+        else:
+            self._asyncWriter.submit(_write_files, self.path, chunks,
+                                     self._meta_text(), meta['compression'])
+
+    #--------------------------------------------------------------------------
+
+    def close(self):
+        """Writes the buffered snapshots to disk.
+        INPUT: None
+        OUTPUT: None
+        """
+        self.flush()
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class TimeSeriesReader(object):
+    """Reads (parts of) the datasets of a time series store.
+    """
+    def __init__(self, path):
+        """Initializes a TimeSeriesReader instance.
+        INPUT: path: Directory of the store.
+        OUTPUT: None
+        """
+        self.path = path
+        self._meta = _read_meta(path)
+        self._rowStart = np.zeros(len(self._meta['chunkRows']) + 1,
+                                  dtype=np.int64)
+        np.cumsum(self._meta['chunkRows'], out=self._rowStart[1:])
+
+    #--------------------------------------------------------------------------
+
+    def properties(self):
+        """Returns the names of the stored properties.
+        INPUT: None
+        OUTPUT: List of property names (excluding 'time').
+        """
+        return sorted([str(k) for k in self._meta['datasets'] if k != 'time'])
+
+    #--------------------------------------------------------------------------
+
+    def __len__(self):
+        """Returns the number of stored snapshots.
+        INPUT: None
+        OUTPUT: Number of snapshots.
+        """
+        return int(self._rowStart[-1])
+
+    #--------------------------------------------------------------------------
+
+    def _chunk(self, name, timeChunk, entryChunk):
+        """Reads and decompresses a chunk.
+        INPUT: name: Name of the dataset.
+               timeChunk, entryChunk: Chunk indices along both axes.
+        OUTPUT: 2-D array of the chunk.
+        """
+        return _read_chunk(self.path, self._meta, name, timeChunk, entryChunk)
+
+    #--------------------------------------------------------------------------
+
+    def read(self, name, steps=None, entries=None):
+        """Reads a dataset, or a part of it. Only the chunks holding the
+        requested data are read.
+        INPUT: name: Name of the dataset.
+               steps: Sequence of snapshot indices. (Optional, default=None,
+                      i.e. all snapshots.)
+               entries: Sequence of entry (vertex or edge) indices.
+                        (Optional, default=None, i.e. all entries.)
+        OUTPUT: 2-D array (steps x entries).
+        """
+        dataset = self._meta['datasets'][name]
+        chunkEntries = self._meta['chunkEntries']
+        if steps is None:
+            steps = np.arange(len(self))
+        if entries is None:
+            entries = np.arange(dataset['size'])
+        steps = np.atleast_1d(np.asarray(steps, dtype=np.int64))
+        entries = np.atleast_1d(np.asarray(entries, dtype=np.int64))
+        if np.any(steps < 0) or np.any(steps >= len(self)) or \
+           np.any(entries < 0) or np.any(entries >= dataset['size']):
+            raise IndexError('Index out of range of dataset %s' % name)
+        result = np.empty((len(steps), len(entries)), dtype=dataset['dtype'])
+        timeChunks = np.searchsorted(self._rowStart, steps, side='right') - 1
+        entryChunks = entries // chunkEntries
+        for tc in np.unique(timeChunks):
+            rows = np.nonzero(timeChunks == tc)[0]
+            for ec in np.unique(entryChunks):
+                cols = np.nonzero(entryChunks == ec)[0]
+                chunk = self._chunk(name, tc, ec)
+                result[np.ix_(rows, cols)] = chunk[np.ix_(
+                    steps[rows] - self._rowStart[tc],
+                    entries[cols] - ec * chunkEntries)]
+        return result
+
+    #--------------------------------------------------------------------------
+
+    def times(self):
+        """Returns the times of all snapshots.
+        INPUT: None
+        OUTPUT: Array of the snapshot times.
+        """
+        return self.read('time')[:, 0]
+
+    #--------------------------------------------------------------------------
+
+    def series(self, name, entry):
+        """Returns the time series of a single entry.
+        INPUT: name: Name of the dataset.
+               entry: Vertex or edge index.
+        OUTPUT: Array of the values of the entry, one per snapshot.
+        """
+        return self.read(name, entries=[entry])[:, 0]
+
+    #--------------------------------------------------------------------------
+
+    def snapshot(self, name, step):
+        """Returns all entries of a single snapshot.
+        INPUT: name: Name of the dataset.
+               step: Snapshot index.
+        OUTPUT: Array of the values of all entries.
+        """
+        return self.read(name, steps=[step])[0]
@@ -0,0 +1,159 @@
+"""This module classifies the vertices of a vascular graph based on the flow
+direction in their adjacent edges. The vertex-edge incidence is stored once
+in compressed sparse row (CSR) format, i.e. as a flat array of the adjacent
+edges of all vertices together with the offset of every vertex in that
+array. Given the edge property 'sign', the in- and outflow edges, their
+number and the resulting vertex type of many vertices are then obtained by a
+few vectorized operations, instead of comparing neighbor pressures vertex by
+vertex.
+"""
+from __future__ import division
+
+import numpy as np
+
+__all__ = ['VertexClassifier']
+
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+
+
+class VertexClassifier(object):
+    """Computes in- and outflow edges and vertex types from the flow sign of
+    the edges. The vertex types are those of the LinearSystemHtd classes:
+    divergent = 3, convergent = 4, connecting = 5, double connecting = 6.
+    Vertices that do not fall into any of these groups (inflow, outflow and
+    noFlow vertices) are assigned type 0 and need to be treated by the
+    caller.
+    """
+    def __init__(self, G):
+        """Initializes a VertexClassifier instance.
+        INPUT: G: Vascular graph in iGraph format. The topology of G must not
+                  change during the lifetime of the classifier.
+        OUTPUT: None
+        """
+        nV = G.vcount()
+        incidence = G.get_inclist()
+        self.degree = np.array([len(a) for a in incidence], dtype=np.int64)
+        offset = np.zeros(nV + 1, dtype=np.int64)
+        np.cumsum(self.degree, out=offset[1:])
+        self.offset = offset
+        # Adjacent edges in the order of G.adjacent():
+        self.edges = np.array([e for a in incidence for e in a],
+                              dtype=np.int64)
+        if G.ecount() > 0:
+            edgelist = np.array(G.get_edgelist(), dtype=np.int64)
+        else:
+            edgelist = np.zeros((0, 2), dtype=np.int64)
+        self.source = edgelist[:, 0]
+        self.target = edgelist[:, 1]
+        self._vertexOfSlot = np.repeat(np.arange(nV, dtype=np.int64),
+                                       self.degree)
+        # +1 if the vertex is the source of the edge, -1 if it is the target:
+        self._orientation = np.where(
+            self.source[self.edges] == self._vertexOfSlot, 1.0, -1.0)
+        self._nV = nV
+
+    #--------------------------------------------------------------------------
+
+    def _slots(self, vertices):
+        """Returns the positions of the adjacent edges of the given vertices
+        in the flat edge array.
+        INPUT: vertices: Array of vertex indices.
+        OUTPUT: Array of slot indices, ordered by vertex.
+        """
+        degree = self.degree[vertices]
+        start = np.zeros(len(vertices), dtype=np.int64)
+        np.cumsum(degree[:-1], out=start[1:])
+        return np.arange(degree.sum(), dtype=np.int64) + \
+               np.repeat(self.offset[vertices] - start, degree)
+
+    #--------------------------------------------------------------------------
+
+    def changed_vertices(self, sign, signOld):
+        """Finds the vertices that are adjacent to an edge whose flow sign
+        has changed.
+        INPUT: sign: Array of the current flow signs of the edges.
+               signOld: Array of the flow signs of the previous timestep.
+        OUTPUT: Sorted array of vertex indices.
+        """
+        changed = np.nonzero(np.asarray(sign) != np.asarray(signOld))[0]
+        return np.unique(np.concatenate([self.source[changed],
+                                         self.target[changed]]))
+
+    #--------------------------------------------------------------------------
+
+    def classify(self, sign, vertices=None, capEdge=None):
+        """Computes the in- and outflow edges and the type of the given
+        vertices. Edges with sign zero are neither in- nor outflow edges.
+        INPUT: sign: Array of the flow signs of the edges.
+               vertices: Array of the vertices to be classified.
+                         (Optional, default=None, i.e. all vertices.)
+               capEdge: Boolean array marking the capillary edges. If
+                        provided, it is determined whether all inflow edges
+                        of a vertex are capillaries and capillaries make up
+                        the majority of its adjacent edges.
+                        (Optional, default=None.)
+        OUTPUT: Dictionary with the following arrays (one entry per vertex
+                in the order of 'vertices'):
+                vertices: The classified vertices.
+                vType: Vertex type (3, 4, 5, 6 or 0, see above).
+                nIn, nOut: Number of in- and outflow edges.
+                inEdges, outEdges: Flat arrays of the in- and outflow edges,
+                                   in the order of G.adjacent().
+                inOffset, outOffset: Start of the edges of every vertex in
+                                     inEdges, outEdges (length n+1).
+                isCap: Capillary inflow criterion (only if capEdge is
+                       given).
+        """
+        if vertices is None:
+            vertices = np.arange(self._nV, dtype=np.int64)
+            slots = np.arange(len(self.edges), dtype=np.int64)
+        else:
+            vertices = np.asarray(vertices, dtype=np.int64)
+            slots = self._slots(vertices)
+        n = len(vertices)
+        local = np.repeat(np.arange(n, dtype=np.int64), self.degree[vertices])
+        edges = self.edges[slots]
+        direction = np.asarray(sign, dtype=float)[edges] * \
+                    self._orientation[slots]
+        isIn = direction < 0
+        isOut = direction > 0
+        nIn = np.bincount(local[isIn], minlength=n)
+        nOut = np.bincount(local[isOut], minlength=n)
+        inOffset = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(nIn, out=inOffset[1:])
+        outOffset = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(nOut, out=outOffset[1:])
+
+        vType = np.zeros(n, dtype=np.int64)
+        vType[(nOut > nIn) & (nIn >= 1)] = 3
+        vType[(nIn > nOut) & (nOut >= 1)] = 4
+        vType[(nIn == nOut) & (nIn == 1)] = 5
+        vType[(nIn == nOut) & (nIn == 2)] = 6
+
+        result = {'vertices': vertices, 'vType': vType, 'nIn': nIn,
+                  'nOut': nOut, 'inEdges': edges[isIn],
+                  'outEdges': edges[isOut], 'inOffset': inOffset,
+                  'outOffset': outOffset}
+        if capEdge is not None:
+            isCapSlot = np.asarray(capEdge, dtype=bool)[edges]
+            capCount = np.bincount(local[isCapSlot], minlength=n)
+            capCountIn = np.bincount(local[isCapSlot & isIn], minlength=n)
+            result['isCap'] = (capCountIn == nIn) & \
+                              (capCount > self.degree[vertices] / 2.)
+        return result
+
+    #--------------------------------------------------------------------------
+
+    def flow_edges(self, classification):
+        """Splits the flat in- and outflow edge arrays of a classification
+        into lists of edges per vertex.
+        INPUT: classification: Dictionary as returned by classify().
+        OUTPUT: inflowE, outflowE: Lists (one per vertex) of lists of edges.
+        """
+        c = classification
+        inflowE = [a.tolist() for a in
+                   np.split(c['inEdges'], c['inOffset'][1:-1])]
+        outflowE = [a.tolist() for a in
+                    np.split(c['outEdges'], c['outOffset'][1:-1])]
+        return inflowE, outflowE